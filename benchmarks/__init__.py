@@ -0,0 +1,40 @@
+"""Micro-benchmarks, run as modules from the root of the checkout
+
+e.g. `python -m benchmarks.bench_filters`
+
+End to end ingest and query timings against a database live in
+`bench_pipeline`, a pytest-benchmark suite over synthetic problem lists
+from `generator`.
+
+"""
+import json
+import os
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tests')
+
+
+def load_problem_list(filename='prob_list.json'):
+    """Returns the problem list from the named file in tests/"""
+    with open(os.path.join(TESTS_DIR, filename), 'r') as json_file:
+        return json.load(json_file)['problem_list']
+
+
+def serialized_problems(problem_list):
+    """Problems serialized as by `Observation.to_json()`, sans database"""
+    from cdr.api.ingest import collect_problems
+
+    codes, problems = collect_problems(problem_list)
+    serialized = []
+    for problem in problems:
+        d = {}
+        for field in ('code', 'icd9', 'icd10'):
+            if getattr(problem, field):
+                d[field] = dict(codes[getattr(problem, field)])
+        status_code, code, value = problem.status
+        d['status'] = {'status_code': status_code}
+        if code:
+            d['status']['code'] = dict(codes[code])
+        if value:
+            d['status']['value'] = dict(codes[value])
+        serialized.append(d)
+    return serialized
@@ -0,0 +1,52 @@
+"""Cohort expression evaluation time versus number of patients
+
+Evaluates a typical "any of these AND NOT those" expression over random
+per code bitmaps, as decoded from storage.
+
+"""
+import random
+import timeit
+
+from cdr.api.cohort import decode, encode, evaluate, from_ids, members
+
+EXPRESSION = {'and': [
+    {'or': ['icd10:E11.9', 'icd10:E11.65', 'icd10:E10*']},
+    {'not': {'or': ['icd10:I10', 'icd10:N18.3']}}]}
+
+# fraction of patients having each leaf's code(s)
+PREVALENCE = {
+    'icd10:E11.9': 0.08, 'icd10:E11.65': 0.02, 'icd10:E10*': 0.005,
+    'icd10:I10': 0.3, 'icd10:N18.3': 0.01}
+
+
+def main(sizes=(1000, 10000, 100000, 1000000), number=20):
+    rng = random.Random(42)
+    print("{:>9} {:>12} {:>12} {:>12}".format(
+        'patients', 'evaluate ms', 'decode ms', 'page ms'))
+    for size in sizes:
+        stored = {
+            leaf: encode(from_ids(rng.sample(
+                range(1, size + 1), int(size * prevalence) or 1)))
+            for leaf, prevalence in PREVALENCE.items()}
+        leaves = {leaf: decode(data) for leaf, data in stored.items()}
+        universe = (1 << (size + 1)) - 2
+
+        def run():
+            return evaluate(EXPRESSION, leaves.__getitem__, universe)
+
+        def decode_all():
+            return [decode(data) for data in stored.values()]
+
+        result = run()
+
+        def first_page():
+            return [id for id, _ in zip(members(result), range(1000))]
+
+        timings = [
+            timeit.timeit(fn, number=number) / number * 1e3
+            for fn in (run, decode_all, first_page)]
+        print("{:>9} {:>12.3f} {:>12.3f} {:>12.3f}".format(size, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Compare reference and compiled problem list filter evaluation
+
+Each request used to re-parse the filter and rebuild its closures; the
+compiled filter is memoized by the raw parameter string.
+
+"""
+import json
+import timeit
+
+from benchmarks import load_problem_list, serialized_problems
+from cdr.api.filters import compile_filter, filter_func
+
+FILTER = json.dumps({
+    'filter': {
+        'icd9': {'code': ['133.0', '296.2*', '296.3*', '300.4', '311.*']},
+        'icd10': {'code': ['E78.*', 'H21.239']}},
+    'status': {'value': {
+        'code': '55561003', 'code_system': '2.16.840.1.113883.6.96'}}})
+
+
+def reference(problems):
+    pass_filter = filter_func(FILTER)
+    return [p for p in problems if pass_filter(p)]
+
+
+def compiled(problems):
+    matches = compile_filter(FILTER).matches
+    return [p for p in problems if matches(p)]
+
+
+def main(number=2000):
+    problems = serialized_problems(load_problem_list())
+    assert reference(problems) == compiled(problems)
+    print("{} observations, {} requests each".format(len(problems), number))
+    for fn in (reference, compiled):
+        elapsed = timeit.timeit(lambda: fn(problems), number=number)
+        print("{:>10}: {:.2f} us/request".format(
+            fn.__name__, elapsed / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
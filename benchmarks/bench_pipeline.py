@@ -0,0 +1,157 @@
+"""Ingest and query benchmarks, run with pytest-benchmark
+
+e.g. `python -m pytest benchmarks/bench_pipeline.py
+--benchmark-json=results.json`, keeping the JSON to compare releases.
+
+Sizes and database are configured through the environment:
+
+    CDR_BENCH_DATABASE_URI: defaults to a SQLite file, or point at a
+        local (scratch!) PostgreSQL database - its tables are dropped
+    CDR_BENCH_PATIENTS: patients preloaded for queries (200)
+    CDR_BENCH_PROBLEMS: problems per patient (50)
+    CDR_BENCH_VOCABULARY: distinct diagnoses (500)
+
+"""
+from datetime import datetime, timedelta
+from itertools import count, cycle
+import json
+import os
+import urllib.parse
+
+import pytest
+
+from benchmarks.generator import hl7_ts, patients, vocabulary
+from cdr import create_app
+from cdr.api.models import ClinicalDoc, parse_problem_list
+from cdr.config import TestConfig
+from cdr.extensions import sdb
+
+BENCH_DB_PATH = '/tmp/cdr_bench.db'
+DATABASE_URI = os.environ.get(
+    'CDR_BENCH_DATABASE_URI', 'sqlite:///' + BENCH_DB_PATH)
+PATIENTS = int(os.environ.get('CDR_BENCH_PATIENTS', 200))
+PROBLEMS = int(os.environ.get('CDR_BENCH_PROBLEMS', 50))
+VOCABULARY = int(os.environ.get('CDR_BENCH_VOCABULARY', 500))
+
+
+class BenchConfig(TestConfig):
+    SQLALCHEMY_DATABASE_URI = DATABASE_URI
+
+
+@pytest.fixture
+def client():
+    app = create_app(BenchConfig)
+    with app.app_context():
+        sdb.app = app
+        sdb.drop_all()
+        sdb.create_all()
+        yield app.test_client()
+        sdb.session.remove()
+        sdb.drop_all()
+    if os.path.exists(BENCH_DB_PATH):
+        os.unlink(BENCH_DB_PATH)
+
+
+@pytest.fixture
+def populated(client):
+    """Client with PATIENTS uploaded, returns (client, MRNs)"""
+    mrns = []
+    for mrn, data in patients(PATIENTS, PROBLEMS, VOCABULARY):
+        assert client.put(
+            '/patients/{}/ccda'.format(mrn), json=data).status_code == 200
+        mrns.append(mrn)
+    return client, mrns
+
+
+@pytest.fixture(autouse=True)
+def extra_info(benchmark):
+    benchmark.extra_info.update(
+        dialect=DATABASE_URI.partition(':')[0], patients=PATIENTS,
+        problems=PROBLEMS, vocabulary=VOCABULARY)
+
+
+def test_parse_problem_list(benchmark, client):
+    generated = patients(10 ** 6, PROBLEMS, VOCABULARY, seed=1)
+
+    def setup():
+        mrn, data = next(generated)
+        doc = ClinicalDoc(mrn=mrn, filepath=data['filepath']).save()
+        return (data['problem_list'], doc), {}
+
+    def parse(problem_list, doc):
+        parse_problem_list(problem_list, doc)
+        sdb.session.commit()
+
+    benchmark.pedantic(parse, setup=setup, rounds=50)
+
+
+def test_upload_ccda(benchmark, client):
+    generated = patients(10 ** 6, PROBLEMS, VOCABULARY, seed=2)
+
+    def setup():
+        mrn, data = next(generated)
+        return ('/patients/{}/ccda'.format(mrn),), {'json': data}
+
+    def upload(url, json):
+        assert client.put(url, json=json).json['message'] == 'upload ok'
+
+    benchmark.pedantic(upload, setup=setup, rounds=50)
+
+
+def test_replace_ccda(benchmark, populated):
+    """Uploads replacing an existing problem list"""
+    client, mrns = populated
+    generated = patients(10 ** 6, PROBLEMS, VOCABULARY, seed=3)
+    effective = count()
+
+    def setup():
+        _, data = next(generated)
+        data['effectiveTime'] = hl7_ts(
+            datetime(2030, 1, 1) + timedelta(seconds=next(effective)))
+        return ('/patients/{}/ccda'.format(mrns[0]),), {'json': data}
+
+    def upload(url, json):
+        assert client.put(url, json=json).json['message'] == 'upload ok'
+
+    benchmark.pedantic(upload, setup=setup, rounds=50)
+
+
+@pytest.mark.parametrize('filter_by', (
+    None,
+    {'filter': {'icd10': {'code': ['E*', 'I10.1']}}},
+))
+def test_get_problem_list(benchmark, populated, filter_by):
+    client, mrns = populated
+    query = ''
+    if filter_by:
+        query = '?filter=' + urllib.parse.quote(json.dumps(filter_by))
+    urls = cycle(
+        '/patients/{}/problem_list{}'.format(mrn, query) for mrn in mrns)
+
+    def get():
+        assert client.get(next(urls)).status_code == 200
+
+    benchmark(get)
+
+
+def test_get_problem_lists(benchmark, populated):
+    client, mrns = populated
+    batch = {'mrns': mrns[:100]}
+
+    def get():
+        assert client.post('/problem_lists', json=batch).status_code == 200
+
+    benchmark(get)
+
+
+@pytest.mark.parametrize('prefix', (False, True))
+def test_diagnosis_lookup(benchmark, populated, prefix):
+    client, _ = populated
+    _, _, icd10 = vocabulary(VOCABULARY)[0]
+    code = icd10['_code'][0] + '*' if prefix else icd10['_code']
+    url = '/diagnosis/icd10/{}/patients'.format(code)
+
+    def get():
+        assert client.get(url).status_code == 200
+
+    benchmark(get)
@@ -0,0 +1,60 @@
+"""Compare peak memory and time of decoding uploads whole and streamed
+
+`tests/prob_list.json` is scaled up by repeating its entries, as a
+patient with a long problem list.
+
+"""
+from io import BytesIO
+import json
+import time
+import tracemalloc
+
+from benchmarks import load_problem_list
+from cdr.api.ingest import collect_problems, content_hash
+from cdr.api.stream import read_upload
+
+
+def scaled_upload(scale):
+    problem_list = load_problem_list()
+    section = problem_list['section']
+    section['entry'] = section['entry'] * scale
+    return json.dumps({
+        'filepath': '/tmp/scaled', 'effectiveTime': '20151023101908-0400',
+        'problem_list': problem_list}).encode('utf-8')
+
+
+def whole(body):
+    data = json.load(BytesIO(body))
+    return content_hash(data['problem_list']), collect_problems(
+        data['problem_list'])
+
+
+def streamed(body):
+    problem_list = read_upload(BytesIO(body))['problem_list']
+    return content_hash(problem_list), collect_problems(problem_list)
+
+
+def measure(fn, body):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(body)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(scales=(1, 10, 50)):
+    for scale in scales:
+        body = scaled_upload(scale)
+        assert whole(body) == streamed(body)
+        print("{} entries, {:.1f} MB body".format(
+            51 * scale, len(body) / 2 ** 20))
+        for fn in (whole, streamed):
+            elapsed, peak = measure(fn, body)
+            print("{:>10}: {:.1f} MB peak, {:.0f} ms".format(
+                fn.__name__, peak / 2 ** 20, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
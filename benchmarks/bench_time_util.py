@@ -0,0 +1,57 @@
+"""Compare dateutil and HL7 fast path parsing of CCDA timestamps
+
+Every observation carries an author time and effectiveTime, each once
+sent through the generic dateutil parser.
+
+"""
+import timeit
+
+from dateutil.parser import parse as dateutilparse
+import pytz
+from tzlocal import get_localzone
+
+from benchmarks import load_problem_list
+from cdr.time_util import parse_datetime
+
+
+def timestamps(node):
+    """Generate all HL7 TS `_value`s found within node"""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == '_value' and isinstance(value, str) and (
+                    value[:8].isdigit()):
+                yield value
+            else:
+                yield from timestamps(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from timestamps(item)
+
+
+def reference(values):
+    """parse_datetime as it was, dateutil and a local zone lookup per call"""
+    parsed = []
+    for value in values:
+        dt = dateutilparse(value)
+        if not dt.tzinfo:
+            dt = get_localzone().localize(dt, is_dst=None)
+        parsed.append(dt.astimezone(pytz.UTC))
+    return parsed
+
+
+def fast_path(values):
+    return [parse_datetime(value) for value in values]
+
+
+def main(number=200):
+    values = list(timestamps(load_problem_list()))
+    assert reference(values) == fast_path(values)
+    print("{} timestamps, {} passes each".format(len(values), number))
+    for fn in (reference, fast_path):
+        elapsed = timeit.timeit(lambda: fn(values), number=number)
+        print("{:>10}: {:.2f} us/timestamp".format(
+            fn.__name__, elapsed / number / len(values) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Synthetic problem lists, in the Mirth JSON shape of `tests/prob_list.json`
+
+Output is deterministic for a given seed, so runs remain comparable
+release to release.
+
+"""
+from datetime import datetime, timedelta
+import random
+
+ICD9, ICD10 = '2.16.840.1.113883.6.103', '2.16.840.1.113883.6.90'
+SNOMED, LOINC = '2.16.840.1.113883.6.96', '2.16.840.1.113883.6.1'
+
+STATUSES = (
+    ('55561003', 'Active'),
+    ('73425007', 'Inactive'),
+    ('413322009', 'Resolved'),
+)
+
+
+def code(code, system, system_name, display, **extra):
+    json = {
+        '_code': code, '_codeSystem': system,
+        '_codeSystemName': system_name, '_displayName': display}
+    json.update(extra)
+    return json
+
+
+def vocabulary(size, seed=0):
+    """Returns list of `size` (SNOMED, ICD-9, ICD-10) code triples"""
+    rng = random.Random(seed)
+    triples = []
+    for i in range(size):
+        # spread over a few ICD-10 chapters, for realistic prefix lookups
+        chapter = rng.choice('EFIJKM')
+        icd10 = '{}{:02d}.{}'.format(chapter, i // 10 % 100, i % 10)
+        triples.append((
+            code(str(100000000 + i), SNOMED, 'SNOMED CT',
+                 'Synthetic disorder {}'.format(i), _type='CD'),
+            code('{:03d}.{}'.format(i // 10 % 1000, i % 10), ICD9,
+                 'ICD-9-CM', 'Synthetic ICD-9 {}'.format(i)),
+            code(icd10, ICD10, 'ICD-10-CM', 'Synthetic ICD-10 {}'.format(i))))
+    return triples
+
+
+def hl7_ts(dt, offset=True):
+    return dt.strftime('%Y%m%d%H%M%S') + ('-0500' if offset else '')
+
+
+def observation(triple, status, onset, entry):
+    snomed, icd9, icd10 = triple
+    value = dict(snomed)
+    value['_'] = {'translation': [icd10, icd9]}
+    status_code, status_display = status
+    return {
+        '_classCode': 'OBS', '_moodCode': 'EVN',
+        '_': {
+            'code': code(
+                '282291009', SNOMED, 'SNOMED CT', 'Diagnosis'),
+            'author': {'time': {'_value': hl7_ts(entry, offset=False)}},
+            'effectiveTime': {
+                'high': {'_nullFlavor': 'UNK'},
+                'low': {'_value': hl7_ts(onset)}},
+            'value': value,
+            'entryRelationship': {
+                '_inversionInd': 'false', '_typeCode': 'REFR',
+                '_': {'observation': {
+                    '_classCode': 'OBS', '_moodCode': 'EVN',
+                    '_': {
+                        'statusCode': {'_code': 'completed'},
+                        'code': code('33999-4', LOINC, 'LOINC', 'Status'),
+                        'value': code(
+                            status_code, SNOMED, 'SNOMED CT',
+                            status_display, _type='CD')}}}},
+            'statusCode': {'_code': 'completed'}}}
+
+
+def problem_list(problems, terms, rng):
+    """Returns problem list of `problems` entries drawn from terms"""
+    start = datetime(2015, 1, 1)
+    entries = []
+    for triple in rng.sample(terms, min(problems, len(terms))):
+        onset = start + timedelta(days=rng.randrange(1500))
+        entry = onset + timedelta(days=rng.randrange(30), minutes=17)
+        entries.append({'act': {
+            '_classCode': 'ACT', '_moodCode': 'EVN',
+            '_': {
+                'code': code(
+                    'CONC', '2.16.840.1.113883.5.6', 'HL7ActClass',
+                    'Concern'),
+                'entryRelationship': {
+                    '_inversionInd': 'false', '_typeCode': 'SUBJ',
+                    '_': {'observation': observation(
+                        triple, rng.choice(STATUSES), onset, entry)}},
+                'statusCode': {'_code': 'active'}}}})
+    return {'section': {
+        'title': 'Conditions or Problems',
+        'code': code('11450-4', LOINC, 'LOINC', 'Problem List'),
+        'entry': entries}}
+
+
+def patients(count, problems=50, vocabulary_size=500, seed=0):
+    """Generate (MRN, upload JSON) for `count` synthetic patients
+
+    :param problems: problems per patient
+    :param vocabulary_size: distinct diagnoses shared across patients
+
+    """
+    rng = random.Random(seed)
+    terms = vocabulary(vocabulary_size, seed)
+    effective = datetime(2019, 11, 1)
+    for i in range(count):
+        yield 'bench{:07d}'.format(i), {
+            'filepath': '/tmp/bench/{}.xml'.format(i),
+            'effectiveTime': hl7_ts(effective + timedelta(seconds=i)),
+            'problem_list': problem_list(problems, terms, rng)}
@@ -0,0 +1,216 @@
+"""Compressed archive of received upload payloads
+
+Enabled by configuring ARCHIVE_DIR.  Each payload is stored as received,
+compressed with zstd when the `zstandard` package is installed, gzip
+otherwise (or as set by ARCHIVE_COMPRESSION), and addressed by the sha256
+of its uncompressed bytes:
+
+    ARCHIVE_DIR/ab/cd/abcd...ef.json.gz
+
+Identical payloads are stored once, and only if referenced by a clinical
+doc once ingested: those of obsolete or unchanged uploads are dropped.
+Payloads of since replaced uploads are kept.  Uploads are written through
+as they are read, so the archive costs no buffering of the body.
+
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+
+from flask import current_app
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Gzip(object):
+    name = 'gzip'
+    suffix = '.json.gz'
+
+    @staticmethod
+    def writer(fileobj):
+        # fixed mtime, so identical payloads compress identically
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+
+    @staticmethod
+    def reader(path):
+        return gzip.open(path, 'rb')
+
+
+class Zstd(object):
+    name = 'zstd'
+    suffix = '.json.zst'
+
+    @staticmethod
+    def writer(fileobj):
+        return zstandard.ZstdCompressor().stream_writer(
+            fileobj, closefd=False)
+
+    @staticmethod
+    def reader(path):
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+
+CODECS = {codec.name: codec for codec in (Gzip, Zstd)}
+
+
+def enabled():
+    return bool(current_app.config.get('ARCHIVE_DIR'))
+
+
+def codec():
+    """Returns the configured codec, else the best available"""
+    name = current_app.config.get('ARCHIVE_COMPRESSION')
+    if not name:
+        name = 'zstd' if zstandard else 'gzip'
+    if name == 'zstd' and zstandard is None:
+        raise ValueError("ARCHIVE_COMPRESSION zstd requires zstandard")
+    return CODECS[name]
+
+
+def _path(key, codec):
+    return os.path.join(
+        current_app.config['ARCHIVE_DIR'], key[:2], key[2:4],
+        key + codec.suffix)
+
+
+def locate(key):
+    """Returns (path, codec) of the archived payload, or None if absent"""
+    for codec in CODECS.values():
+        path = _path(key, codec)
+        if os.path.exists(path):
+            return path, codec
+    return None
+
+
+def key_for(payload):
+    """Returns the archive key of the payload bytes"""
+    return hashlib.sha256(payload).hexdigest()
+
+
+class Writer(object):
+    """Compress bytes to a temporary file
+
+    `finish()` returns the payload's key, after which the file is either
+    moved into place by `keep()` or removed by `discard()`.
+
+    """
+
+    def __init__(self):
+        self.codec = codec()
+        self.digest = hashlib.sha256()
+        tmp_dir = os.path.join(current_app.config['ARCHIVE_DIR'], 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(
+            dir=tmp_dir, suffix=self.codec.suffix, delete=False)
+        self.compressor = self.codec.writer(self.file)
+        self.key = None
+
+    def write(self, data):
+        self.digest.update(data)
+        self.compressor.write(data)
+
+    def finish(self):
+        if self.key is None:
+            self.compressor.close()
+            self.file.close()
+            self.key = self.digest.hexdigest()
+        return self.key
+
+    def keep(self):
+        """Store the payload written, returns its key"""
+        key = self.finish()
+        if locate(key):
+            os.unlink(self.file.name)
+            return key
+        path = _path(key, self.codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.file.name, path)
+        return key
+
+    def discard(self):
+        self.finish()
+        os.unlink(self.file.name)
+
+
+class Tee(object):
+    """Read through wrapper of a binary stream, compressing all read
+
+    Once the stream is consumed, `finish()` returns the payload's key,
+    and `keep()` stores it, or `discard()` drops it.
+
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = Writer()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.writer.write(data)
+        return data
+
+    def finish(self):
+        # archive the payload whole, even if the reader stopped short
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.writer.finish()
+
+    def keep(self):
+        return self.writer.keep()
+
+    def discard(self):
+        self.writer.discard()
+
+
+def store(payload):
+    """Archive the payload bytes, returns its key"""
+    writer = Writer()
+    try:
+        writer.write(payload)
+    except Exception:
+        writer.discard()
+        raise
+    return writer.keep()
+
+
+def open_payload(key):
+    """Returns binary file object of the uncompressed payload
+
+    Raises LookupError if not archived.
+
+    """
+    found = locate(key)
+    if not found:
+        raise LookupError("payload {} not archived".format(key))
+    path, codec = found
+    return codec.reader(path)
+
+
+def iter_payload(key, chunk_size=CHUNK_SIZE):
+    """Returns generator of the uncompressed payload in chunks
+
+    The payload is located up front, so the generator needs no app
+    context, as when streaming a response.  Raises LookupError if not
+    archived.
+
+    """
+    found = locate(key)
+    if not found:
+        raise LookupError("payload {} not archived".format(key))
+    return _iter_file(*found, chunk_size=chunk_size)
+
+
+def _iter_file(path, codec, chunk_size):
+    with codec.reader(path) as payload:
+        while True:
+            chunk = payload.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
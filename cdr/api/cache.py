@@ -0,0 +1,141 @@
+"""Process wide interning of Code and Status ids
+
+Codes and statuses form an append only vocabulary repeated across nearly
+every patient, so once an id is known it need not be looked up again.
+
+Each gunicorn worker holds its own caches.  To keep them safe, ids learned
+within a transaction are staged on the session and only promoted into the
+shared cache once that transaction commits - a rollback discards them.
+
+"""
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import event
+
+from .. import metrics
+from ..extensions import sdb
+
+PENDING_KEY = 'cdr_id_cache_pending'
+
+
+class LRUCache(object):
+    """Bounded mapping, evicting the least recently used entries"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Returns cached value or None, maintaining hit/miss counts"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self._data), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses}
+
+
+class IdCache(LRUCache):
+    """LRU of committed ids, with per session staging of new entries"""
+
+    def __init__(self, name, maxsize):
+        super(IdCache, self).__init__(maxsize)
+        self.name = name
+
+    def _pending(self):
+        return sdb.session.info.setdefault(
+            PENDING_KEY, {}).setdefault(self.name, {})
+
+    def lookup(self, key):
+        """Returns id for key, from this cache or the session's staged ids"""
+        id = self.get(key)
+        if id is None:
+            id = self._pending().get(key)
+        return id
+
+    def remember(self, key, id):
+        """Stage id for key, promoted to the cache on commit"""
+        self._pending()[key] = id
+
+
+# keyed on (code, code_system)
+code_ids = IdCache('code', maxsize=10000)
+
+# keyed on (status_code, code_id, value_id)
+status_ids = IdCache('status', maxsize=1000)
+
+CACHES = {cache.name: cache for cache in (code_ids, status_ids)}
+
+
+def configure(app):
+    """Size and clear caches - ids from another database are meaningless"""
+    code_ids.resize(app.config['CODE_CACHE_SIZE'])
+    status_ids.resize(app.config['STATUS_CACHE_SIZE'])
+    for cache in CACHES.values():
+        cache.clear()
+
+
+def stats():
+    """Returns dict of stats for each cache, by name"""
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+@event.listens_for(sdb.session, 'after_commit')
+def promote_pending(session):
+    for name, pending in session.info.pop(PENDING_KEY, {}).items():
+        cache = CACHES[name]
+        for key, id in pending.items():
+            cache.set(key, id)
+
+
+@event.listens_for(sdb.session, 'after_soft_rollback')
+def discard_pending(session, previous_transaction):
+    session.info.pop(PENDING_KEY, None)
+
+
+metrics.describe(
+    'cdr_id_cache_hits_total', 'counter', 'Id cache lookups found')
+metrics.describe(
+    'cdr_id_cache_misses_total', 'counter', 'Id cache lookups missed')
+metrics.describe('cdr_id_cache_size', 'gauge', 'Ids held in cache')
+
+
+@metrics.collector
+def cache_metrics():
+    for name, cache in CACHES.items():
+        yield 'cdr_id_cache_hits_total', {'cache': name}, cache.hits
+        yield 'cdr_id_cache_misses_total', {'cache': name}, cache.misses
+        yield 'cdr_id_cache_size', {'cache': name}, len(cache)
@@ -0,0 +1,289 @@
+"""Patient cohorts by diagnosis, as set algebra over per code bitmaps
+
+Every MRN is assigned a dense integer id (PatientIndex), and every ICD-9
+or ICD-10 code observed holds the set of patients having it as a bitmap
+(CodeCohort).  Ingest appends a CohortDelta per code a patient gains or
+loses, applied to the bitmaps as read, until folded into them by
+`fold_cohorts`.
+
+Cohort expressions are JSON trees, with leaves of the form
+"<system>:<code>" (a trailing '*' matching by prefix) combined by single
+key objects of "and" or "or" (lists) or "not" (a single operand), e.g.::
+
+    {"and": [{"or": ["icd10:E11*", "icd10:E10*"]}, {"not": "icd10:I10"}]}
+
+Bitmaps are evaluated as python ints, whose bitwise operations run over
+machine words.
+
+"""
+from array import array
+from functools import reduce
+from itertools import islice
+import operator
+import sys
+
+
+from ..extensions import sdb
+from .filters import prefix_clause
+from .ingest import chunks, insert_ignoring_conflicts
+from .models import CODE_SYSTEMS, Code, CodeCohort, CohortDelta
+from .models import Observation, PatientIndex
+
+# Deltas folded per round trip, see `fold_cohorts`
+FOLD_BATCH_SIZE = 10000
+
+# Encoding tags, see `encode`
+BITMAP, ARRAY = b'B', b'A'
+
+
+class ExpressionException(Exception):
+    pass
+
+
+def popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+def members(bitmap, after=0):
+    """Generate the ids of set bits greater than `after`, ascending"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    first = after + 1
+    for i in range(first // 8, len(data)):
+        byte = data[i]
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte >> bit & 1 and i * 8 + bit >= first:
+                yield i * 8 + bit
+
+
+def from_ids(ids):
+    """Returns bitmap with the bits for the given ids set"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    data = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        data[id // 8] |= 1 << (id % 8)
+    return int.from_bytes(data, 'little')
+
+
+def encode(bitmap):
+    """Serialize bitmap, as a sorted id array when that is smaller
+
+    Rare codes among many patients are sparse, where four bytes per id
+    beats a bit per patient.
+
+    """
+    length = (bitmap.bit_length() + 7) // 8
+    if popcount(bitmap) * 4 < length:
+        ids = array('I', members(bitmap))
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return ARRAY + ids.tobytes()
+    return BITMAP + bitmap.to_bytes(length, 'little')
+
+
+def decode(data):
+    """Inverse of `encode`, returns the bitmap"""
+    data = bytes(data)
+    if data[:1] == ARRAY:
+        ids = array('I')
+        ids.frombytes(data[1:])
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return from_ids(ids)
+    return int.from_bytes(data[1:], 'little')
+
+
+def evaluate(expression, leaf, universe):
+    """Evaluate cohort expression to a bitmap
+
+    :param expression: parsed JSON cohort expression, see module doc
+    :param leaf: function returning the bitmap for a leaf string
+    :param universe: bitmap of all patients, complement of "not"
+
+    """
+    if isinstance(expression, str):
+        return leaf(expression)
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise ExpressionException(
+            "expected leaf string or single key object: {}".format(
+                expression))
+
+    op, operand = next(iter(expression.items()))
+    if op == 'not':
+        return universe & ~evaluate(operand, leaf, universe)
+    if op not in ('and', 'or'):
+        raise ExpressionException("unsupported operator: {}".format(op))
+    if not isinstance(operand, list) or not operand:
+        raise ExpressionException("'{}' requires a list".format(op))
+    results = (evaluate(o, leaf, universe) for o in operand)
+    return reduce(operator.and_ if op == 'and' else operator.or_, results)
+
+
+def apply_delta(bitmap, patient_id, present):
+    bit = 1 << patient_id
+    return bitmap | bit if present else bitmap & ~bit
+
+
+def leaf_bitmap(leaf):
+    """Returns the bitmap of patients for a "<system>:<code>" leaf"""
+    system, _, code = leaf.partition(':')
+    if system not in CODE_SYSTEMS or not code:
+        raise ExpressionException("unsupported leaf: {}".format(leaf))
+
+    code_ids = sdb.session.query(Code.id).filter(
+        Code.code_system == CODE_SYSTEMS[system])
+    if code.endswith('*'):
+        code_ids = code_ids.filter(prefix_clause(Code.code, code[:-1]))
+    else:
+        code_ids = code_ids.filter(Code.code == code)
+    code_ids = code_ids.subquery()
+
+    bitmaps = {
+        code_id: decode(bitmap) for code_id, bitmap in sdb.session.query(
+            CodeCohort.code_id, CodeCohort.bitmap).filter(
+            CodeCohort.code_id.in_(code_ids))}
+    deltas = sdb.session.query(
+        CohortDelta.code_id, CohortDelta.patient_id,
+        CohortDelta.present).filter(
+        CohortDelta.code_id.in_(code_ids)).order_by(CohortDelta.id)
+    for code_id, patient_id, present in deltas:
+        bitmaps[code_id] = apply_delta(
+            bitmaps.get(code_id, 0), patient_id, present)
+    return reduce(operator.or_, bitmaps.values(), 0)
+
+
+def universe():
+    """Returns bitmap of all indexed patients
+
+    Built from the ids present, as sequences leave gaps where inserts
+    roll back.
+
+    """
+    return from_ids(id for id, in sdb.session.query(PatientIndex.id))
+
+
+def cohort(expression):
+    """Evaluate cohort expression against the stored bitmaps"""
+    leaves = {}
+
+    def cached_leaf(leaf):
+        if leaf not in leaves:
+            leaves[leaf] = leaf_bitmap(leaf)
+        return leaves[leaf]
+
+    return evaluate(expression, cached_leaf, universe())
+
+
+def page(bitmap, after=0, limit=1000):
+    """Returns (MRNs, next cursor) for up to limit patients past `after`
+
+    The cursor is the PatientIndex id of the last patient included, None
+    when no more remain.
+
+    """
+    ids = list(islice(members(bitmap, after), limit + 1))
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = ids[-1]
+    mrns = dict(sdb.session.query(PatientIndex.id, PatientIndex.mrn).filter(
+        PatientIndex.id.in_(ids))) if ids else {}
+    # skip bits no longer addressing an indexed patient
+    return [mrns[id] for id in ids if id in mrns], next_cursor
+
+
+def patient_id(mrn):
+    """Returns the dense PatientIndex id for mrn, assigning if new"""
+    id = sdb.session.query(PatientIndex.id).filter_by(mrn=mrn).scalar()
+    if id is None:
+        insert_ignoring_conflicts(PatientIndex.__table__, [dict(mrn=mrn)])
+        id = sdb.session.query(PatientIndex.id).filter_by(mrn=mrn).scalar()
+    return id
+
+
+def diagnosis_code_ids(mrn):
+    """Returns set of icd9 and icd10 code ids observed for mrn"""
+    rows = sdb.session.query(
+        Observation.icd9_id, Observation.icd10_id).filter_by(doc_id=mrn)
+    return {id for row in rows for id in row if id}
+
+
+def update_cohorts(mrn, added, removed):
+    """Record the patient gaining `added` code ids, losing `removed`
+
+    Appends a CohortDelta per code rather than rewriting its bitmap, so
+    concurrent uploads sharing common codes neither lock nor rewrite
+    bitmaps sized to the whole population.
+
+    """
+    # index every patient, even those w/o diagnoses, for use in "not"
+    id = patient_id(mrn)
+    if not added and not removed:
+        return
+
+    sdb.session.execute(CohortDelta.__table__.insert(), [
+        dict(code_id=code_id, patient_id=id, present=code_id in added)
+        for code_id in sorted(added | removed)])
+
+
+def fold_cohorts(batch_size=FOLD_BATCH_SIZE):
+    """Fold pending deltas into the cohort bitmaps, returns number folded
+
+    Run periodically, see `flask rebuild-cohorts --fold`.  Deltas are
+    removed by id as folded, so those committed meanwhile remain for the
+    next run.  Caller is responsible for committing.
+
+    """
+    folded, last_id = 0, 0
+    while True:
+        deltas = sdb.session.query(
+            CohortDelta.id, CohortDelta.code_id, CohortDelta.patient_id,
+            CohortDelta.present).filter(CohortDelta.id > last_id).order_by(
+            CohortDelta.id).limit(batch_size).all()
+        if not deltas:
+            return folded
+
+        cohorts = {}
+        for chunk in chunks({delta.code_id for delta in deltas}):
+            cohorts.update((c.code_id, c) for c in CodeCohort.query.filter(
+                CodeCohort.code_id.in_(chunk)))
+        bitmaps = {
+            code_id: decode(cohort.bitmap)
+            for code_id, cohort in cohorts.items()}
+        for delta in deltas:
+            bitmaps[delta.code_id] = apply_delta(
+                bitmaps.get(delta.code_id, 0), delta.patient_id,
+                delta.present)
+        for code_id, bitmap in bitmaps.items():
+            if code_id not in cohorts:
+                cohorts[code_id] = CodeCohort(code_id=code_id)
+                sdb.session.add(cohorts[code_id])
+            cohorts[code_id].bitmap = encode(bitmap)
+
+        for chunk in chunks(delta.id for delta in deltas):
+            CohortDelta.query.filter(CohortDelta.id.in_(chunk)).delete(
+                synchronize_session=False)
+        folded += len(deltas)
+        last_id = deltas[-1].id
+
+
+def rebuild_cohorts():
+    """Regenerate all cohort bitmaps from the stored observations"""
+    CohortDelta.query.delete()
+    CodeCohort.query.delete()
+    bitmaps = {}
+    rows = sdb.session.query(
+        Observation.doc_id, Observation.icd9_id, Observation.icd10_id)
+    patients = {}
+    for mrn, icd9_id, icd10_id in rows:
+        if mrn not in patients:
+            patients[mrn] = 1 << patient_id(mrn)
+        for id in (icd9_id, icd10_id):
+            if id:
+                bitmaps[id] = bitmaps.get(id, 0) | patients[mrn]
+    for id, bitmap in bitmaps.items():
+        sdb.session.add(CodeCohort(code_id=id, bitmap=encode(bitmap)))
+    return len(bitmaps)
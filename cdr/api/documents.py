@@ -0,0 +1,86 @@
+"""Access to the CCDA documents referenced by clinical docs
+
+Documents are only served from within CCDA_ROOT, as each `filepath` is
+given by the uploading client.
+
+"""
+import mmap
+import os
+from urllib.parse import quote
+
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+def resolve(filepath):
+    """Returns the real path of filepath, relative to CCDA_ROOT
+
+    Raises LookupError if unconfigured, missing or outside CCDA_ROOT.
+
+    """
+    root = current_app.config.get('CCDA_ROOT')
+    if not root:
+        raise LookupError("CCDA_ROOT not configured")
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, filepath))
+    if os.path.commonpath((root, path)) != root:
+        raise LookupError("document outside CCDA_ROOT")
+    if not os.path.isfile(path):
+        raise LookupError("document not found")
+    return path
+
+
+def accel_location(path):
+    """Returns the X-Accel-Redirect location of path, see CCDA_ACCEL_REDIRECT
+
+    The internal location is expected to alias CCDA_ROOT.
+
+    """
+    root = os.path.realpath(current_app.config['CCDA_ROOT'])
+    return current_app.config['CCDA_ACCEL_REDIRECT'].rstrip('/') + '/' + quote(
+        os.path.relpath(path, root))
+
+
+class MappedFile(object):
+    """Seekable iterable of a memory mapped file
+
+    Range requests seek straight to their offset, and partial reads
+    slice the mapping, sharing the page cache across workers rather than
+    copying the file through read buffers.
+
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        with open(path, 'rb') as document:
+            self.map = mmap.mmap(
+                document.fileno(), 0, access=mmap.ACCESS_READ)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        end = len(self.map) if size < 0 else self.pos + size
+        data = self.map[self.pos:end]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            raise StopIteration()
+        return chunk
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,247 @@
+"""Problem list filters
+
+The `filter` query parameter is a url-encoded JSON string of the form::
+
+    {"filter": {<field>: {<subfield>: [<pattern>, ...]}},
+     "status": {<code|value>: {<subfield>: <value>}}}
+
+An observation passes if any pattern matches (a trailing '*' matches by
+prefix), and when "status" is given, its status matches every subfield.
+
+`compile_filter` flattens the spec into a memoized `CompiledFilter`,
+which evaluates serialized observations or, via `filter_clause`, yields a
+SQL WHERE clause over Observation so only matching rows leave the
+database.  `filter_func` evaluates the spec directly, and remains as the
+reference implementation.
+
+"""
+import json
+import sys
+from sqlalchemy import and_, false, or_
+
+from ..extensions import sdb
+from .cache import LRUCache
+from .models import Code, Observation, Status
+
+# Compiled filters, keyed by the raw filter parameter string
+compiled_filters = LRUCache(maxsize=256)
+
+# Observation relationships to Code, available as filter fields
+CODE_FIELDS = {
+    'code': Observation.code,
+    'icd9': Observation.icd9,
+    'icd10': Observation.icd10,
+}
+
+# Status relationships to Code, available in status requirements
+STATUS_FIELDS = {
+    'code': Status.code,
+    'value': Status.value,
+}
+
+CODE_SUBFIELDS = {
+    'code': Code.code,
+    'code_system': Code.code_system,
+    'code_system_name': Code.code_system_name,
+    'display': Code.display,
+}
+
+
+def filter_func(filter_parameters):
+    """Generator, returns a function based on value of filter_parameters
+
+    Filter parameters expected to be url-encoded JSON string (if
+    defined)  It defines the list of parameters to search on.
+
+    """
+
+    def field_match(subfield, patterns, contents):
+        """Returns true if contents match field_rule parameters"""
+        if subfield not in contents:
+            return False
+
+        for pattern in patterns:
+            if pattern.endswith('*'):
+                if contents[subfield].startswith(pattern[:-1]):
+                    return True
+            elif contents[subfield] == pattern:
+                return True
+        return False
+
+    def status_match(status_rule, contents):
+        for key in status_rule:
+            match_dict = status_rule[key]
+            for field in match_dict:
+                if match_dict[field] != contents[key][field]:
+                    return False
+        return True
+
+    if not filter_parameters:
+        """Without filter parameters, everything passes the filter """
+        return lambda x: True
+
+    params = json.loads(filter_parameters)
+    filter_by = params['filter']
+    require_status = params.get('status')
+
+    def filter_observation(observation):
+        """All params treated as 'or' - return true as soon as one hits"""
+        for field in filter_by:
+            if field in observation:
+                for subfield, patterns in filter_by[field].items():
+                    if field_match(subfield, patterns, observation[field]):
+                        # Found a matching field, confirm status if required
+                        if require_status:
+                            return status_match(
+                                require_status, observation['status'])
+                        else:
+                            return True
+        # Never matched, filter out
+        return False
+
+    return filter_observation
+
+
+def prefix_clause(column, prefix):
+    """Returns clause matching column values starting with prefix
+
+    LIKE, as on PostgreSQL it uses the varchar_pattern_ops indices and
+    matches exactly whatever the collation.  SQLite's LIKE ignores case,
+    so there the prefix is compared as the range `prefix <= column <
+    upper bound`, exact under its binary collation, for the semantics of
+    str.startswith().
+
+    """
+    if sdb.engine.dialect.name != 'sqlite':
+        # a literal pattern, rather than one concatenated in SQL
+        pattern = prefix.replace('/', '//').replace('%', '/%').replace(
+            '_', '/_')
+        return column.like(pattern + '%', escape='/')
+    # the upper bound increments the last character that can be
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return column >= prefix
+    upper = stem[:-1] + chr(ord(stem[-1]) + 1)
+    return and_(column >= prefix, column < upper)
+
+
+class CompiledFilter(object):
+    """Filter spec flattened into precomputed lookup structures
+
+    Each (field, subfield) pair holds a set of exact patterns and a sorted
+    tuple of prefixes, so evaluation is a set lookup plus a single
+    `str.startswith()` call rather than a scan of the patterns.
+
+    """
+
+    def __init__(self, patterns, status):
+        # tuple of (field, subfield, exact frozenset, prefixes tuple)
+        self.patterns = patterns
+        # tuple of (status key, subfield, value) requirements
+        self.status = status
+        self._clause = None
+
+    @classmethod
+    def from_json(cls, params):
+        patterns = []
+        for field, subfields in params['filter'].items():
+            for subfield, values in subfields.items():
+                exact = frozenset(p for p in values if not p.endswith('*'))
+                prefixes = tuple(sorted(
+                    p[:-1] for p in values if p.endswith('*')))
+                patterns.append((field, subfield, exact, prefixes))
+        status = tuple(
+            (key, field, value)
+            for key, match_dict in (params.get('status') or {}).items()
+            for field, value in match_dict.items())
+        return cls(patterns=tuple(patterns), status=status)
+
+    def status_match(self, status):
+        for key, field, value in self.status:
+            if status.get(key, {}).get(field) != value:
+                return False
+        return True
+
+    def matches(self, observation):
+        """Evaluate against serialized observation, as does `filter_func`"""
+        for field, subfield, exact, prefixes in self.patterns:
+            contents = observation.get(field)
+            if not isinstance(contents, dict) or subfield not in contents:
+                continue
+            value = contents[subfield]
+            if value in exact or value.startswith(prefixes):
+                if self.status:
+                    return self.status_match(observation['status'])
+                return True
+        return False
+
+    @staticmethod
+    def pattern_clause(column, exact, prefixes):
+        """Returns clause matching column to exact values or prefixes"""
+        clauses = []
+        if exact:
+            clauses.append(column.in_(sorted(exact)))
+        for prefix in prefixes:
+            clauses.append(prefix_clause(column, prefix))
+        return or_(*clauses) if clauses else false()
+
+    def status_clause(self):
+        """Returns clause requiring the observation status match all fields"""
+        by_key = {}
+        for key, field, value in self.status:
+            if key not in STATUS_FIELDS or field not in CODE_SUBFIELDS:
+                return false()
+            by_key.setdefault(key, []).append(CODE_SUBFIELDS[field] == value)
+        return Observation.status.has(and_(*(
+            STATUS_FIELDS[key].has(and_(*columns))
+            for key, columns in by_key.items())))
+
+    def clause(self):
+        """Returns SQL clause over Observation, mirroring `matches()`"""
+        if self._clause is not None:
+            return self._clause
+
+        matches = []
+        for field, subfield, exact, prefixes in self.patterns:
+            if field in CODE_FIELDS and subfield in CODE_SUBFIELDS:
+                matches.append(CODE_FIELDS[field].has(self.pattern_clause(
+                    CODE_SUBFIELDS[subfield], exact, prefixes)))
+            elif field == 'status' and subfield == 'status_code':
+                matches.append(Observation.status.has(self.pattern_clause(
+                    Status.status_code, exact, prefixes)))
+
+        clause = or_(*matches) if matches else false()
+        if self.status:
+            clause = and_(clause, self.status_clause())
+        self._clause = clause
+        return clause
+
+
+def compile_filter(filter_parameters):
+    """Returns CompiledFilter for filter_parameters, or None if empty
+
+    Compiled filters are memoized by the raw parameter string, the
+    dashboard sending the same handful of filters over and over.
+
+    """
+    if not filter_parameters:
+        return None
+
+    compiled = compiled_filters.get(filter_parameters)
+    if compiled is None:
+        compiled = CompiledFilter.from_json(json.loads(filter_parameters))
+        compiled_filters.set(filter_parameters, compiled)
+    return compiled
+
+
+def filter_clause(filter_parameters):
+    """Compile filter_parameters into a SQL clause over Observation
+
+    Mirrors `filter_func`.  Returns None in the absence of filter
+    parameters, as everything passes the filter.
+
+    """
+    compiled = compile_filter(filter_parameters)
+    if compiled is None:
+        return None
+    return compiled.clause()
@@ -0,0 +1,577 @@
+"""Set based ingest of Mirth problem lists
+
+Resolving each Code and Status through its own `save()` costs several
+round trips per code.  Instead, walk the whole problem list first,
+gathering every distinct code and status, resolve each table with one
+bulk lookup plus one conflict ignoring insert, and finally insert all the
+Observation rows in a single statement.
+
+"""
+from collections import namedtuple
+from flask import current_app
+import hashlib
+import json
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .. import instrument, metrics
+from ..extensions import sdb
+from ..time_util import datetime_w_tz, parse_datetime, utc_now
+from . import archive, cache
+from .models import ChangeLog, ClinicalDoc, Code, Observation
+from .models import ParseException, Status
+from .models import parse_effective_time, parse_problem_list
+
+# Keep IN lists and multi-row VALUES below SQLite's bound parameter limit
+CHUNK_SIZE = 200
+
+# Parsed observation, prior to resolution of any database ids.  Codes are
+# referenced by their (code, code_system) key, the status by its
+# (status_code, code key, value key) tuple.
+Problem = namedtuple(
+    'Problem', ('code', 'icd9', 'icd10', 'status', 'onset_date', 'entry_date'))
+
+
+def chunks(sequence, size=CHUNK_SIZE):
+    """Generate lists of up to size items, bounding IN lists"""
+    sequence = list(sequence)
+    for i in range(0, len(sequence), size):
+        yield sequence[i:i + size]
+
+
+class ProblemList(object):
+    """Problem list reduced to its header and the Problems collected
+
+    As read from a stream by `stream.read_upload`, in place of the whole
+    decoded document.  Subscripting reaches the header, i.e. everything
+    but the section's entries.
+
+    """
+    __slots__ = ('header', 'codes', 'problems', 'content_hash')
+
+    def __init__(self, header, codes, problems, content_hash):
+        self.header = header
+        self.codes = codes
+        self.problems = problems
+        self.content_hash = content_hash
+
+    def __getitem__(self, key):
+        return self.header[key]
+
+    def __bool__(self):
+        # false for an empty object, as the decoded dict would be
+        return bool(self.header)
+
+
+def entry_observation(entry):
+    """Returns the observation json of a problem list entry"""
+    return entry['act']['_']['entryRelationship']['_']['observation']['_']
+
+
+def observation_entries(problem_list):
+    """Generate the observation json for each entry in the problem list"""
+    entries = problem_list['section']['entry']
+    if isinstance(entries, dict):
+        # When there's a single entry, only the act key comes through
+        entries = [entries]
+    for entry in entries:
+        yield entry_observation(entry)
+
+
+def code_key(json, codes):
+    """Register code json in the `codes` dict, return its unique key"""
+    key = (json['_code'], json['_codeSystem'])
+    if key not in codes:
+        codes[key] = {
+            'code': json['_code'], 'code_system': json['_codeSystem'],
+            'code_system_name': json['_codeSystemName'],
+            'display': json['_displayName']}
+    return key
+
+
+def collect_problem(observation_json, codes):
+    """Parse observation json into a Problem, registering codes found
+
+    Mirrors `parse_observation` without touching the database.  Returns
+    None for observations lacking a status.
+
+    """
+    try:
+        code = code_key(observation_json['value'], codes)
+    except KeyError:
+        code = None  # we don't always get a meaningful code, just translations
+
+    try:
+        onset_date = parse_effective_time(observation_json['effectiveTime'])
+    except KeyError:
+        onset_date = None  # occasionally the effectiveTime is missing
+
+    entry_date = parse_datetime(observation_json['author']['time']['_value'])
+    icd9, icd10 = None, None
+    if 'translation' in observation_json['value']['_']:
+        translation = observation_json['value']['_']['translation']
+        if isinstance(translation, dict):
+            translation = [translation]
+        for t in translation:
+            if t['_codeSystemName'].startswith('ICD-9'):
+                assert icd9 is None
+                icd9 = code_key(t, codes)
+            if t['_codeSystemName'].startswith('ICD-10'):
+                assert icd10 is None
+                icd10 = code_key(t, codes)
+
+    if 'entryRelationship' not in observation_json:
+        return None
+
+    # occasionally we get multiple status entries - preserve only the last
+    relationship = observation_json['entryRelationship']
+    if isinstance(relationship, list):
+        relationship = relationship[-1]
+    s_json = relationship['_']['observation']['_']
+    status = (
+        s_json['statusCode']['_code'],
+        code_key(s_json['code'], codes) if 'code' in s_json else None,
+        code_key(s_json['value'], codes) if 'value' in s_json else None)
+    return Problem(
+        code=code, icd9=icd9, icd10=icd10, status=status,
+        onset_date=onset_date, entry_date=entry_date)
+
+
+def collect_problems(problem_list):
+    """Walk the full problem list, returns (codes, problems)
+
+    `codes` maps each distinct (code, code_system) to its column values,
+    `problems` is the list of Problems parsed.
+
+    """
+    if isinstance(problem_list, ProblemList):
+        return problem_list.codes, problem_list.problems
+
+    codes, problems = {}, []
+    for observation_json in observation_entries(problem_list):
+        problem = collect_problem(observation_json, codes)
+        if problem:
+            problems.append(problem)
+    return codes, problems
+
+
+def insert_ignoring_conflicts(table, rows, returning=()):
+    """Insert rows, skipping any that violate a unique constraint
+
+    Returns the `returning` columns for the rows inserted where the
+    dialect supports it, otherwise an empty list.
+
+    """
+    dialect = sdb.engine.dialect.name
+    inserted = []
+    for chunk in chunks(rows):
+        if dialect == 'postgresql':
+            stmt = pg_insert(table).values(chunk).on_conflict_do_nothing()
+            if returning:
+                inserted.extend(sdb.session.execute(
+                    stmt.returning(*returning)).fetchall())
+            else:
+                sdb.session.execute(stmt)
+            continue
+        stmt = table.insert()
+        if dialect == 'sqlite':
+            stmt = stmt.prefix_with('OR IGNORE')
+        sdb.session.execute(stmt, chunk)
+    return inserted
+
+
+def _lookup_codes(keys):
+    found = {}
+    wanted = set(keys)
+    for chunk in chunks({k[0] for k in wanted}):
+        query = sdb.session.query(
+            Code.id, Code.code, Code.code_system).filter(Code.code.in_(chunk))
+        for id, code, code_system in query:
+            if (code, code_system) in wanted:
+                found[(code, code_system)] = id
+    return found
+
+
+def resolve_codes(codes):
+    """Returns dict of (code, code_system) -> id, adding any missing codes
+
+    Ids are served from the process wide `cache.code_ids` where possible,
+    only misses reach the database.
+
+    """
+    ids = {}
+    for key in codes:
+        id = cache.code_ids.lookup(key)
+        if id is not None:
+            ids[key] = id
+    missing = [key for key in codes if key not in ids]
+    if not missing:
+        return ids
+
+    found = _lookup_codes(missing)
+    missing = [key for key in missing if key not in found]
+    if missing:
+        inserted = insert_ignoring_conflicts(
+            Code.__table__, [codes[key] for key in missing],
+            returning=(Code.id, Code.code, Code.code_system))
+        for id, code, code_system in inserted:
+            found[(code, code_system)] = id
+        remaining = [key for key in missing if key not in found]
+        if remaining:
+            found.update(_lookup_codes(remaining))
+
+    for key, id in found.items():
+        cache.code_ids.remember(key, id)
+    ids.update(found)
+    return ids
+
+
+def _status_values(key, code_ids):
+    """Map status key of code keys to (status_code, code_id, value_id)"""
+    status_code, code, value = key
+    return (
+        status_code,
+        code_ids[code] if code else None,
+        code_ids[value] if value else None)
+
+
+def _lookup_statuses(values):
+    found = {}
+    wanted = set(values)
+    for chunk in chunks({v[1] for v in wanted}):
+        query = sdb.session.query(
+            Status.id, Status.status_code, Status.code_id,
+            Status.value_id).filter(Status.code_id.in_(chunk))
+        for id, status_code, code_id, value_id in query:
+            if (status_code, code_id, value_id) in wanted:
+                found[(status_code, code_id, value_id)] = id
+    return found
+
+
+def resolve_statuses(values):
+    """Returns dict of (status_code, code_id, value_id) -> id
+
+    Adds any missing statuses; served from `cache.status_ids` where
+    possible.
+
+    """
+    ids = {}
+    for value in values:
+        id = cache.status_ids.lookup(value)
+        if id is not None:
+            ids[value] = id
+    missing = {value for value in values if value not in ids}
+    if not missing:
+        return ids
+
+    found = _lookup_statuses(missing)
+    missing = [value for value in missing if value not in found]
+    if missing:
+        inserted = insert_ignoring_conflicts(
+            Status.__table__,
+            [dict(status_code=s, code_id=c, value_id=v)
+             for s, c, v in missing],
+            returning=(
+                Status.id, Status.status_code, Status.code_id,
+                Status.value_id))
+        for id, status_code, code_id, value_id in inserted:
+            found[(status_code, code_id, value_id)] = id
+        remaining = [value for value in missing if value not in found]
+        if remaining:
+            found.update(_lookup_statuses(remaining))
+        if any(value not in found for value in missing):
+            raise ParseException(
+                "status conflicts with existing code/value pair")
+
+    for value, id in found.items():
+        cache.status_ids.remember(value, id)
+    ids.update(found)
+    return ids
+
+
+def fingerprint(row):
+    """Stable identity of an observation row, for diffing problem lists"""
+    return (
+        row['code_id'], row['icd9_id'], row['icd10_id'], row['status_id'],
+        datetime_w_tz(row['onset_date']), datetime_w_tz(row['entry_date']))
+
+
+def reconcile(mrn, rows):
+    """Replace observations for mrn with rows, touching only the changes
+
+    Successive documents for a patient are largely identical, so rather
+    than deleting everything and reinserting, diff the fingerprints of
+    existing and new rows.  Returns (rows to insert, ids to delete).
+
+    """
+    table = Observation.__table__
+    existing = {}
+    for row in sdb.session.execute(select([
+            table.c.id, table.c.code_id, table.c.icd9_id, table.c.icd10_id,
+            table.c.status_id, table.c.onset_date, table.c.entry_date]).where(
+            table.c.doc_id == mrn)):
+        existing.setdefault(fingerprint(row), []).append(row['id'])
+
+    inserts = []
+    for row in rows:
+        matches = existing.get(fingerprint(row))
+        if matches:
+            matches.pop()
+        else:
+            inserts.append(row)
+    deletes = [id for ids in existing.values() for id in ids]
+    return inserts, deletes
+
+
+def ingest_problem_list(problem_list, mrn, replace=False):
+    """Persist observations for the problem list with set based queries
+
+    If `replace` is set, existing observations for `mrn` not found in the
+    problem list are deleted, and only new observations inserted.
+
+    Returns the list of observation rows (dicts of column values) parsed
+    for `mrn`.
+
+    """
+    # pending ORM state (i.e. the clinical doc) must precede core inserts
+    sdb.session.flush()
+
+    codes, problems = collect_problems(problem_list)
+    code_ids = resolve_codes(codes)
+    status_values = {
+        problem.status: _status_values(problem.status, code_ids)
+        for problem in problems}
+    status_ids = resolve_statuses(set(status_values.values()))
+
+    rows = [dict(
+        doc_id=mrn,
+        code_id=code_ids[p.code] if p.code else None,
+        icd9_id=code_ids[p.icd9] if p.icd9 else None,
+        icd10_id=code_ids[p.icd10] if p.icd10 else None,
+        status_id=status_ids[status_values[p.status]],
+        onset_date=p.onset_date, entry_date=p.entry_date)
+        for p in problems]
+
+    inserts = rows
+    if replace:
+        inserts, deletes = reconcile(mrn, rows)
+        current_app.logger.info(
+            "replacing problems for %s: %d kept, %d deleted, %d new",
+            mrn, len(rows) - len(inserts), len(deletes), len(inserts))
+        for chunk in chunks(deletes):
+            sdb.session.execute(Observation.__table__.delete().where(
+                Observation.id.in_(chunk)))
+
+    for chunk in chunks(inserts):
+        sdb.session.execute(Observation.__table__.insert(), chunk)
+    return rows
+
+
+def canonical_json(value):
+    """Key order and whitespace independent JSON serialization"""
+    return json.dumps(
+        value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def content_hash(problem_list):
+    """Canonical SHA-256 hex digest of the problem list
+
+    The entries are digested one at a time, and combined with the rest
+    of the document (the header), so the hash may also be computed
+    incrementally as entries stream by.
+
+    """
+    if isinstance(problem_list, ProblemList):
+        return problem_list.content_hash
+    if not problem_list:
+        return hashlib.sha256(canonical_json(problem_list)).hexdigest()
+
+    header = dict(problem_list)
+    header['section'] = {
+        k: v for k, v in problem_list['section'].items() if k != 'entry'}
+    entries = problem_list['section'].get('entry', [])
+    if isinstance(entries, dict):
+        entries = [entries]
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest_entry(digest, entry)
+    return combined_hash(header, digest)
+
+
+def digest_entry(digest, entry):
+    """Add entry to the running digest of a problem list's entries"""
+    digest.update(canonical_json(entry))
+    digest.update(b'\n')
+
+
+def combined_hash(header, digest):
+    """Returns content hash from the header and digest of its entries"""
+    return hashlib.sha256(
+        canonical_json(header) + digest.digest()).hexdigest()
+
+
+metrics.describe(
+    'cdr_uploads_total', 'counter',
+    'Uploaded documents by result: upload ok, obsolete or unchanged')
+
+
+def count_upload(message):
+    """Count an ingested document by result, once committed"""
+    metrics.inc('cdr_uploads_total', result=message)
+
+
+def ingest_document(mrn, data, archive_key=None):
+    """Persist the CCDA data for given MRN unless a newer one exists
+
+    :param data: dict with 'filepath', 'effectiveTime' and optionally
+      'receipt_time' and the Mirth 'problem_list'
+    :param archive_key: key of the archived payload, see `archive`
+
+    Returns 'obsolete' if a newer document is already present, else
+    'unchanged' if the problem list matches that already stored (only
+    the document's times, filepath and archive key are updated), otherwise
+    'upload ok'.  Each outcome is written to the `ChangeLog`.  Caller is
+    responsible for committing, then `count_upload()`.
+
+    """
+    existed = ClinicalDoc.query.get(mrn) is not None
+    message = _ingest_document(mrn, data, archive_key)
+    if message == 'upload ok':
+        action = 'replaced' if existed else 'inserted'
+    else:
+        action = message
+    sdb.session.add(ChangeLog(
+        mrn=mrn, action=action, generation_time=data.get('effectiveTime'),
+        receipt_time=data.get('receipt_time') or utc_now()))
+    return message
+
+
+def _ingest_document(mrn, data, archive_key):
+    # Check for existing record for this MRN
+    replace = False
+    doc = ClinicalDoc.query.get(mrn)
+    if doc:
+        replace = True
+
+    digest = content_hash(data.get('problem_list'))
+    effective_time = parse_datetime(data.get('effectiveTime'))
+    if doc and effective_time is not None and (
+            datetime_w_tz(doc.generation_time) >= effective_time):
+        if doc.content_hash == digest and (
+                datetime_w_tz(doc.generation_time) == effective_time):
+            current_app.logger.info(
+                "identical data for MRN %s already present", mrn)
+            return 'unchanged'
+        current_app.logger.info(
+            "found better data for MRN %s already present", mrn)
+        return 'obsolete'
+
+    if doc is None:
+        doc = ClinicalDoc(mrn=mrn, filepath=data['filepath'])
+    else:
+        doc.filepath = data.get('filepath', doc.filepath)
+    if effective_time is not None:
+        doc.generation_time = effective_time
+    if 'receipt_time' in data:
+        doc.receipt_time = parse_datetime(data['receipt_time'])
+
+    if replace and doc.content_hash == digest:
+        # a newer document with the same problem list, observations stand
+        current_app.logger.info(
+            "identical data for MRN %s already present", mrn)
+        if archive_key:
+            doc.archive_key = archive_key
+        return 'unchanged'
+
+    doc.content_hash = digest
+    doc.archive_key = archive_key
+
+    doc.save()
+    with instrument.timer('parse'):
+        parse_problem_list(
+            data.get('problem_list'), clinical_doc=doc, replace=replace)
+    return 'upload ok'
+
+
+def archive_referenced(mrn, archive_key):
+    """True if the clinical doc of mrn references the archived payload
+
+    Payloads are only archived while referenced, see `archive`.
+
+    """
+    doc = ClinicalDoc.query.get(mrn)
+    return doc is not None and doc.archive_key == archive_key
+
+
+def _ingest_group(group):
+    """Ingest and commit group of (line, mrn, data, payload) records
+
+    A failing record is rolled back along with the rest of the
+    transaction, so the remainder of the group is replayed without it.
+    Uploads are counted and archived once committed.  Returns dict of
+    result by line number.
+
+    """
+    results = {}
+    remaining = list(group)
+    archiving = archive.enabled()
+    while remaining:
+        applied, failed = [], None
+        for line, mrn, data, payload in remaining:
+            try:
+                archive_key = archive.key_for(payload) if archiving else None
+                applied.append((line, mrn, ingest_document(
+                    mrn, data, archive_key=archive_key)))
+            except Exception as e:
+                current_app.logger.warning(
+                    "bulk upload of line %d for %s failed: %r", line, mrn, e)
+                failed = line
+                results[line] = dict(line=line, mrn=mrn, error=repr(e))
+                break
+        if failed is None:
+            referenced = [
+                payload for line, mrn, data, payload in remaining
+                if archiving and archive_referenced(
+                    mrn, archive.key_for(payload))]
+            sdb.session.commit()
+            # once committed, so replays and rollbacks leave no trace
+            for payload in referenced:
+                archive.store(payload)
+            for line, mrn, message in applied:
+                count_upload(message)
+                results[line] = dict(line=line, mrn=mrn, message=message)
+            return results
+        sdb.session.rollback()
+        remaining = [r for r in remaining if r[0] != failed]
+    return results
+
+
+def ingest_ndjson(lines, group_size):
+    """Ingest a newline delimited JSON stream of CCDAs
+
+    Each line holds a JSON object of 'mrn' plus the data expected by
+    `ingest_document`.  Lines are consumed incrementally, committing
+    every `group_size` records.  Generates a result dict per line, in
+    order.  When enabled, each line is archived as its own payload.
+
+    """
+    group, results = [], {}
+    for line, raw in enumerate(lines, 1):
+        if not raw.strip():
+            continue
+        try:
+            data = json.loads(raw)
+            mrn = data['mrn']
+        except (ValueError, KeyError, TypeError) as e:
+            results[line] = dict(line=line, error=repr(e))
+            continue
+        group.append((line, mrn, data, raw.strip()))
+        if len(group) >= group_size:
+            results.update(_ingest_group(group))
+            group = []
+            for line in sorted(results):
+                yield results[line]
+            results = {}
+    results.update(_ingest_group(group))
+    for line in sorted(results):
+        yield results[line]
@@ -1,9 +1,19 @@
 from flask import current_app
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import joinedload
 
 from ..extensions import sdb
-from ..time_util import datetime_w_tz, parse_datetime, utc_now
+from ..time_util import datetime_w_tz, isoformat_w_tz, parse_datetime
+from ..time_util import utc_now
+
+
+# OIDs of the supported diagnosis code systems
+CODE_SYSTEMS = {
+    'icd9': '2.16.840.1.113883.6.103',
+    'icd10': '2.16.840.1.113883.6.90',
+}
 
 
 class ClinicalDoc(sdb.Model):
@@ -17,6 +27,17 @@ class ClinicalDoc(sdb.Model):
         "generation_time", sdb.DateTime(timezone=True))
     _lastvisit_time = sdb.Column(sdb.DateTime(timezone=True))
     filepath = sdb.Column(sdb.VARCHAR(length=512), nullable=False)
+    # see `ingest.content_hash`
+    content_hash = sdb.Column(sdb.String(64))
+    # sha256 of the accepted upload, see `archive`
+    archive_key = sdb.Column(sdb.String(64))
+    # last change to the observations, set by `parse_problem_list`
+    _modified_time = sdb.Column(
+        "modified_time", sdb.DateTime(timezone=True))
+    # serialized observations, materialized by `parse_problem_list`
+    problem_list_snapshot = sdb.Column(
+        sdb.JSON(none_as_null=True).with_variant(
+            JSONB(none_as_null=True), 'postgresql'))
 
     @hybrid_property
     def generation_time(self):
@@ -34,6 +55,14 @@ class ClinicalDoc(sdb.Model):
     def lastvisit_time(self, value):
         self._lastvisit_time = parse_datetime(value)
 
+    @hybrid_property
+    def modified_time(self):
+        return datetime_w_tz(self._modified_time)
+
+    @modified_time.setter
+    def modified_time(self, value):
+        self._modified_time = parse_datetime(value)
+
     @hybrid_property
     def receipt_time(self):
         return datetime_w_tz(self._receipt_time)
@@ -42,6 +71,11 @@ class ClinicalDoc(sdb.Model):
     def receipt_time(self, value):
         self._receipt_time = parse_datetime(value)
 
+    def problem_list(self):
+        """Serialized observations, as presented by `get_problem_list`"""
+        return [obs.to_json() for obs in Observation.eager_query().filter_by(
+            doc_id=self.mrn).order_by(Observation.id)]
+
     def __str__(self):
         return u"<{0}: {1}@{2}>".format(
             self.__class__.__name__, self.mrn, self.filepath)
@@ -68,8 +102,15 @@ class Code(sdb.Model):
     code_system_name = sdb.Column(sdb.String(80), nullable=False)
     display = sdb.Column(sdb.Text, nullable=False)
 
-    __table_args__ = (UniqueConstraint(
-        'code', 'code_system', name='_code_code_system'),)
+    __table_args__ = (
+        UniqueConstraint('code', 'code_system', name='_code_code_system'),
+        # keyset pagination of codes by system, see views.codes_by_system
+        Index('ix_code_code_system_name_code', 'code_system_name', 'code'),
+        # prefix (LIKE 'E11%') lookups within a system
+        Index(
+            'ix_code_code_system_code_pattern', 'code_system', 'code',
+            postgresql_ops={'code': 'varchar_pattern_ops'}),
+    )
 
     @classmethod
     def from_json(cls, json):
@@ -83,15 +124,18 @@ class Code(sdb.Model):
                 'display': self.display}
 
     def save(self):
-        """Avoid duplicates - return existing or add new"""
-        existing = Code.query.filter_by(
+        """Avoid duplicates - return existing or add new
+
+        Resolved through the cached, conflict safe `ingest.resolve_codes`
+
+        """
+        from .ingest import resolve_codes
+
+        key = (self.code, self.code_system)
+        ids = resolve_codes({key: dict(
             code=self.code, code_system=self.code_system,
-            code_system_name=self.code_system_name)
-        if existing.count():
-            self = existing.one()
-        else:
-            sdb.session.add(self)
-        return sdb.session.merge(self)
+            code_system_name=self.code_system_name, display=self.display)})
+        return Code.query.get(ids[key])
 
 
 class Status(sdb.Model):
@@ -130,24 +174,16 @@ class Status(sdb.Model):
         return d
 
     def save(self):
-        """Avoid duplicates - return existing or add new"""
-
-        existing = Status.query.filter_by(
-            status_code=self.status_code)
-        if self.code_id:
-            existing = existing.filter_by(code_id=self.code_id)
-        else:
-            existing = existing.filter(Status.code_id.is_(None))
-        if self.value_id:
-            existing = existing.filter_by(value_id=self.value_id)
-        else:
-            existing = existing.filter(Status.value_id.is_(None))
-
-        if existing.count():
-            self = existing.one()
-        else:
-            sdb.session.add(self)
-        return sdb.session.merge(self)
+        """Avoid duplicates - return existing or add new
+
+        Resolved through the cached, conflict safe `ingest.resolve_statuses`
+
+        """
+        from .ingest import resolve_statuses
+
+        key = (self.status_code, self.code_id, self.value_id)
+        ids = resolve_statuses([key])
+        return Status.query.get(ids[key])
 
 
 class Observation(sdb.Model):
@@ -157,10 +193,10 @@ class Observation(sdb.Model):
     doc_id = sdb.Column(  # Previously labeled "owner"
         sdb.ForeignKey('clinical_doc.mrn'), index=True, nullable=False)
     code_id = sdb.Column(sdb.ForeignKey('code.id'))
-    icd9_id = sdb.Column(sdb.ForeignKey('code.id'), index=True)
-    icd10_id = sdb.Column(sdb.ForeignKey('code.id'), index=True)
-    _entry_date = sdb.DateTime(timezone=True)
-    _onset_date = sdb.DateTime(timezone=True)
+    icd9_id = sdb.Column(sdb.ForeignKey('code.id'))
+    icd10_id = sdb.Column(sdb.ForeignKey('code.id'))
+    _entry_date = sdb.Column("entry_date", sdb.DateTime(timezone=True))
+    _onset_date = sdb.Column("onset_date", sdb.DateTime(timezone=True))
     status_id = sdb.Column(sdb.ForeignKey('status.id'))
 
     code = sdb.relationship('Code', uselist=False, foreign_keys=[code_id])
@@ -168,6 +204,12 @@ class Observation(sdb.Model):
     icd10 = sdb.relationship('Code', uselist=False, foreign_keys=[icd10_id])
     status = sdb.relationship('Status')
 
+    # patients by diagnosis, in MRN order - see views.patients_w_icd9code
+    __table_args__ = (
+        Index('ix_observation_icd9_id_doc_id', 'icd9_id', 'doc_id'),
+        Index('ix_observation_icd10_id_doc_id', 'icd10_id', 'doc_id'),
+    )
+
     @hybrid_property
     def entry_date(self):
         return datetime_w_tz(self._entry_date)
@@ -184,11 +226,162 @@ class Observation(sdb.Model):
     def onset_date(self, value):
         self._onset_date = parse_datetime(value)
 
+    @classmethod
+    def eager_query(cls):
+        """Query loading all codes and the status w/ its codes in one go
+
+        Avoids the lazy load per relationship otherwise incurred by
+        `to_json()`
+
+        """
+        return cls.query.options(
+            joinedload(cls.code), joinedload(cls.icd9),
+            joinedload(cls.icd10),
+            joinedload(cls.status).joinedload(Status.code),
+            joinedload(cls.status).joinedload(Status.value))
+
+    def to_json(self):
+        d = {}
+        for e in (
+                'code', 'icd9', 'icd10', 'onset_date', 'entry_date',
+                'status'):
+            value = getattr(self, e)
+            if value:
+                if hasattr(value, 'isoformat'):
+                    d[e] = isoformat_w_tz(value)
+                else:
+                    d[e] = value.to_json()
+        return d
+
+
+class PatientIndex(sdb.Model):
+    """Dense integer id per MRN, addressing bits in cohort bitmaps"""
+    __tablename__ = 'patient_index'
+    id = sdb.Column(sdb.Integer, primary_key=True)
+    mrn = sdb.Column(sdb.VARCHAR(length=255), unique=True, nullable=False)
+
+
+class CodeCohort(sdb.Model):
+    """Patients with an observation of the code, as an encoded bitmap
+
+    See `cohort.encode` for the format; bits address PatientIndex ids
+
+    """
+    __tablename__ = 'code_cohort'
+    code_id = sdb.Column(sdb.ForeignKey('code.id'), primary_key=True)
+    bitmap = sdb.Column(sdb.LargeBinary, nullable=False)
+
+
+class CohortDelta(sdb.Model):
+    """Patient gaining (present) or losing a code, pending its bitmap
+
+    Appended by uploads in place of rewriting the CodeCohort bitmap, and
+    folded into it later, see `cohort.fold_cohorts`.
+
+    """
+    __tablename__ = 'cohort_delta'
+    id = sdb.Column(sdb.Integer, primary_key=True)
+    code_id = sdb.Column(sdb.ForeignKey('code.id'), nullable=False)
+    patient_id = sdb.Column(sdb.Integer, nullable=False)
+    present = sdb.Column(sdb.Boolean, nullable=False)
+
+    # pending deltas of the codes in a leaf, in order
+    __table_args__ = (Index('ix_cohort_delta_code_id_id', 'code_id', 'id'),)
+
+
+class IngestJob(sdb.Model):
+    """Upload accepted for asynchronous processing, see `queue`"""
+    __tablename__ = 'ingest_job'
+    id = sdb.Column(sdb.Integer, primary_key=True)
+    mrn = sdb.Column(sdb.VARCHAR(length=255), nullable=False)
+    payload = sdb.Column(sdb.Text, nullable=False)
+    state = sdb.Column(sdb.String(16), nullable=False, default='queued')
+    attempts = sdb.Column(sdb.Integer, nullable=False, default=0)
+    result = sdb.Column(sdb.Text)
+    enqueued_at = sdb.Column(
+        sdb.DateTime(timezone=True), default=utc_now, nullable=False)
+    started_at = sdb.Column(sdb.DateTime(timezone=True))
+    finished_at = sdb.Column(sdb.DateTime(timezone=True))
+    # retries back off, unclaimed until then
+    not_before = sdb.Column(sdb.DateTime(timezone=True))
+
+    # workers claim the oldest queued job, one per MRN at a time
+    __table_args__ = (
+        Index('ix_ingest_job_state_id', 'state', 'id'),
+        Index('ix_ingest_job_mrn_state', 'mrn', 'state'))
+
+    def to_json(self):
+        d = {'id': self.id, 'mrn': self.mrn, 'state': self.state,
+             'attempts': self.attempts}
+        if self.result is not None:
+            d['result'] = self.result
+        for e in ('enqueued_at', 'started_at', 'finished_at', 'not_before'):
+            if getattr(self, e):
+                d[e] = isoformat_w_tz(getattr(self, e))
+        return d
+
+
+class ChangeLog(sdb.Model):
+    """Outcome of an upload, in order received, for incremental sync
+
+    Written by `ingest.ingest_document`, and by `reparse` for problem
+    lists it changes; the id serves as cursor of the change feed.
+
+    """
+    __tablename__ = 'change_log'
+    ACTIONS = ('inserted', 'replaced', 'obsolete', 'unchanged', 'reparsed')
+
+    id = sdb.Column(sdb.Integer, primary_key=True)
+    mrn = sdb.Column(sdb.VARCHAR(length=255), nullable=False)
+    action = sdb.Column(sdb.String(16), nullable=False)
+    _generation_time = sdb.Column(
+        "generation_time", sdb.DateTime(timezone=True))
+    _receipt_time = sdb.Column(
+        "receipt_time", sdb.DateTime(timezone=True), nullable=False)
+    recorded_time = sdb.Column(
+        sdb.DateTime(timezone=True), default=utc_now, nullable=False)
+
+    # history of a single patient
+    __table_args__ = (Index('ix_change_log_mrn_id', 'mrn', 'id'),)
+
+    @hybrid_property
+    def generation_time(self):
+        return datetime_w_tz(self._generation_time)
+
+    @generation_time.setter
+    def generation_time(self, value):
+        self._generation_time = parse_datetime(value)
+
+    @hybrid_property
+    def receipt_time(self):
+        return datetime_w_tz(self._receipt_time)
+
+    @receipt_time.setter
+    def receipt_time(self, value):
+        self._receipt_time = parse_datetime(value)
+
+    def to_json(self):
+        d = {'cursor': str(self.id), 'mrn': self.mrn, 'action': self.action,
+             'receipt_time': isoformat_w_tz(self.receipt_time)}
+        if self.generation_time:
+            d['generation_time'] = isoformat_w_tz(self.generation_time)
+        return d
+
 
 class ParseException(Exception):
     pass
 
 
+def validate_problem_list(problem_list):
+    """Raise ParseException unless the section is headed 'Problem List'"""
+    try:
+        display = problem_list['section']['code']['_displayName']
+    except (KeyError, TypeError):
+        display = None
+    if display != 'Problem List':
+        raise ParseException("Requires section/code -> Problem List")
+
+
 def parse_effective_time(effectiveTime):
     """Given an effectiveTime, pull best value from high/low and return
 
@@ -279,34 +472,26 @@ def parse_problem_list(problem_list, clinical_doc, replace=False):
     nature of CCDAs, just blow away any existing problems for the clinical_doc
     and add in the ones parsed.
 
+    Codes, statuses and observations are resolved in bulk, see `ingest`,
+    and the per diagnosis patient bitmaps maintained, see `cohort`.  The
+    resulting problem list is materialized on the clinical_doc, saving
+    its reconstruction on every read.
+
     """
+    from .cohort import diagnosis_code_ids, update_cohorts
+    from .ingest import ingest_problem_list
+
     if not problem_list:
         return
 
-    if replace:
-        current_app.logger.info(
-            "deleting problems from {} in favor of new".format(
-                clinical_doc.mrn))
-        for obsolete in Observation.query.filter_by(doc_id=clinical_doc.mrn):
-            sdb.session.delete(obsolete)
-
-    if problem_list['section']['code']['_displayName'] != 'Problem List':
-        raise ParseException("Requires section/code -> Problem List")
-    for entry in problem_list['section']['entry']:
-        try:
-            obs = entry['act']['_']['entryRelationship']['_']\
-                    ['observation']['_']
-        except TypeError:
-            # When there's a single entry, only the act key comes through
-            # pull up this one obs directly from the problem list
-            assert(entry == 'act')  
-            obs = problem_list['section']['entry']['act']['_']\
-                    ['entryRelationship']['_']['observation']['_']
-        observation = parse_observation(obs)
-        if observation:
-            observation.doc_id = clinical_doc.mrn
-            sdb.session.add(observation)
-        else:
-            current_app.logger.debug(
-                "Tossing observation w/o status for {}".format(
-                    clinical_doc.mrn))
+    validate_problem_list(problem_list)
+    previous = diagnosis_code_ids(clinical_doc.mrn) if replace else set()
+    rows = ingest_problem_list(
+        problem_list, clinical_doc.mrn, replace=replace)
+    current = {
+        id for row in rows for id in (row['icd9_id'], row['icd10_id']) if id}
+    update_cohorts(
+        clinical_doc.mrn, added=current - previous,
+        removed=previous - current)
+    clinical_doc.problem_list_snapshot = clinical_doc.problem_list()
+    clinical_doc.modified_time = utc_now()
@@ -0,0 +1,191 @@
+"""Database backed queue of uploads, for asynchronous ingest
+
+In asynchronous mode `upload_ccda` validates and enqueues the payload,
+returning immediately, while the `flask ingest-worker` command drains the
+queue.  Keeping the queue in the database avoids the need for a broker.
+
+"""
+from datetime import timedelta
+from flask import current_app
+import json
+from multiprocessing import Process
+import time
+
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.orm import aliased
+
+from .. import metrics
+from ..extensions import sdb
+from ..time_util import datetime_w_tz, parse_datetime, utc_now
+from . import archive
+from .ingest import archive_referenced, count_upload, ingest_document
+from .models import IngestJob
+
+STATES = ('queued', 'running', 'done', 'failed')
+
+
+def validate(data):
+    """Raise ValueError if upload data can't be ingested"""
+    if not isinstance(data, dict):
+        raise ValueError("expected JSON object")
+    for key in ('filepath', 'effectiveTime'):
+        if key not in data:
+            raise ValueError("missing required '{}'".format(key))
+    parse_datetime(data['effectiveTime'])
+
+
+def enqueue(mrn, payload):
+    """Add job for the raw JSON payload to the queue, returns the job"""
+    job = IngestJob(mrn=mrn, payload=payload, state='queued')
+    sdb.session.add(job)
+    sdb.session.flush()
+    return job
+
+
+def claim():
+    """Claim the oldest queued job, returns it or None if queue is empty
+
+    Jobs backing off until `not_before` are passed over, as are those
+    with an earlier job of the same MRN running or queued, so each
+    patient's jobs run one at a time, in order.
+
+    Candidates are selected skipping rows locked by other workers, and
+    claimed with a conditional update, as not all databases lock rows.
+
+    """
+    other = aliased(IngestJob)
+    blocked = exists().where(and_(
+        other.mrn == IngestJob.mrn, other.id != IngestJob.id, or_(
+            other.state == 'running',
+            and_(other.state == 'queued', other.id < IngestJob.id))))
+    while True:
+        id = sdb.session.query(IngestJob.id).filter(
+            IngestJob.state == 'queued',
+            or_(IngestJob.not_before.is_(None),
+                IngestJob.not_before <= utc_now()),
+            ~blocked).order_by(IngestJob.id).limit(1).with_for_update(
+            skip_locked=True).scalar()
+        if id is None:
+            sdb.session.commit()
+            return None
+        claimed = IngestJob.query.filter_by(id=id, state='queued').update(
+            {'state': 'running', 'started_at': utc_now(),
+             'attempts': IngestJob.attempts + 1}, synchronize_session=False)
+        sdb.session.commit()
+        if claimed:
+            return IngestJob.query.get(id)
+
+
+def run(job):
+    """Ingest the claimed job, recording its outcome
+
+    Failed jobs are requeued until INGEST_MAX_ATTEMPTS is reached, each
+    retry waiting twice as long, from INGEST_RETRY_BACKOFF seconds.
+
+    """
+    referenced = False
+    try:
+        payload = job.payload.encode('utf-8')
+        archive_key = archive.key_for(payload) if archive.enabled() else None
+        job.result = ingest_document(
+            job.mrn, json.loads(job.payload), archive_key=archive_key)
+        referenced = archive_key and archive_referenced(job.mrn, archive_key)
+        job.state = 'done'
+    except Exception as e:
+        current_app.logger.exception(
+            "ingest job %d for %s failed", job.id, job.mrn)
+        sdb.session.rollback()
+        job = IngestJob.query.get(job.id)
+        job.result = repr(e)
+        if job.attempts >= current_app.config['INGEST_MAX_ATTEMPTS']:
+            job.state = 'failed'
+        else:
+            job.state = 'queued'
+            job.not_before = utc_now() + timedelta(seconds=current_app.config[
+                'INGEST_RETRY_BACKOFF'] * 2 ** (job.attempts - 1))
+    job.finished_at = utc_now()
+    sdb.session.commit()
+    if job.state == 'done':
+        count_upload(job.result)
+        if referenced:
+            archive.store(payload)
+    return job
+
+
+def requeue_stale(timeout):
+    """Requeue jobs left running longer than timeout seconds"""
+    count = IngestJob.query.filter(
+        IngestJob.state == 'running',
+        IngestJob.started_at < utc_now() - timedelta(seconds=timeout)).update(
+        {'state': 'queued'}, synchronize_session=False)
+    sdb.session.commit()
+    return count
+
+
+def work(poll_interval=1.0, burst=False):
+    """Process jobs until interrupted, returns number processed
+
+    :param poll_interval: seconds to sleep when the queue is empty
+    :param burst: if set, return once the queue is empty
+
+    """
+    processed = 0
+    while True:
+        job = claim()
+        if job is None:
+            if burst:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        run(job)
+        processed += 1
+
+
+def _work_in_app(app, **kwargs):
+    with app.app_context():
+        # never share connections inherited across fork
+        sdb.engine.dispose()
+        work(**kwargs)
+
+
+def run_workers(app, processes=1, **kwargs):
+    """Drain the queue with the given number of worker processes"""
+    with app.app_context():
+        requeued = requeue_stale(app.config['INGEST_STALE_TIMEOUT'])
+        if requeued:
+            app.logger.warning("requeued %d stale jobs", requeued)
+        if processes == 1:
+            return work(**kwargs)
+        sdb.engine.dispose()
+
+    workers = [
+        Process(target=_work_in_app, args=(app,), kwargs=kwargs)
+        for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+metrics.describe(
+    'cdr_ingest_queue_depth', 'gauge', 'Ingest jobs awaiting a worker')
+metrics.describe(
+    'cdr_ingest_queue_lag_seconds', 'gauge',
+    'Age of the oldest queued ingest job')
+metrics.describe('cdr_ingest_jobs', 'gauge', 'Ingest jobs by state')
+
+
+@metrics.collector
+def queue_metrics():
+    counts = dict(sdb.session.query(
+        IngestJob.state, func.count(IngestJob.id)).group_by(IngestJob.state))
+    for state in STATES:
+        yield 'cdr_ingest_jobs', {'state': state}, counts.get(state, 0)
+    yield 'cdr_ingest_queue_depth', {}, counts.get('queued', 0)
+
+    oldest = sdb.session.query(func.min(IngestJob.enqueued_at)).filter_by(
+        state='queued').scalar()
+    lag = 0
+    if oldest is not None:
+        lag = (utc_now() - datetime_w_tz(oldest)).total_seconds()
+    yield 'cdr_ingest_queue_lag_seconds', {}, lag
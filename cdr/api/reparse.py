@@ -0,0 +1,176 @@
+"""Re-derive observations from stored source documents
+
+After parser fixes, each patient's problem list is parsed again from its
+source document - by default the upload as archived (source 'archive'),
+else a JSON upload (or bare problem list) located by the `source`
+template, formatted with the doc's `mrn` and `filepath`.  The `filepath`
+itself names the CCDA XML, not JSON.
+
+Patients are processed in batches, one transaction each, across a pool
+of worker processes.  Completed MRNs may be appended to a checkpoint
+file, skipped when resuming.
+
+"""
+from collections import Counter
+import json
+from multiprocessing import Pool
+
+from ..extensions import sdb
+from . import archive
+from .ingest import canonical_json, content_hash
+from .models import ChangeLog, ClinicalDoc, parse_problem_list
+
+ARCHIVE_SOURCE = 'archive'
+DEFAULT_SOURCE = ARCHIVE_SOURCE
+
+
+def load_source(doc, source=DEFAULT_SOURCE):
+    """Returns the problem list from the source document of doc"""
+    if source == ARCHIVE_SOURCE:
+        if not doc.archive_key:
+            raise LookupError("no archived upload")
+        with archive.open_payload(doc.archive_key) as payload:
+            data = json.load(payload)
+    else:
+        path = source.format(mrn=doc.mrn, filepath=doc.filepath)
+        with open(path, 'r') as json_file:
+            data = json.load(json_file)
+    # an upload as given to `upload_ccda`, or just its problem list
+    if isinstance(data, dict) and 'problem_list' in data:
+        return data['problem_list']
+    return data
+
+
+def problem_diff(before, after):
+    """Returns (added, removed) between serialized problem lists"""
+    before = Counter(canonical_json(p) for p in before or ())
+    after = Counter(canonical_json(p) for p in after or ())
+    return (
+        [json.loads(p) for p in (after - before).elements()],
+        [json.loads(p) for p in (before - after).elements()])
+
+
+def describe_problem(problem):
+    """Short description of a serialized problem, for diff reports"""
+    codes = [
+        '{} {}'.format(field, problem[field]['code'])
+        for field in ('icd10', 'icd9', 'code') if field in problem]
+    status = problem['status'].get('value', {}).get(
+        'display', problem['status']['status_code'])
+    return '{} ({})'.format(', '.join(codes), status)
+
+
+def reparse_patient(doc, problem_list):
+    """Parse problem_list in place of doc's observations, returns diff"""
+    before = doc.problem_list_snapshot
+    if before is None:
+        before = doc.problem_list()
+    parse_problem_list(problem_list, doc, replace=True)
+    doc.content_hash = content_hash(problem_list)
+    added, removed = problem_diff(before, doc.problem_list_snapshot)
+    if added or removed:
+        # incremental consumers of the change feed refetch the patient
+        sdb.session.add(ChangeLog(
+            mrn=doc.mrn, action='reparsed',
+            generation_time=doc.generation_time,
+            receipt_time=doc.receipt_time))
+    return added, removed
+
+
+def reparse_batch(mrns, source=DEFAULT_SOURCE, dry_run=False):
+    """Reparse the patients in a single transaction
+
+    A failing patient is rolled back along with the rest of the batch,
+    which is replayed without it.  Dry runs always roll back.
+
+    Returns list of result dicts, one per MRN: with the 'added' and
+    'removed' problems, or an 'error'.
+
+    """
+    results, sources = {}, {}
+    for mrn in mrns:
+        # load sources up front, so missing files cost no replay
+        try:
+            doc = ClinicalDoc.query.get(mrn)
+            if doc is None:
+                raise LookupError("no clinical doc")
+            sources[mrn] = load_source(doc, source)
+        except Exception as e:
+            results[mrn] = dict(mrn=mrn, error=repr(e))
+    sdb.session.rollback()
+
+    remaining = [mrn for mrn in mrns if mrn in sources]
+    while remaining:
+        applied, failed = [], None
+        for mrn in remaining:
+            try:
+                applied.append((mrn, reparse_patient(
+                    ClinicalDoc.query.get(mrn), sources[mrn])))
+            except Exception as e:
+                failed = mrn
+                results[mrn] = dict(mrn=mrn, error=repr(e))
+                break
+        if failed is None:
+            if dry_run:
+                sdb.session.rollback()
+            else:
+                sdb.session.commit()
+            for mrn, (added, removed) in applied:
+                results[mrn] = dict(mrn=mrn, added=added, removed=removed)
+            break
+        sdb.session.rollback()
+        remaining = [mrn for mrn in remaining if mrn != failed]
+    return [results[mrn] for mrn in mrns]
+
+
+class Checkpoint(object):
+    """Append only file of completed MRNs, one per line"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def completed(self):
+        try:
+            with open(self.path, 'r') as checkpoint:
+                return {line.strip() for line in checkpoint if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def record(self, mrns):
+        with open(self.path, 'a') as checkpoint:
+            checkpoint.writelines(mrn + '\n' for mrn in mrns)
+
+
+def _init_worker(app):
+    global _app_context
+    _app_context = app.app_context()
+    _app_context.push()
+    # never share connections inherited across fork
+    sdb.engine.dispose()
+
+
+def _reparse_batch(args):
+    return reparse_batch(*args)
+
+
+def reparse(app, mrns, source=DEFAULT_SOURCE, processes=1, batch_size=50,
+            dry_run=False):
+    """Reparse the given patients, generating each batch's results
+
+    Batches complete in any order when spread over `processes`.  Call
+    within an app context.
+
+    """
+    batches = [
+        (mrns[i:i + batch_size], source, dry_run)
+        for i in range(0, len(mrns), batch_size)]
+    if processes == 1:
+        for batch in batches:
+            yield reparse_batch(*batch)
+        return
+
+    sdb.session.remove()
+    sdb.engine.dispose()
+    with Pool(processes, initializer=_init_worker, initargs=(app,)) as pool:
+        for results in pool.imap_unordered(_reparse_batch, batches):
+            yield results
@@ -0,0 +1,183 @@
+"""Incremental reading of uploads, one problem list entry at a time
+
+`request.json` decodes the whole body into nested dicts before parsing
+begins.  Instead, the outer objects of an upload are walked as a stream,
+and each entry of `problem_list.section.entry` decoded, reduced to its
+Problem and discarded before the next is read.  Memory is bounded by the
+largest entry, plus the compact Problems collected.
+
+"""
+import codecs
+import hashlib
+import json
+import re
+
+from .ingest import ProblemList, collect_problem, combined_hash
+from .ingest import content_hash, digest_entry, entry_observation
+from .models import ParseException, validate_problem_list
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+
+class JSONStream(object):
+    """Pull reader of JSON from a binary stream
+
+    Structure is walked with `members()` and `elements()`, while values
+    are decoded whole by `value()`, reading as much of the stream as each
+    requires.
+
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        data = self.stream.read(size)
+        if not data:
+            self.eof = True
+        text = self.decoder.decode(data or b'', final=self.eof)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+
+    def peek(self):
+        """Returns next non whitespace character, or '' at the end"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._fill(self.chunk_size)
+
+    def expect(self, chars):
+        """Consume the next character, one of `chars`, and return it"""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("expected one of '{}', found '{}'".format(
+                chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decode and return the whole JSON value next in the stream"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer may continue
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill(size)
+            size *= 2
+
+    def members(self):
+        """Generate the keys of the object next in the stream
+
+        The consumer must read each member's value before resuming.
+
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("object keys must be strings")
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Generate once per element of the array next in the stream
+
+        The consumer must read each element before resuming.
+
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+def entries(reader):
+    """Generate each entry, single entries arriving without a list"""
+    if reader.peek() == '[':
+        for _ in reader.elements():
+            yield reader.value()
+    else:
+        yield reader.value()
+
+
+def read_problem_list(reader):
+    """Read the problem list object next in the stream
+
+    Returns a ProblemList, equivalent to `ingest.collect_problems()` and
+    `ingest.content_hash()` of the decoded problem list.  Raises
+    ValueError on a section other than the 'Problem List', when its code
+    precedes the entries.
+
+    """
+    header, codes, problems = {}, {}, []
+    digest = hashlib.sha256()
+    for key in reader.members():
+        if key != 'section' or reader.peek() != '{':
+            header[key] = reader.value()
+            continue
+        section = header['section'] = {}
+        for section_key in reader.members():
+            if section_key != 'entry':
+                section[section_key] = reader.value()
+                if section_key == 'code':
+                    try:
+                        validate_problem_list(header)
+                    except ParseException as e:
+                        raise ValueError(str(e))
+                continue
+            for entry in entries(reader):
+                digest_entry(digest, entry)
+                problem = collect_problem(entry_observation(entry), codes)
+                if problem:
+                    problems.append(problem)
+    return ProblemList(
+        header=header, codes=codes, problems=problems,
+        content_hash=combined_hash(header, digest) if header else (
+            content_hash(header)))
+
+
+def read_upload(stream, chunk_size=CHUNK_SIZE):
+    """Read upload JSON from a binary stream, as given to `upload_ccda`
+
+    Returns the upload dict, with the 'problem_list' reduced to a
+    ProblemList.  Raises ValueError on malformed JSON.
+
+    """
+    reader = JSONStream(stream, chunk_size=chunk_size)
+    data = {}
+    for key in reader.members():
+        if key == 'problem_list' and reader.peek() == '{':
+            data[key] = read_problem_list(reader)
+        else:
+            data[key] = reader.value()
+    if reader.peek():
+        raise ValueError("unexpected data following upload")
+    return data
@@ -1,12 +1,28 @@
 from flask import abort, Blueprint, current_app, request, jsonify
+from flask import Response, send_file, stream_with_context, url_for
+from datetime import datetime, timedelta
+import hashlib
 import json
+import mimetypes
+import os
 from os import getenv
-from sqlalchemy.orm.exc import NoResultFound
-
-from ..extensions import sdb
-from ..time_util import datetime_w_tz, isoformat_w_tz, parse_datetime
-from .models import ClinicalDoc, parse_problem_list
-from .models import Code, Observation
+import pytz
+import time
+from sqlalchemy import distinct, func
+from sqlalchemy.orm import joinedload
+from werkzeug.http import is_resource_modified
+
+from .. import instrument, metrics
+from ..extensions import read_replica, sdb
+from ..time_util import isoformat_w_tz, utc_now
+from . import archive, documents, queue
+from .cohort import ExpressionException, cohort, page, popcount
+from .filters import filter_clause, prefix_clause
+from .ingest import archive_referenced, count_upload, ingest_document
+from .ingest import ingest_ndjson
+from .models import ChangeLog, ClinicalDoc, IngestJob
+from .models import CODE_SYSTEMS, Code, Observation, Status
+from .stream import read_upload
 
 PROXYPATH = getenv('PROXYPATH', '')
 api = Blueprint('api', __name__, url_prefix=PROXYPATH)
@@ -17,162 +33,568 @@ def hello():
     return jsonify(hi='there')
 
 
+def etag_for(*parts):
+    """Returns strong ETag for the given parts of a resource's state"""
+    return hashlib.sha1('\0'.join(
+        isoformat_w_tz(p) if isinstance(p, datetime) else str(p or '')
+        for p in parts).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """Returns 304 response if request validators match, otherwise None
+
+    Checked ahead of any expensive queries, as clients poll patient
+    resources.  Follows `If-None-Match`, or in its absence
+    `If-Modified-Since`.
+
+    """
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(pytz.UTC).replace(
+            tzinfo=None)
+    if is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return add_validators(Response(status=304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
 @api.route('/patients/<string:mrn>/ccda/file_info')
+@read_replica
 def api_index(mrn):
     doc = ClinicalDoc.query.get_or_404(mrn)
-    return jsonify(
+    etag = etag_for(doc.mrn, doc.filepath, doc.receipt_time)
+    unchanged = not_modified(etag, doc.receipt_time)
+    if unchanged:
+        return unchanged
+
+    response = jsonify(
         mrn=mrn, filepath=doc.filepath,
         receipt_time=isoformat_w_tz(doc.receipt_time))
+    return add_validators(response, etag, doc.receipt_time)
+
+
+@api.route('/patients/<string:mrn>/ccda/archive')
+@read_replica
+def archived_ccda(mrn):
+    """Presents the upload accepted for given MRN, as archived
+
+    Clients accepting the archive's encoding receive the compressed file
+    as is, otherwise it is decompressed as streamed.  Archived payloads
+    never change, so are validated by key alone.
+
+    """
+    doc = ClinicalDoc.query.get_or_404(mrn)
+    found = doc.archive_key and archive.locate(doc.archive_key)
+    if not found:
+        abort(404, "no archived upload for {}".format(mrn))
+    path, codec = found
+    encoded = codec.name in request.accept_encodings
+    etag = '{}-{}'.format(
+        doc.archive_key, codec.name) if encoded else doc.archive_key
+    unchanged = not_modified(etag, None)
+    if unchanged:
+        return unchanged
+
+    if encoded:
+        response = send_file(
+            path, mimetype='application/json', add_etags=False)
+        response.headers['Content-Encoding'] = codec.name
+    else:
+        response = Response(
+            archive.iter_payload(doc.archive_key),
+            mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return add_validators(response, etag, None)
+
+
+@api.route('/patients/<string:mrn>/ccda')
+@read_replica
+def download_ccda(mrn):
+    """Presents the CCDA document at the clinical doc's filepath
+
+    Served from within CCDA_ROOT, honoring conditional and range
+    requests.  The file is streamed via the server's `wsgi.file_wrapper`
+    (or memory mapped, with CCDA_MMAP), else handed off to the front end
+    server with USE_X_SENDFILE or CCDA_ACCEL_REDIRECT.
+
+    """
+    doc = ClinicalDoc.query.get_or_404(mrn)
+    try:
+        path = documents.resolve(doc.filepath)
+    except LookupError as e:
+        abort(404, str(e))
+    stat = os.stat(path)
+    etag = etag_for(path, stat.st_mtime_ns, stat.st_size)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), pytz.UTC)
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/xml'
+    accel = current_app.config['CCDA_ACCEL_REDIRECT']
+    if accel:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = documents.accel_location(path)
+    elif current_app.config['CCDA_MMAP'] and stat.st_size and (
+            not current_app.use_x_sendfile):
+        response = Response(
+            documents.MappedFile(path), mimetype=mimetype,
+            direct_passthrough=True)
+        response.content_length = stat.st_size
+    else:
+        response = send_file(
+            path, mimetype=mimetype, conditional=False, add_etags=False)
+    # patient documents, never for shared caches
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = 0
+    response.expires = None
+    add_validators(response, etag, last_modified)
+    if accel or current_app.use_x_sendfile:
+        # the front end server sends the body, ranges included
+        return response
+    return response.make_conditional(
+        request, accept_ranges='bytes', complete_length=stat.st_size)
+
+
+def stream_json_array(key, items):
+    """Generate JSON object `{key: [items]}` incrementally
+
+    Suitable for a streamed response, avoiding buffering of all items.
+
+    """
+    yield '{{"{}": ['.format(key)
+    for i, item in enumerate(items):
+        yield (',' if i else '') + json.dumps(item)
+    yield ']}\n'
 
 
 @api.route('/codes/<system>')
+@read_replica
 def codes_by_system(system):
-    """Presents a list of diagnosis for the requested system"""
+    """Presents a list of diagnosis for the requested system
+
+    Optional query parameters:
+        after: keyset cursor, only codes sorting after it are included
+        limit: maximum number of codes to include
+        stream: if true, yield the JSON array incrementally from a server
+            side cursor rather than buffering the whole list
+
+    When codes remain beyond `limit`, the cursor for the next page is
+    advertised in the `X-Next-Cursor` and `Link` response headers.
+
+    """
+    system_name = system
     if system == 'icd9':
-        system = 'ICD-9-CM'
+        system_name = 'ICD-9-CM'
     if system == 'icd10':
-        system = 'ICD-10-CM'
+        system_name = 'ICD-10-CM'
+
+    codes = Code.query.filter_by(
+        code_system_name=system_name).order_by(Code.code)
+    after = request.args.get('after')
+    if after:
+        codes = codes.filter(Code.code > after)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        abort(400, "limit must be positive")
+    stream = request.args.get('stream', '').lower() in ('1', 'true')
+
+    next_cursor = None
+    if limit:
+        # the last code on this page is the next cursor, if any follow
+        boundary = [c for c, in codes.with_entities(
+            Code.code).offset(limit - 1).limit(2)]
+        if len(boundary) == 2:
+            next_cursor = boundary[0]
+        codes = codes.limit(limit)
+
+    if stream:
+        codes = codes.execution_options(stream_results=True).yield_per(1000)
+        response = Response(stream_with_context(stream_json_array(
+            'codes', (code.to_json() for code in codes))),
+            mimetype='application/json')
+    else:
+        response = jsonify(codes=[code.to_json() for code in codes])
+
+    if next_cursor is not None:
+        args = dict(system=system, limit=limit)
+        if stream:
+            args['stream'] = 'true'
+        next_page_headers(response, '.codes_by_system', next_cursor, **args)
+    return response
+
 
-    codes = Code.query.filter_by(code_system_name=system)
-    data = []
-    for code in codes:
-        data.append(code.to_json())
-    return jsonify(codes=data)
+def next_page_headers(response, endpoint, cursor, cursor_arg='after',
+                      **args):
+    """Advertise the keyset cursor for the next page on response"""
+    response.headers['X-Next-Cursor'] = cursor
+    args[cursor_arg] = cursor
+    response.headers['Link'] = '<{}>; rel="next"'.format(
+        url_for(endpoint, **args))
 
 
 @api.route('/diagnosis/<system>/<code>/patients')
+@read_replica
 def patients_w_icd9code(system, code):
-    """Presents a list of patients with the given icd9/10 code"""
-    if system not in ('icd9', 'icd10'):
-        abort(400, "unsupported system: {}".format(system))
+    """Presents a list of patients with the given icd9/10 code
 
-    try:
-        matching_code = Code.query.filter_by(code=code).one()
-    except NoResultFound:
-        abort(404)
+    A trailing '*' on the code matches all codes in the system sharing
+    the prefix, e.g. `E11*`.
 
-    if system == 'icd9':
-        observations = Observation.query.filter_by(icd9_id=matching_code.id)
-    else:
-        observations = Observation.query.filter_by(icd10_id=matching_code.id)
-    data = dict()
-    data['diagnosis'] = matching_code.to_json()
-    for obs in observations:
-        data[obs.doc_id] = obs.status.to_json()
-    return jsonify(patients=data)
+    Optional query parameters:
+        after: keyset cursor, only MRNs sorting after it are included
+        limit: maximum number of patients to include
+        count_only: if true, only the number of matching patients is
+            returned
 
+    Patients are keyed by MRN, with the status of the matching
+    observation.  Exact (non prefix) lookups also include the matching
+    code under the legacy 'diagnosis' key.
 
-def filter_func(filter_parameters):
-    """Generator, returns a function based on value of filter_parameters
+    """
+    if system not in CODE_SYSTEMS:
+        abort(400, "unsupported system: {}".format(system))
 
-    Filter parameters expected to be url-encoded JSON string (if
-    defined)  It defines the list of parameters to search on.
+    # Resolve codes through the (code_system, code) indices
+    codes = Code.query.filter_by(code_system=CODE_SYSTEMS[system])
+    if code.endswith('*'):
+        codes = codes.filter(prefix_clause(Code.code, code[:-1]))
+    else:
+        codes = codes.filter_by(code=code)
+    codes = codes.order_by(Code.code).all()
+    if not codes:
+        abort(404)
+    diagnoses = [c.to_json() for c in codes]
+
+    column = Observation.icd9_id if system == 'icd9' else Observation.icd10_id
+    matching = Observation.query.filter(column.in_([c.id for c in codes]))
+    if request.args.get('count_only', '').lower() in ('1', 'true'):
+        count = matching.with_entities(
+            func.count(distinct(Observation.doc_id))).scalar()
+        return jsonify(count=count, diagnoses=diagnoses)
+
+    after = request.args.get('after')
+    if after:
+        matching = matching.filter(Observation.doc_id > after)
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        abort(400, "limit must be positive")
+
+    # Patients and status (w/ its codes) in one query, ordered by MRN
+    rows = matching.join(Observation.status).with_entities(
+        Observation.doc_id, Status).options(
+        joinedload(Status.code), joinedload(Status.value)).order_by(
+        Observation.doc_id, Observation.id).execution_options(
+        stream_results=True).yield_per(1000)
+
+    data = dict()
+    next_cursor = last_mrn = None
+    for mrn, status in rows:
+        if limit and mrn not in data and len(data) == limit:
+            next_cursor = last_mrn
+            break
+        last_mrn = mrn
+        # multiple matching observations per patient, the last prevails
+        data[mrn] = status.to_json()
+
+    if not code.endswith('*'):
+        data['diagnosis'] = diagnoses[0]
+    response = jsonify(patients=data, diagnoses=diagnoses)
+    if next_cursor is not None:
+        next_page_headers(
+            response, '.patients_w_icd9code', next_cursor,
+            system=system, code=code, limit=limit)
+    return response
+
+
+@api.route('/cohorts', methods=('POST',))
+@read_replica
+def cohort_patients():
+    """Presents patients matching a boolean expression over diagnoses
+
+    Expects a JSON body of the form `{"expression": <expression>}`, see
+    `cohort` for the expression grammar.
+
+    Optional query parameters:
+        after: cursor from X-Next-Cursor of the previous page
+        limit: maximum number of MRNs to include, default 1000
+        count_only: if true, only the number of matching patients is
+            returned
 
     """
+    data = request.get_json(silent=True)
+    if not data or 'expression' not in data:
+        abort(400, "expression required")
+    try:
+        bitmap = cohort(data['expression'])
+    except ExpressionException as e:
+        abort(400, str(e))
 
-    def field_match(subfield, patterns, contents):
-        """Returns true if contents match field_rule parameters"""
-        if subfield not in contents:
-            return False
-
-        for pattern in patterns:
-            if pattern.endswith('*'):
-                if contents[subfield].startswith(pattern[:-1]):
-                    return True
-            elif contents[subfield] == pattern:
-                return True
-        return False
-
-    def status_match(status_rule, contents):
-        for key in status_rule:
-            match_dict = status_rule[key]
-            for field in match_dict:
-                if match_dict[field] != contents[key][field]:
-                    return False
-        return True
-
-    if not filter_parameters:
-        """Without filter parameters, everything passes the filter """
-        return lambda x: True
-
-    params = json.loads(filter_parameters)
-    filter_by = params['filter']
-    require_status = params.get('status')
-
-    def filter_observation(observation):
-        """All params treated as 'or' - return true as soon as one hits"""
-        for field in filter_by:
-            if field in observation:
-                for subfield, patterns in filter_by[field].items():
-                    if field_match(subfield, patterns, observation[field]):
-                        # Found a matching field, confirm status if required
-                        if require_status:
-                            return status_match(
-                                require_status, observation['status'])
-                        else:
-                            return True
-        # Never matched, filter out
-        return False
-
-    return filter_observation
+    count = popcount(bitmap)
+    if request.args.get('count_only', '').lower() in ('1', 'true'):
+        return jsonify(count=count)
+
+    limit = request.args.get('limit', 1000, type=int)
+    if limit < 1:
+        abort(400, "limit must be positive")
+    mrns, next_cursor = page(
+        bitmap, after=request.args.get('after', 0, type=int), limit=limit)
+    response = jsonify(count=count, patients=mrns)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 
 @api.route('/patients/<string:mrn>/problem_list')
+@read_replica
 def get_problem_list(mrn):
+    """Presents the problem list, served from its snapshot if unfiltered
+
+    Supports conditional requests, via ETag or Last-Modified.
+
+    """
     doc = ClinicalDoc.query.get_or_404(mrn)
-    problem_list = []
-    observations = Observation.query.filter_by(doc_id=doc.mrn)
+    last_modified = doc.modified_time or doc.receipt_time
+    etag = etag_for(
+        doc.mrn, doc.modified_time, doc.receipt_time,
+        request.args.get("filter"))
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
 
-    pass_filter = filter_func(request.args.get("filter"))
+    problem_list = problem_lists(
+        [doc], filter_clause(request.args.get("filter")))[doc.mrn]
+    with instrument.timer('serialize'):
+        response = jsonify(
+            mrn=mrn, receipt_time=isoformat_w_tz(doc.receipt_time),
+            problem_list=problem_list)
+    return add_validators(response, etag, last_modified)
 
-    for obs in observations:
-        problem = {}
-        for e in (
-                'code', 'icd9', 'icd10', 'onset_date', 'entry_date',
-                'status'):
-            if getattr(obs, e):
-                if hasattr(getattr(obs, e), 'isoformat'):
-                    problem[e] = isoformat_w_tz(getattr(obs, e))
-                else:
-                    problem[e] = getattr(obs, e).to_json()
-        if pass_filter(problem):
-            problem_list.append(problem)
 
-    return jsonify(
-        mrn=mrn, receipt_time=isoformat_w_tz(doc.receipt_time),
-        problem_list=problem_list)
+def problem_lists(docs, clause=None):
+    """Returns dict of serialized problem lists for docs, keyed by MRN
+
+    Unfiltered lists are served from their snapshots; the remainder come
+    from a single eager loading query, however many docs are given.
+
+    """
+    found = {}
+    pending = []
+    for doc in docs:
+        if clause is None and doc.problem_list_snapshot is not None:
+            found[doc.mrn] = doc.problem_list_snapshot
+        else:
+            found[doc.mrn] = []
+            pending.append(doc.mrn)
+
+    if pending:
+        observations = Observation.eager_query().filter(
+            Observation.doc_id.in_(pending)).order_by(
+            Observation.doc_id, Observation.id)
+        if clause is not None:
+            observations = observations.filter(clause)
+        observations = observations.all()
+        with instrument.timer('serialize'):
+            for obs in observations:
+                found[obs.doc_id].append(obs.to_json())
+    return found
+
+
+@api.route('/problem_lists', methods=('POST',))
+@read_replica
+def get_problem_lists():
+    """Presents the problem lists for many patients at once
+
+    Expects a JSON body of the form `{"mrns": [...], "filter": <spec>}`,
+    the optional filter as given (url-encoded) to `get_problem_list`.
+
+    Responds with the problem lists keyed by MRN, and the list of
+    requested MRNs `not_found`, from a fixed number of queries.
+
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('mrns'), list):
+        abort(400, "list of mrns required")
+    mrns = list(dict.fromkeys(str(mrn) for mrn in data['mrns']))
+    if len(mrns) > current_app.config['PROBLEM_LIST_BATCH_LIMIT']:
+        abort(400, "at most {} mrns per request".format(
+            current_app.config['PROBLEM_LIST_BATCH_LIMIT']))
+
+    filter_by = data.get('filter')
+    if filter_by and not isinstance(filter_by, str):
+        # canonical form, sharing the compiled filter cache
+        filter_by = json.dumps(filter_by, sort_keys=True)
+    try:
+        clause = filter_clause(filter_by)
+    except (ValueError, KeyError, AttributeError) as e:
+        abort(400, "invalid filter: {}".format(e))
+
+    docs = ClinicalDoc.query.filter(ClinicalDoc.mrn.in_(mrns)).all() if (
+        mrns) else []
+    found = problem_lists(docs, clause)
+    with instrument.timer('serialize'):
+        response = jsonify(
+            problem_lists={
+                doc.mrn: dict(
+                    mrn=doc.mrn,
+                    receipt_time=isoformat_w_tz(doc.receipt_time),
+                    problem_list=found[doc.mrn])
+                for doc in docs},
+            not_found=[mrn for mrn in mrns if mrn not in found])
+    return response
 
 
 @api.route('/patients/<string:mrn>/ccda', methods=('PUT',))
 def upload_ccda(mrn):
-    """Persist the CCDA for given MRN unless a newer one exists"""
-    data = request.json
-    # with open('/tmp/save-{}'.format(mrn), 'w') as backup:
-    #     backup.write(json.dumps(data['problem_list'], indent=2))
-
-    # Check for existing record for this MRN
-    replace = False
-    doc = ClinicalDoc.query.get(mrn)
-    if doc:
-        replace = True
-
-    if doc and datetime_w_tz(doc.generation_time) >=\
-            parse_datetime(data['effectiveTime']):
-        current_app.logger.info("found better data for MRN {} already"
-                                " present".format(mrn))
-        return jsonify(message='obsolete')
-
-    filepath = data['filepath']
-    if doc is None:
-        doc = ClinicalDoc(mrn=mrn, filepath=filepath)
-
-    if 'effectiveTime' in data:
-        doc.generation_time = parse_datetime(data['effectiveTime'])
-    if 'receipt_time' in data:
-        doc.receipt_time = parse_datetime(data['receipt_time'])
-
-    doc.save()
-    parse_problem_list(
-        data.get('problem_list'), clinical_doc=doc, replace=replace)
-    sdb.session.commit()
-    return jsonify(message='upload ok')
+    """Persist the CCDA for given MRN unless a newer one exists
+
+    The body is read as a stream, one problem list entry at a time, see
+    `stream.read_upload`.
+
+    In asynchronous mode (query parameter `async=true`, or configured
+    INGEST_ASYNC) the payload is only validated and queued for the
+    `ingest-worker`, responding 202 with the job id.
+
+    With ARCHIVE_DIR configured, the payload is compressed as read, and
+    archived if referenced from the clinical doc, i.e. when accepted.
+
+    """
+    run_async = request.args.get('async', '').lower() in ('1', 'true') or (
+        current_app.config['INGEST_ASYNC'])
+    if run_async:
+        data = request.json
+        try:
+            queue.validate(data)
+        except ValueError as e:
+            abort(400, str(e))
+        job = queue.enqueue(mrn, request.get_data(as_text=True))
+        sdb.session.commit()
+        response = jsonify(message='queued', job_id=job.id)
+        response.status_code = 202
+        response.headers['Location'] = url_for('.job_status', job_id=job.id)
+        return response
+
+    tee = archive.Tee(request.stream) if archive.enabled() else None
+    try:
+        with instrument.timer('parse'):
+            data = read_upload(tee or request.stream)
+    except Exception as e:
+        if tee:
+            tee.discard()
+        if isinstance(e, ValueError):
+            abort(400, "invalid upload: {}".format(e))
+        raise
+    archive_key = tee.finish() if tee else None
+    try:
+        message = ingest_document(mrn, data, archive_key=archive_key)
+        referenced = tee and archive_referenced(mrn, archive_key)
+        sdb.session.commit()
+    except Exception:
+        if tee:
+            tee.discard()
+        raise
+    count_upload(message)
+    if referenced:
+        tee.keep()
+    elif tee:
+        tee.discard()
+    return jsonify(message=message)
+
+
+@api.route('/changes')
+def changes():
+    """Presents the outcome of uploads in order received
+
+    Consumers sync incrementally, resuming from the cursor of the last
+    response rather than pulling every problem list.  Always read from
+    the primary, as replica lag could hide a late committed change the
+    cursor would then skip.
+
+    Optional query parameters:
+        since: cursor of a previous response, only later changes are
+            included
+        limit: maximum number of changes, capped at CHANGE_FEED_LIMIT
+        wait: seconds to wait for a change when none follow the cursor,
+            capped at CHANGE_FEED_MAX_WAIT (long polling, disabled by
+            default)
+
+    Responds with the 'changes' and the 'cursor' to resume from.  When
+    more changes follow, the next page is advertised as by other
+    paginated views.
+
+    """
+    since = request.args.get('since', 0, type=int)
+    max_limit = current_app.config['CHANGE_FEED_LIMIT']
+    limit = request.args.get('limit', max_limit, type=int)
+    if limit < 1:
+        abort(400, "limit must be positive")
+    limit = min(limit, max_limit)
+    deadline = time.time() + min(
+        request.args.get('wait', 0, type=float),
+        current_app.config['CHANGE_FEED_MAX_WAIT'])
+    settle = timedelta(seconds=current_app.config['CHANGE_FEED_SETTLE'])
+
+    while True:
+        # ids are assigned before commit, so may become visible out of
+        # order; holding back recent changes keeps cursors from skipping
+        query = ChangeLog.query.filter(ChangeLog.id > since)
+        if settle:
+            query = query.filter(ChangeLog.recorded_time <= utc_now() - settle)
+        rows = query.order_by(ChangeLog.id).limit(limit + 1).all()
+        remaining = deadline - time.time()
+        if rows or remaining <= 0:
+            break
+        # release the connection while waiting
+        sdb.session.remove()
+        time.sleep(min(
+            remaining, current_app.config['CHANGE_FEED_POLL_INTERVAL']))
+
+    cursor = str(rows[min(len(rows), limit) - 1].id) if rows else str(since)
+    response = jsonify(
+        changes=[change.to_json() for change in rows[:limit]], cursor=cursor)
+    if len(rows) > limit:
+        next_page_headers(
+            response, '.changes', cursor, cursor_arg='since', limit=limit)
+    return response
+
+
+@api.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    """Presents the state of an asynchronous upload"""
+    job = IngestJob.query.get_or_404(job_id)
+    return jsonify(job.to_json())
+
+
+@api.route('/metrics')
+def metrics_view():
+    """Presents metrics in the Prometheus text format"""
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.route('/ccda/batch', methods=('POST',))
+def upload_ccda_batch():
+    """Persist a newline delimited JSON stream of CCDAs
+
+    Each line holds a JSON object as given to `upload_ccda`, plus its
+    'mrn'.  Lines are read incrementally and committed in groups of
+    BULK_COMMIT_SIZE; a failing record is rolled back and reported
+    without losing the rest of its group.
+
+    Responds with a newline delimited JSON stream of results, one per
+    record: its line number and mrn, with the upload 'message' or an
+    'error'.
+
+    """
+    results = ingest_ndjson(
+        request.stream, group_size=current_app.config['BULK_COMMIT_SIZE'])
+    return Response(
+        stream_with_context(json.dumps(r) + '\n' for r in results),
+        mimetype='application/x-ndjson')
@@ -2,8 +2,9 @@ import os
 
 from flask import Flask, request
 
+from . import instrument, metrics
 from .config import DefaultConfig
-from .api import api
+from .api import api, cache
 from .extensions import sdb
 
 
@@ -48,6 +49,8 @@ def configure_app(app, config=None):
 
 def configure_extensions(app):
     sdb.init_app(app)
+    cache.configure(app)
+    metrics.configure(app.config['METRICS_DIR'])
 
 
 def configure_blueprints(app, blueprints):
@@ -58,51 +61,68 @@ def configure_blueprints(app, blueprints):
 
 
 def configure_logging(app):
-    """Configure file(info) and email(error) logging."""
+    """Configure file(info) and email(error) logging.
+
+    Both sinks sit behind a queue, drained by a background thread, so
+    requests never block on disk or SMTP - see cdr.logs.
+
+    """
 
     if app.debug or app.testing:
         # Skip debug and test mode. Just check standard output.
         return
     else:  # pragma: no cover
+        import atexit
         import logging
-        from logging.handlers import SMTPHandler
+        from . import logs
 
         # Set info level on logger, which might be overwritten by handers.
         # Suppress DEBUG messages.
         app.logger.setLevel(logging.INFO)
 
-        info_log = os.path.join(app.config['LOG_FOLDER'], 'info.log')
-        info_file_handler = logging.handlers.RotatingFileHandler(info_log, maxBytes=100000, backupCount=10)
+        info_file_handler = logs.file_handler(app.config)
         info_file_handler.setLevel(logging.INFO)
-        info_file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]')
-        )
-        app.logger.addHandler(info_file_handler)
+        info_file_handler.setFormatter(logs.formatter(app.config))
+        handlers = [info_file_handler]
+
+        if app.config.get('MAIL_SERVER'):
+            mail_handler = logs.CoalescingSMTPHandler(
+                app.config['MAIL_SERVER'],
+                app.config['MAIL_USERNAME'],
+                app.config['ADMINS'],
+                'O_ops... %s failed!' % app.config['PROJECT'],
+                (app.config['MAIL_USERNAME'],
+                 app.config['MAIL_PASSWORD']),
+                interval=app.config['MAIL_INTERVAL'])
+            mail_handler.setLevel(logging.ERROR)
+            mail_handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+            handlers.append(mail_handler)
+
+        pipeline = logs.LogPipeline(handlers)
+        app.logger.addHandler(pipeline.handler)
+        pipeline.start()
+        atexit.register(pipeline.stop)
 
         # Testing
         app.logger.info("testing info.")
-        app.logger.warn("testing warn.")
+        app.logger.warning("testing warn.")
         app.logger.error("testing error.")
 
-        mail_handler = SMTPHandler(app.config['MAIL_SERVER'],
-                                   app.config['MAIL_USERNAME'],
-                                   app.config['ADMINS'],
-                                   'O_ops... %s failed!' % app.config['PROJECT'],
-                                   (app.config['MAIL_USERNAME'],
-                                    app.config['MAIL_PASSWORD']))
-        mail_handler.setLevel(logging.ERROR)
-        mail_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]')
-        )
-        app.logger.addHandler(mail_handler)
-
 
 def configure_hook(app):
+    instrumented = app.config['INSTRUMENTATION']
+    if instrumented:
+        instrument.listen()
+
+        @app.after_request
+        def after_request(response):
+            return instrument.finish(response)
+
     @app.before_request
     def before_request():
         """Set to True to see details of every call"""
+        if instrumented:
+            instrument.start()
         if False:  # pragma: no cover
             print("HEADERS", request.headers)
             print("REQ_path", request.path)
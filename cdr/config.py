@@ -17,12 +17,77 @@ class BaseConfig(object):
     ADMINS = ['pbugni@uw.edu']
     SECRET_KEY = 'override with a secret key'
     LOG_FOLDER = os.path.join('/tmp', 'logs')
+    # 'text' or 'json', one object per line
+    LOG_FORMAT = env.get('LOG_FORMAT', 'text')
+    # Log to info.<pid>.log, as workers sharing a file race on rotation
+    LOG_PER_PROCESS = env.get('LOG_PER_PROCESS', 'false').lower() == 'true'
+    # Minimum seconds between error mails, errors between are coalesced
+    MAIL_INTERVAL = int(env.get('MAIL_INTERVAL', 300))
     SQLALCHEMY_DATABASE_URI = (
         'postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}/{PGDATABASE}'.format(
             PGUSER=env.get('PGUSER'), PGPASSWORD=env.get('PGPASSWORD'),
             PGHOST=env.get('PGHOST', 'localhost'),
             PGDATABASE=env.get('PGDATABASE')))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(env.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(env.get('DB_MAX_OVERFLOW', 10)),
+        # test connections on checkout, surviving database restarts
+        'pool_pre_ping': env.get(
+            'DB_POOL_PRE_PING', 'true').lower() == 'true',
+        'pool_recycle': int(env.get('DB_POOL_RECYCLE', 1800)),
+    }
+    # Optional read only replica, serving the read_replica views
+    SQLALCHEMY_BINDS = {
+        'replica': env['REPLICA_DATABASE_URI']} if env.get(
+        'REPLICA_DATABASE_URI') else {}
+
+    # Bounds on the process wide code and status id caches
+    CODE_CACHE_SIZE = int(env.get('CODE_CACHE_SIZE', 10000))
+    STATUS_CACHE_SIZE = int(env.get('STATUS_CACHE_SIZE', 1000))
+
+    # Records per transaction in bulk (NDJSON) uploads
+    BULK_COMMIT_SIZE = int(env.get('BULK_COMMIT_SIZE', 50))
+
+    # Queue uploads for the ingest-worker rather than processing in request
+    INGEST_ASYNC = env.get('INGEST_ASYNC', 'false').lower() == 'true'
+    INGEST_MAX_ATTEMPTS = int(env.get('INGEST_MAX_ATTEMPTS', 3))
+    # Seconds before the first retry of a failed job, doubling thereafter
+    INGEST_RETRY_BACKOFF = float(env.get('INGEST_RETRY_BACKOFF', 30))
+    # Seconds after which a running job is presumed lost with its worker
+    INGEST_STALE_TIMEOUT = int(env.get('INGEST_STALE_TIMEOUT', 600))
+
+    # Maximum MRNs per batch problem list request
+    PROBLEM_LIST_BATCH_LIMIT = int(env.get('PROBLEM_LIST_BATCH_LIMIT', 500))
+
+    # Change feed: maximum page, long poll wait and database poll interval.
+    # Each waiting consumer holds a worker, so only enable long polling
+    # with threaded or async workers to spare
+    CHANGE_FEED_LIMIT = int(env.get('CHANGE_FEED_LIMIT', 1000))
+    CHANGE_FEED_MAX_WAIT = float(env.get('CHANGE_FEED_MAX_WAIT', 0))
+    CHANGE_FEED_POLL_INTERVAL = float(env.get('CHANGE_FEED_POLL_INTERVAL', 1))
+    # Seconds changes are held back, longer than upload transactions last
+    CHANGE_FEED_SETTLE = float(env.get('CHANGE_FEED_SETTLE', 5))
+
+    # Directory of the compressed upload archive, disabled if unset
+    ARCHIVE_DIR = env.get('ARCHIVE_DIR')
+    # 'zstd' or 'gzip', defaults to zstd when zstandard is installed
+    ARCHIVE_COMPRESSION = env.get('ARCHIVE_COMPRESSION')
+
+    # Directory holding the CCDA documents named by clinical doc filepaths,
+    # served by the download view; unset disables downloads
+    CCDA_ROOT = env.get('CCDA_ROOT')
+    # Memory map documents for download, rather than reading
+    CCDA_MMAP = env.get('CCDA_MMAP', 'false').lower() == 'true'
+    # Hand downloads off to the front end server, either by X-Sendfile or
+    # to an nginx internal location aliasing CCDA_ROOT, e.g. '/ccda-files'
+    USE_X_SENDFILE = env.get('USE_X_SENDFILE', 'false').lower() == 'true'
+    CCDA_ACCEL_REDIRECT = env.get('CCDA_ACCEL_REDIRECT')
+
+    # Per request SQL and phase timing, see cdr.instrument
+    INSTRUMENTATION = env.get('INSTRUMENTATION', 'false').lower() == 'true'
+    # Directory shared by worker processes, for metrics across them all
+    METRICS_DIR = env.get('METRICS_DIR')
 
 
 class DefaultConfig(BaseConfig):
@@ -34,3 +99,7 @@ class TestConfig(BaseConfig):
 
     TEST_DATABASE_URI = 'sqlite:///' + TESTDB_PATH
     SQLALCHEMY_DATABASE_URI = TEST_DATABASE_URI
+    # SQLite file databases don't pool
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    SQLALCHEMY_BINDS = {}
+    CHANGE_FEED_SETTLE = 0
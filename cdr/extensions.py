@@ -1,3 +1,51 @@
-from flask_sqlalchemy import SQLAlchemy
+from functools import wraps
 
-sdb = SQLAlchemy()
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+
+# SQLALCHEMY_BINDS key of the optional read only replica
+REPLICA_BIND = 'replica'
+
+
+def replica_configured(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads of `read_replica` views to the replica
+
+    Flushes always go to the primary, as does everything outside of such
+    views (uploads, the ingest worker, CLI commands).
+
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get(
+                'cdr_read_replica'):
+            return get_state(self.app).db.get_engine(
+                self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_replica(view):
+    """Decorator routing the view's queries to the replica, if configured
+
+    Replicas lag the primary; clients needing to read their own writes
+    opt out with the `X-Read-Your-Writes: true` request header.
+
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        g.cdr_read_replica = replica_configured(current_app) and (
+            request.headers.get('X-Read-Your-Writes', '').lower() != 'true')
+        return view(*args, **kwargs)
+    return decorated
+
+
+sdb = RoutingSQLAlchemy()
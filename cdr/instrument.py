@@ -0,0 +1,125 @@
+"""Opt-in per request timing, enabled by the INSTRUMENTATION config
+
+Statements and their database time are accumulated from SQLAlchemy
+cursor events, named phases (parse, serialize) from `timer()`.  Each
+response carries the totals in a `Server-Timing` header, and per endpoint
+histograms are published with the other metrics.
+
+Phases may overlap - database time spent parsing counts toward both.
+
+"""
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import metrics
+
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class RequestTimings(object):
+    __slots__ = ('start', 'db', 'statements', 'phases')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.db = 0.0
+        self.statements = 0
+        self.phases = {}
+
+
+def current():
+    """Returns RequestTimings of the current request, None if not timed"""
+    if not has_request_context():
+        return None
+    return g.get('cdr_timings')
+
+
+@contextmanager
+def timer(phase):
+    """Add the time spent within the block to the request's `phase`"""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[phase] = timings.phases.get(phase, 0.0) + (
+            perf_counter() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, *args):
+    if current() is not None:
+        conn.info.setdefault('cdr_query_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, *args):
+    timings = current()
+    if timings is None or not conn.info.get('cdr_query_start'):
+        return
+    timings.db += perf_counter() - conn.info['cdr_query_start'].pop()
+    timings.statements += 1
+
+
+def handle_error(context):
+    # the failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        context.connection.info.pop('cdr_query_start', None)
+
+
+def listen():
+    """Register for cursor events on all engines, once per process"""
+    if not event.contains(
+            Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+
+
+def start():
+    """Begin timing the current request"""
+    g.cdr_timings = RequestTimings()
+
+
+def finish(response):
+    """Record timings of the current request, adding Server-Timing"""
+    timings = current()
+    if timings is None:
+        return response
+    total = perf_counter() - timings.start
+
+    entries = ['db;dur={:.1f};desc="{} statements"'.format(
+        timings.db * 1000, timings.statements)]
+    entries.extend(
+        '{};dur={:.1f}'.format(phase, elapsed * 1000)
+        for phase, elapsed in sorted(timings.phases.items()))
+    entries.append('total;dur={:.1f}'.format(total * 1000))
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    endpoint = request.endpoint or 'unmatched'
+    metrics.observe(
+        'cdr_request_duration_seconds', total, endpoint=endpoint)
+    metrics.observe(
+        'cdr_request_statements', timings.statements,
+        buckets=STATEMENT_BUCKETS, endpoint=endpoint)
+    metrics.observe(
+        'cdr_request_phase_seconds', timings.db, endpoint=endpoint,
+        phase='db')
+    for phase, elapsed in timings.phases.items():
+        metrics.observe(
+            'cdr_request_phase_seconds', elapsed, endpoint=endpoint,
+            phase=phase)
+    return response
+
+
+metrics.describe(
+    'cdr_request_duration_seconds', 'histogram', 'Request handling time')
+metrics.describe(
+    'cdr_request_statements', 'histogram', 'SQL statements per request')
+metrics.describe(
+    'cdr_request_phase_seconds', 'histogram',
+    'Request time spent in database, parse and serialize phases')
@@ -0,0 +1,200 @@
+"""Non-blocking logging pipeline
+
+Request threads only enqueue log records (QueueHandler); a background
+QueueListener thread feeds them to the slow sinks - the log file and
+error mail - so request latency never waits on disk or SMTP.
+
+Error mail is coalesced: at most one message per MAIL_INTERVAL seconds,
+carrying every error logged in the meantime.
+
+"""
+from datetime import datetime
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from logging.handlers import RotatingFileHandler, SMTPHandler
+import os
+import queue
+from threading import Timer
+import time
+import weakref
+
+TEXT_FORMAT = (
+    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, for log aggregation"""
+
+    def format(self, record):
+        created = datetime.utcfromtimestamp(record.created)
+        entry = {
+            'time': created.isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'path': record.pathname,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class CoalescingSMTPHandler(SMTPHandler):
+    """SMTPHandler sending at most one mail per `interval` seconds
+
+    Records arriving within the interval of the last mail are held, and
+    sent together once it passes.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.interval = kwargs.pop('interval', 300)
+        super(CoalescingSMTPHandler, self).__init__(*args, **kwargs)
+        self.pending = []
+        self.last_sent = None
+        self.timer = None
+
+    def emit(self, record):
+        # called holding the handler's lock, see `Handler.handle()`
+        self.pending.append(record)
+        wait = 0
+        if self.last_sent is not None:
+            wait = self.last_sent + self.interval - time.monotonic()
+        if wait <= 0:
+            self._send()
+        elif self.timer is None:
+            self.timer = Timer(wait, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self.timer = None
+            if self.pending:
+                self._send()
+        finally:
+            self.release()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
+        super(CoalescingSMTPHandler, self).close()
+
+    def getSubject(self, record):
+        subject = super(CoalescingSMTPHandler, self).getSubject(record)
+        count = getattr(record, 'coalesced', 1)
+        if count > 1:
+            subject = '{} ({} errors)'.format(subject, count)
+        return subject
+
+    def _send(self):
+        """Mail all pending records as one, via `SMTPHandler.emit()`"""
+        records, self.pending = self.pending, []
+        summary = logging.makeLogRecord(records[-1].__dict__)
+        summary.msg = '\n\n'.join(self.format(r) for r in records)
+        summary.args = None
+        summary.exc_info = summary.exc_text = None
+        summary.coalesced = len(records)
+        # the body is formatted already
+        formatter, self.formatter = self.formatter, None
+        try:
+            super(CoalescingSMTPHandler, self).emit(summary)
+        finally:
+            self.formatter = formatter
+        self.last_sent = time.monotonic()
+
+
+class ProcessFileHandler(RotatingFileHandler):
+    """Rotating file handler writing a file of its own per process
+
+    The filename `template` is formatted with the pid, and formatted
+    anew in forked children, e.g. gunicorn --preload workers.
+
+    """
+
+    def __init__(self, template, **kwargs):
+        self.template = template
+        super(ProcessFileHandler, self).__init__(
+            template.format(pid=os.getpid()), delay=True, **kwargs)
+
+    def after_fork(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.baseFilename = os.path.abspath(
+            self.template.format(pid=os.getpid()))
+
+
+# running pipelines, restarted in forked children
+_pipelines = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for pipeline in list(_pipelines):
+        pipeline._restart_in_child()
+
+
+# threads don't survive fork, e.g. gunicorn --preload
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LogPipeline(object):
+    """Queue fronted handlers, drained by a background listener thread"""
+
+    def __init__(self, handlers):
+        self.queue = queue.Queue(-1)
+        self.handler = QueueHandler(self.queue)
+        self.handlers = handlers
+        self.listener = None
+
+    def start(self):
+        self.listener = QueueListener(
+            self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        _pipelines.add(self)
+
+    def _restart_in_child(self):
+        if self.listener is None:
+            return
+        for handler in self.handlers:
+            if hasattr(handler, 'after_fork'):
+                handler.after_fork()
+        self.queue = self.handler.queue = queue.Queue(-1)
+        self.listener = QueueListener(
+            self.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Drain the queue and close handlers"""
+        _pipelines.discard(self)
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.close()
+
+
+def file_handler(config):
+    """Rotating info log, per process if LOG_PER_PROCESS
+
+    Workers sharing one file race on rotation.
+
+    """
+    kwargs = dict(maxBytes=100000, backupCount=10)
+    if config['LOG_PER_PROCESS']:
+        return ProcessFileHandler(
+            os.path.join(config['LOG_FOLDER'], 'info.{pid}.log'), **kwargs)
+    return RotatingFileHandler(
+        os.path.join(config['LOG_FOLDER'], 'info.log'), **kwargs)
+
+
+def formatter(config):
+    if config['LOG_FORMAT'] == 'json':
+        return JSONFormatter()
+    return logging.Formatter(TEXT_FORMAT)
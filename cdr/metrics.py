@@ -0,0 +1,239 @@
+"""Minimal metrics registry, rendered in the Prometheus text format
+
+Counters and histograms are held per process.  With a `directory`
+configured (METRICS_DIR), each process also writes them to its own file
+there, and scrapes sum those of all processes - so counters of the
+gunicorn workers, live and gone, neither split nor go backwards between
+scrapes.  Gauges derived from the database (queue depth et al) are
+registered as collectors, evaluated at scrape time.
+
+"""
+from bisect import bisect_left
+import glob
+import json
+import os
+from threading import Event, Lock, Thread
+import time
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+# Seconds between writes of a process's metrics to its file
+FLUSH_INTERVAL = 1
+
+_lock = Lock()
+_flush_lock = Lock()
+_descriptions = {}
+_counters = {}
+_histograms = {}
+_collectors = []
+_directory = None
+_flusher = None
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def merge(self, counts, sum, count):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += sum
+        self.count += count
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Generate (name, labels, value), buckets cumulative"""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', str(bound)),), cumulative
+        yield name + '_bucket', labels + (('le', '+Inf'),), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Flusher(Thread):
+    """Writes the process's metrics to its file, when changed"""
+
+    def __init__(self):
+        super(Flusher, self).__init__(daemon=True)
+        self.pid = os.getpid()
+        self.changed = Event()
+
+    def run(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            flush()
+            time.sleep(FLUSH_INTERVAL)
+
+
+def configure(directory):
+    """Share metrics across processes through files in directory
+
+    Files of exited processes are kept, so totals never drop; empty the
+    directory when redeploying to reset them.  None keeps metrics per
+    process.
+
+    """
+    global _directory
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    _directory = directory
+
+
+def _changed():
+    """Note metrics changed, to be flushed if configured"""
+    global _flusher
+    if not _directory:
+        return
+    # threads don't survive fork, start one per process
+    if _flusher is None or _flusher.pid != os.getpid():
+        _flusher = Flusher()
+        _flusher.start()
+    _flusher.changed.set()
+
+
+def flush():
+    """Write the process's counters and histograms to its file"""
+    directory = _directory
+    if not directory:
+        return
+    with _lock:
+        snapshot = {
+            'counters': [
+                [name, labels, value]
+                for (name, labels), value in _counters.items()],
+            'histograms': [
+                [name, labels, h.buckets, h.counts, h.sum, h.count]
+                for (name, labels), h in _histograms.items()]}
+    path = os.path.join(directory, 'metrics.{}.json'.format(os.getpid()))
+    with _flush_lock:
+        with open(path + '.tmp', 'w') as file:
+            json.dump(snapshot, file)
+        # replaced whole, so never read half written
+        os.replace(path + '.tmp', path)
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+def _merged():
+    """Returns (counters, histograms) summed over all process files"""
+    flush()
+    counters, histograms = {}, {}
+    for path in glob.glob(os.path.join(_directory, 'metrics.*.json')):
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot['counters']:
+            key = (name, _labels(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, counts, sum, count in snapshot[
+                'histograms']:
+            key = (name, _labels(labels))
+            if key not in histograms:
+                histograms[key] = Histogram(tuple(buckets))
+            histograms[key].merge(counts, sum, count)
+    return counters, histograms
+
+
+def describe(name, kind, help):
+    """Register metric `name` of `kind` (counter, gauge, histogram)"""
+    _descriptions[name] = (kind, help)
+
+
+def inc(name, amount=1, **labels):
+    """Increment counter `name`, for the given labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _changed()
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Add value to histogram `name`, for the given labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+    _changed()
+
+
+def collector(fn):
+    """Decorator registering fn, which generates (name, labels, value)"""
+    _collectors.append(fn)
+    return fn
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+        for k, v in labels) + '}'
+
+
+def _samples(counters, histograms):
+    found = [(name, labels, value)
+             for (name, labels), value in counters.items()]
+    for (name, labels), histogram in histograms.items():
+        found.extend(histogram.samples(name, labels))
+    return found
+
+
+def samples():
+    """Returns list of (name, labels tuple, value) for all metrics"""
+    if _directory:
+        found = _samples(*_merged())
+    else:
+        with _lock:
+            found = _samples(_counters, _histograms)
+    for fn in _collectors:
+        for name, labels, value in fn():
+            found.append((name, tuple(sorted(labels.items())), value))
+    return found
+
+
+def _family(name):
+    """Returns the described metric a sample name belongs to"""
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and _descriptions.get(
+                name[:-len(suffix)], ('',))[0] == 'histogram':
+            return name[:-len(suffix)]
+    return name
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format"""
+    by_family = {}
+    for i, (name, labels, value) in enumerate(samples()):
+        # sort on labels, bar histogram's `le` which keeps bucket order
+        by_family.setdefault(_family(name), []).append(
+            (tuple(l for l in labels if l[0] != 'le'), name, i, labels,
+             value))
+
+    lines = []
+    for family in sorted(by_family):
+        if family in _descriptions:
+            kind, help = _descriptions[family]
+            lines.append('# HELP {} {}'.format(family, help))
+            lines.append('# TYPE {} {}'.format(family, kind))
+        for _, name, _, labels, value in sorted(by_family[family]):
+            lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
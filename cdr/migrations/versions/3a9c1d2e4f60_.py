@@ -0,0 +1,26 @@
+"""Index codes by system name and code for keyset pagination
+
+Revision ID: 3a9c1d2e4f60
+Revises: d4e24d532aaa
+Create Date: 2026-10-18 09:12:40.118000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9c1d2e4f60'
+down_revision = 'd4e24d532aaa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_code_code_system_name_code', 'code',
+        ['code_system_name', 'code'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_code_code_system_name_code', table_name='code')
@@ -0,0 +1,41 @@
+"""Index codes for prefix lookup, observations by diagnosis and MRN
+
+Revision ID: 5b7e2f9a0c13
+Revises: 3a9c1d2e4f60
+Create Date: 2026-10-18 10:03:11.502000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2f9a0c13'
+down_revision = '3a9c1d2e4f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_code_code_system_code_pattern', 'code',
+        ['code_system', 'code'], unique=False,
+        postgresql_ops={'code': 'varchar_pattern_ops'})
+    op.drop_index('ix_observation_icd9_id', table_name='observation')
+    op.drop_index('ix_observation_icd10_id', table_name='observation')
+    op.create_index(
+        'ix_observation_icd9_id_doc_id', 'observation',
+        ['icd9_id', 'doc_id'], unique=False)
+    op.create_index(
+        'ix_observation_icd10_id_doc_id', 'observation',
+        ['icd10_id', 'doc_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_observation_icd10_id_doc_id', table_name='observation')
+    op.drop_index('ix_observation_icd9_id_doc_id', table_name='observation')
+    op.create_index(
+        'ix_observation_icd10_id', 'observation', ['icd10_id'], unique=False)
+    op.create_index(
+        'ix_observation_icd9_id', 'observation', ['icd9_id'], unique=False)
+    op.drop_index('ix_code_code_system_code_pattern', table_name='code')
@@ -0,0 +1,36 @@
+"""Add patient index and per code cohort bitmaps
+
+Revision ID: 7c1f4a8d2b95
+Revises: 5b7e2f9a0c13
+Create Date: 2026-10-18 11:20:47.913000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1f4a8d2b95'
+down_revision = '5b7e2f9a0c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'patient_index',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('mrn', sa.VARCHAR(length=255), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('mrn'))
+    op.create_table(
+        'code_cohort',
+        sa.Column('code_id', sa.Integer(), nullable=False),
+        sa.Column('bitmap', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['code_id'], ['code.id']),
+        sa.PrimaryKeyConstraint('code_id'))
+
+
+def downgrade():
+    op.drop_table('code_cohort')
+    op.drop_table('patient_index')
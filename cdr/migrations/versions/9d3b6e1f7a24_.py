@@ -0,0 +1,40 @@
+"""Add ingest job queue
+
+Revision ID: 9d3b6e1f7a24
+Revises: 7c1f4a8d2b95
+Create Date: 2026-10-18 13:02:19.264000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3b6e1f7a24'
+down_revision = '7c1f4a8d2b95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ingest_job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('mrn', sa.VARCHAR(length=255), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('state', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column(
+            'enqueued_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index(
+        'ix_ingest_job_state_id', 'ingest_job', ['state', 'id'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ingest_job_state_id', table_name='ingest_job')
+    op.drop_table('ingest_job')
@@ -0,0 +1,38 @@
+"""Add change log, recording the outcome of each upload for the change feed
+
+Revision ID: a4e8c2f6b913
+Revises: f3b9d1e7a046
+Create Date: 2026-10-18 19:27:51.604000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4e8c2f6b913'
+down_revision = 'f3b9d1e7a046'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'change_log',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('mrn', sa.VARCHAR(length=255), nullable=False),
+        sa.Column('action', sa.String(length=16), nullable=False),
+        sa.Column(
+            'generation_time', sa.DateTime(timezone=True), nullable=True),
+        sa.Column(
+            'receipt_time', sa.DateTime(timezone=True), nullable=False),
+        sa.Column(
+            'recorded_time', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index(
+        'ix_change_log_mrn_id', 'change_log', ['mrn', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_change_log_mrn_id', table_name='change_log')
+    op.drop_table('change_log')
@@ -0,0 +1,30 @@
+"""Persist observation entry and onset dates
+
+Previously declared without a Column, these were never stored.
+
+Revision ID: b2e8c4d9f031
+Revises: 9d3b6e1f7a24
+Create Date: 2026-10-18 14:15:52.730000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2e8c4d9f031'
+down_revision = '9d3b6e1f7a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('observation', sa.Column(
+        'entry_date', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('observation', sa.Column(
+        'onset_date', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('observation', 'onset_date')
+    op.drop_column('observation', 'entry_date')
@@ -0,0 +1,35 @@
+"""Add cohort deltas, appended by uploads in place of bitmap rewrites
+
+Revision ID: b7d3f5a9c182
+Revises: a4e8c2f6b913
+Create Date: 2026-10-18 21:05:12.338000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3f5a9c182'
+down_revision = 'a4e8c2f6b913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cohort_delta',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('code_id', sa.Integer(), nullable=False),
+        sa.Column('patient_id', sa.Integer(), nullable=False),
+        sa.Column('present', sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(['code_id'], ['code.id']),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index(
+        'ix_cohort_delta_code_id_id', 'cohort_delta', ['code_id', 'id'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_cohort_delta_code_id_id', table_name='cohort_delta')
+    op.drop_table('cohort_delta')
@@ -0,0 +1,25 @@
+"""Add content hash of the problem list to clinical docs
+
+Revision ID: c5f1a7e3d862
+Revises: b2e8c4d9f031
+Create Date: 2026-10-18 15:01:08.415000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f1a7e3d862'
+down_revision = 'b2e8c4d9f031'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('clinical_doc', sa.Column(
+        'content_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('clinical_doc', 'content_hash')
@@ -0,0 +1,29 @@
+"""Add retry backoff and per MRN index to ingest jobs
+
+Revision ID: c9e5a1d7f324
+Revises: b7d3f5a9c182
+Create Date: 2026-10-18 21:48:36.120000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e5a1d7f324'
+down_revision = 'b7d3f5a9c182'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('ingest_job', sa.Column(
+        'not_before', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(
+        'ix_ingest_job_mrn_state', 'ingest_job', ['mrn', 'state'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_ingest_job_mrn_state', table_name='ingest_job')
+    op.drop_column('ingest_job', 'not_before')
@@ -0,0 +1,30 @@
+"""Add materialized problem list snapshot to clinical docs
+
+Populate existing rows with `flask rebuild-snapshots`
+
+Revision ID: d8a2f6b4c179
+Revises: c5f1a7e3d862
+Create Date: 2026-10-18 15:48:33.027000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a2f6b4c179'
+down_revision = 'c5f1a7e3d862'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('clinical_doc', sa.Column(
+        'problem_list_snapshot',
+        sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'),
+        nullable=True))
+
+
+def downgrade():
+    op.drop_column('clinical_doc', 'problem_list_snapshot')
@@ -0,0 +1,25 @@
+"""Add modified time to clinical docs, for conditional requests
+
+Revision ID: e1c7b3a5d208
+Revises: d8a2f6b4c179
+Create Date: 2026-10-18 16:21:07.412000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1c7b3a5d208'
+down_revision = 'd8a2f6b4c179'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('clinical_doc', sa.Column(
+        'modified_time', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('clinical_doc', 'modified_time')
@@ -0,0 +1,25 @@
+"""Add archive key to clinical docs, referencing the archived upload
+
+Revision ID: f3b9d1e7a046
+Revises: e1c7b3a5d208
+Create Date: 2026-10-18 18:42:33.215000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9d1e7a046'
+down_revision = 'e1c7b3a5d208'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('clinical_doc', sa.Column(
+        'archive_key', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('clinical_doc', 'archive_key')
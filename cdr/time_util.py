@@ -2,9 +2,17 @@
 
 from datetime import datetime
 from dateutil.parser import parse as dateutilparse
+from functools import lru_cache
 import pytz
+import re
 from tzlocal import get_localzone
 
+# HL7 TS formats received in CCDAs: YYYYMMDD, YYYYMMDDHHMM[SS][.fff][+/-ZZZZ]
+HL7_TS = re.compile(
+    r'(\d{4})(\d{2})(\d{2})'
+    r'(?:(\d{2})(\d{2})(?:(\d{2})(?:\.(\d{1,6}))?)?)?'
+    r'(?:([+-])(\d{2})(\d{2}))?$')
+
 
 def utc_now():
     """ datetime does have a utcnow method, but it doesn't contain tz """
@@ -30,6 +38,43 @@ def datetime_w_tz(dt):
     return dt
 
 
+@lru_cache(maxsize=None)
+def local_zone():
+    """Local timezone, resolved once per process"""
+    return get_localzone()
+
+
+@lru_cache(maxsize=None)
+def fixed_offset(minutes):
+    return pytz.FixedOffset(minutes)
+
+
+def parse_hl7_ts(value):
+    """Parse HL7 TS value, returns None if not in a supported format
+
+    Avoids the generic (and slow) dateutil parser for the formats found
+    in every observation.
+
+    """
+    match = HL7_TS.match(value)
+    if not match:
+        return None
+    (year, month, day, hour, minute, second, fraction, sign, tz_hours,
+     tz_minutes) = match.groups()
+    try:
+        dt = datetime(
+            int(year), int(month), int(day), int(hour or 0),
+            int(minute or 0), int(second or 0),
+            int(fraction.ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return None
+    if sign:
+        offset = int(tz_hours) * 60 + int(tz_minutes)
+        dt = dt.replace(tzinfo=fixed_offset(
+            -offset if sign == '-' else offset))
+    return dt
+
+
 def parse_datetime(value):
     """We always want to store as UTZ; assume local tz if none provided"""
     if value is None:
@@ -37,10 +82,10 @@ def parse_datetime(value):
     if isinstance(value, datetime):
         dt = value
     else:
-        dt = dateutilparse(value)
+        dt = parse_hl7_ts(value) or dateutilparse(value)
     if not dt.tzinfo:
         # If no tz info or offset was defined, assume local
-        tz = get_localzone()
+        tz = local_zone()
         dt = tz.localize(dt, is_dst=None)
 
     # Store everything in UTC - convert if necessary
@@ -43,6 +43,129 @@ def initdb():
         sdb.create_all()
 
 
+@click.option(
+    '--processes', '-p', default=1, help='Number of worker processes')
+@click.option(
+    '--poll-interval', default=1.0, help='Seconds to wait on empty queue')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty')
+@app.cli.command('ingest-worker')
+def ingest_worker(processes, poll_interval, burst):
+    """Process uploads queued for asynchronous ingest"""
+    from cdr.api.queue import run_workers
+
+    run_workers(
+        app, processes=processes, poll_interval=poll_interval, burst=burst)
+
+
+@click.option(
+    '--all', 'rebuild_all', is_flag=True,
+    help='Rebuild every snapshot, not only those missing')
+@app.cli.command('rebuild-snapshots')
+def rebuild_snapshots(rebuild_all):
+    """Materialize the problem list snapshot for clinical docs"""
+    from cdr.api.models import ClinicalDoc
+
+    docs = ClinicalDoc.query.order_by(ClinicalDoc.mrn)
+    if not rebuild_all:
+        docs = docs.filter(ClinicalDoc.problem_list_snapshot.is_(None))
+    mrns = [doc.mrn for doc in docs.with_entities(ClinicalDoc.mrn)]
+    for count, mrn in enumerate(mrns, 1):
+        doc = ClinicalDoc.query.get(mrn)
+        doc.problem_list_snapshot = doc.problem_list()
+        if count % 100 == 0:
+            sdb.session.commit()
+            click.echo("rebuilt {} of {}".format(count, len(mrns)))
+    sdb.session.commit()
+    click.echo("rebuilt {} snapshots".format(len(mrns)))
+
+
+@click.option(
+    '--fold', is_flag=True,
+    help='Only fold the deltas appended by uploads into the bitmaps')
+@app.cli.command('rebuild-cohorts')
+def rebuild_cohorts(fold):
+    """Regenerate the per diagnosis patient bitmaps from observations
+
+    Run periodically with --fold, keeping the pending deltas applied on
+    every cohort query few.
+
+    """
+    from cdr.api.cohort import fold_cohorts, rebuild_cohorts
+
+    if fold:
+        count = fold_cohorts()
+        sdb.session.commit()
+        click.echo("folded {} deltas".format(count))
+        return
+    count = rebuild_cohorts()
+    sdb.session.commit()
+    click.echo("rebuilt {} cohorts".format(count))
+
+
+@click.option(
+    '--processes', '-p', default=os.cpu_count(),
+    help='Number of worker processes, defaults to one per core')
+@click.option(
+    '--batch-size', default=50, help='Patients per worker transaction')
+@click.option(
+    '--source', default='archive', show_default=True,
+    help='"archive" for the archived upload, else path of the JSON source '
+    'document, formatted with {mrn} and {filepath}')
+@click.option(
+    '--checkpoint', type=click.Path(dir_okay=False),
+    help='File recording completed MRNs, which are skipped on resume')
+@click.option(
+    '--dry-run', is_flag=True, help='Report differences, writing nothing')
+@click.argument('mrns', nargs=-1)
+@app.cli.command('reparse')
+def reparse(processes, batch_size, source, checkpoint, dry_run, mrns):
+    """Re-derive observations from stored source documents
+
+    All patients are reparsed unless MRNs are given.
+
+    """
+    import time
+    from cdr.api.models import ClinicalDoc
+    from cdr.api.reparse import Checkpoint, describe_problem
+    from cdr.api.reparse import reparse as run_reparse
+
+    if not mrns:
+        mrns = [mrn for mrn, in ClinicalDoc.query.with_entities(
+            ClinicalDoc.mrn).order_by(ClinicalDoc.mrn)]
+    checkpoint = Checkpoint(checkpoint) if checkpoint else None
+    if checkpoint:
+        completed = checkpoint.completed()
+        mrns = [mrn for mrn in mrns if mrn not in completed]
+
+    done = changed = failed = 0
+    start = time.time()
+    for results in run_reparse(
+            app, list(mrns), source=source, processes=processes,
+            batch_size=batch_size, dry_run=dry_run):
+        for result in results:
+            done += 1
+            if 'error' in result:
+                failed += 1
+                click.echo("{mrn}: failed {error}".format(**result), err=True)
+            elif result['added'] or result['removed']:
+                changed += 1
+                click.echo("{}: +{} -{}".format(
+                    result['mrn'], len(result['added']),
+                    len(result['removed'])))
+                if dry_run:
+                    for problem in result['added']:
+                        click.echo("  + " + describe_problem(problem))
+                    for problem in result['removed']:
+                        click.echo("  - " + describe_problem(problem))
+        if checkpoint and not dry_run:
+            checkpoint.record(
+                [r['mrn'] for r in results if 'error' not in r])
+        click.echo(
+            "{} of {} reparsed, {} changed, {} failed, {:.1f}/s".format(
+                done, len(mrns), changed, failed,
+                done / max(time.time() - start, 1e-6)), err=True)
+
+
 @click.option(
     '--config_key',
     '-c',
@@ -23,6 +23,7 @@ setup(
         'Flask-SQLAlchemy',
         'Flask-Script',
         'Flask-Testing',
+        'zstandard',
     ],
     test_suite='tests',
     classifiers=[
@@ -1,5 +1,6 @@
 import os
 import pytest
+from sqlalchemy import event
 
 from cdr import create_app
 from cdr.config import TestConfig, TESTDB_PATH
@@ -26,3 +27,22 @@ def client(request):
         os.unlink(TESTDB_PATH)
 
     request.addfinalizer(teardown_sdb)
+
+
+class StatementCounter(object):
+    """Context manager counting SQL statements issued on the engine"""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _increment(self, conn, cursor, statement, *args, **kwargs):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(_sdb.engine, 'before_cursor_execute', self._increment)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(_sdb.engine, 'before_cursor_execute', self._increment)
@@ -0,0 +1,187 @@
+import gzip
+import hashlib
+import json
+import os
+from flask import _app_ctx_stack
+import pytest
+
+from cdr.api import archive
+from cdr.api.models import ClinicalDoc
+from cdr.api.reparse import reparse
+from cdr.extensions import sdb
+from tests import client
+from tests.test_reparse import damage, load_upload
+
+
+def enable_archive(client, tmpdir):
+    client.application.config['ARCHIVE_DIR'] = str(tmpdir)
+    # tests compare against the gzip encoding, even with zstandard
+    client.application.config['ARCHIVE_COMPRESSION'] = 'gzip'
+
+
+def archived_files(tmpdir):
+    return sorted(
+        name for _, _, names in os.walk(str(tmpdir)) for name in names)
+
+
+def upload(client, mrn, body):
+    response = client.put(
+        '/patients/{}/ccda'.format(mrn), data=body,
+        content_type='application/json')
+    sdb.session.remove()
+    return response
+
+
+def test_archive_upload(client, tmpdir):
+    enable_archive(client, tmpdir)
+    body = json.dumps(load_upload()).encode('utf-8')
+    key = hashlib.sha256(body).hexdigest()
+    assert upload(client, 'abc1', body).json['message'] == 'upload ok'
+
+    doc = ClinicalDoc.query.get('abc1')
+    assert doc.archive_key == key
+    path, codec = archive.locate(key)
+    assert path == os.path.join(
+        str(tmpdir), key[:2], key[2:4], key + codec.suffix)
+    assert os.listdir(str(tmpdir.join('tmp'))) == []
+
+    response = client.get('/patients/abc1/ccda/archive')
+    assert response.status_code == 200
+    assert response.data == body
+    assert response.headers['ETag'] == '"{}"'.format(key)
+
+    response = client.get(
+        '/patients/abc1/ccda/archive',
+        headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == body
+
+    response = client.get(
+        '/patients/abc1/ccda/archive',
+        headers={'If-None-Match': '"{}"'.format(key)})
+    assert response.status_code == 304
+
+
+def test_archive_streamed_outside_app_context(client, tmpdir):
+    enable_archive(client, tmpdir)
+    body = json.dumps(load_upload()).encode('utf-8')
+    upload(client, 'abc1', body)
+
+    # the response is read once the request's contexts are popped
+    app_context = _app_ctx_stack.top
+    app_context.pop()
+    try:
+        response = client.get('/patients/abc1/ccda/archive')
+        assert response.status_code == 200
+        assert response.data == body
+    finally:
+        app_context.push()
+
+
+def test_archive_zstd(client, tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    client.application.config['ARCHIVE_DIR'] = str(tmpdir)
+    client.application.config['ARCHIVE_COMPRESSION'] = 'zstd'
+    body = json.dumps(load_upload()).encode('utf-8')
+    upload(client, 'abc1', body)
+    key = hashlib.sha256(body).hexdigest()
+    assert archived_files(tmpdir) == [key + '.json.zst']
+
+    assert client.get('/patients/abc1/ccda/archive').data == body
+    response = client.get(
+        '/patients/abc1/ccda/archive', headers={'Accept-Encoding': 'zstd'})
+    assert response.headers['Content-Encoding'] == 'zstd'
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(
+        response.data) == body
+
+
+def test_archive_dedupe(client, tmpdir):
+    enable_archive(client, tmpdir)
+    with client.application.test_request_context():
+        key = archive.store(b'{"a": 1}')
+        assert archive.store(b'{"a": 1}') == key
+        with archive.open_payload(key) as payload:
+            assert payload.read() == b'{"a": 1}'
+    assert archived_files(tmpdir) == [key + '.json.gz']
+
+
+def test_archive_referenced_only(client, tmpdir):
+    enable_archive(client, tmpdir)
+    data = load_upload()
+    body = json.dumps(data).encode('utf-8')
+    upload(client, 'abc1', body)
+    key = hashlib.sha256(body).hexdigest()
+
+    # obsolete and unchanged uploads leave nothing behind
+    data['problem_list']['section']['entry'].pop()
+    older = json.dumps(dict(data, effectiveTime='20100101000000-0800'))
+    assert upload(client, 'abc1', older.encode('utf-8')).json[
+        'message'] == 'obsolete'
+    assert upload(client, 'abc1', body).json['message'] == 'unchanged'
+    assert archived_files(tmpdir) == [key + '.json.gz']
+
+    # nor do superseded lines of a batch
+    lines = []
+    for effective_time in ('20300101000000-0800', '20310101000000-0800'):
+        data['effectiveTime'] = effective_time
+        data['mrn'] = 'abc2'
+        data['problem_list']['section']['entry'].pop()
+        lines.append(json.dumps(data).encode('utf-8'))
+    client.post('/ccda/batch', data=b'\n'.join(lines))
+    sdb.session.remove()
+    latest = hashlib.sha256(lines[-1]).hexdigest()
+    assert ClinicalDoc.query.get('abc2').archive_key == latest
+    assert archived_files(tmpdir) == sorted(
+        [key + '.json.gz', latest + '.json.gz'])
+
+
+def test_archive_after_commit(client, tmpdir, monkeypatch):
+    enable_archive(client, tmpdir)
+    data = load_upload()
+    data['mrn'] = 'abc1'
+
+    def fail():
+        raise RuntimeError("commit failed")
+    monkeypatch.setattr(sdb.session, 'commit', fail)
+    with pytest.raises(RuntimeError):
+        client.post('/ccda/batch', data=json.dumps(data)).data
+    with pytest.raises(RuntimeError):
+        upload(client, 'abc1', json.dumps(data).encode('utf-8'))
+    assert archived_files(tmpdir) == []
+
+
+def test_archive_invalid_upload(client, tmpdir):
+    enable_archive(client, tmpdir)
+    assert upload(client, 'abc1', b'{"filepath": ').status_code == 400
+    assert os.listdir(str(tmpdir.join('tmp'))) == []
+
+
+def test_archive_disabled(client):
+    body = json.dumps(load_upload()).encode('utf-8')
+    assert upload(client, 'abc1', body).json['message'] == 'upload ok'
+    assert ClinicalDoc.query.get('abc1').archive_key is None
+    assert client.get('/patients/abc1/ccda/archive').status_code == 404
+
+
+def test_archive_batch(client, tmpdir):
+    enable_archive(client, tmpdir)
+    data = load_upload()
+    data['mrn'] = 'abc1'
+    line = json.dumps(data).encode('utf-8')
+    response = client.post('/ccda/batch', data=line + b'\n')
+    assert json.loads(response.data)['message'] == 'upload ok'
+    sdb.session.remove()
+    assert ClinicalDoc.query.get('abc1').archive_key == hashlib.sha256(
+        line).hexdigest()
+
+
+def test_reparse_archive(client, tmpdir):
+    enable_archive(client, tmpdir)
+    body = json.dumps(load_upload()).encode('utf-8')
+    upload(client, 'abc1', body)
+    damage('abc1')
+
+    # the archive is the default source
+    results = [r for batch in reparse(
+        client.application, ['abc1']) for r in batch]
+    assert len(results[0]['added']) == 2
@@ -0,0 +1,59 @@
+import json
+import os
+
+from cdr.api import cache
+from cdr.api.cache import LRUCache
+from cdr.api.models import ClinicalDoc, Code, Observation
+from cdr.api.models import parse_problem_list
+from cdr.extensions import sdb
+from tests import client, StatementCounter
+
+
+def test_lru_eviction():
+    lru = LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1  # 'b' now least recently used
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert lru.get('c') == 3
+    assert lru.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1}
+
+
+def test_only_committed_ids_cached(client):
+    as_json = {
+        "_code": "25064002",
+        "_codeSystem": "2.16.840.1.113883.6.96",
+        "_codeSystemName": "SNOMED CT",
+        "_displayName": "Headache"}
+    key = (as_json['_code'], as_json['_codeSystem'])
+    code = Code.from_json(as_json).save()
+    assert cache.code_ids.get(key) is None
+    assert cache.code_ids.lookup(key) == code.id  # staged on session
+
+    sdb.session.rollback()
+    assert cache.code_ids.lookup(key) is None
+
+    code = Code.from_json(as_json).save()
+    sdb.session.commit()
+    assert cache.code_ids.get(key) == code.id
+
+
+def test_warm_cache_skips_lookups(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    doc = ClinicalDoc(mrn='abc123', filepath='/var/foo').save()
+    parse_problem_list(data['problem_list'], doc)
+    sdb.session.commit()
+
+    doc2 = ClinicalDoc(mrn='def456', filepath='/var/foo').save()
+    with StatementCounter() as counter:
+        parse_problem_list(data['problem_list'], doc2)
+    # no code or status is looked up, nor inserted
+    assert not [
+        statement for statement in counter.statements
+        if 'FROM code ' in statement or 'FROM status ' in statement
+        or 'INTO code ' in statement or 'INTO status ' in statement]
+    assert Observation.query.filter_by(doc_id=doc2.mrn).count() == 51
+    assert cache.stats()['code']['hits'] > 0
@@ -0,0 +1,116 @@
+import json
+import os
+import pytest
+
+from cdr.api.cohort import ExpressionException, decode, encode, evaluate
+from cdr.api.cohort import fold_cohorts, from_ids, members, popcount
+from cdr.api.cohort import page, rebuild_cohorts
+from cdr.api.models import ClinicalDoc, CodeCohort, CohortDelta
+from cdr.api.models import PatientIndex, parse_problem_list
+from cdr.extensions import sdb
+from tests import client
+
+
+def load(filename):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, filename), 'r') as json_file:
+        return json.load(json_file)
+
+
+def test_encoding():
+    sparse = from_ids([3, 100000])
+    assert encode(sparse)[:1] == b'A'
+    assert decode(encode(sparse)) == sparse
+    dense = from_ids(range(1, 1000, 3))
+    assert encode(dense)[:1] == b'B'
+    assert decode(encode(dense)) == dense
+    assert decode(encode(0)) == 0
+    assert list(members(dense, after=991)) == [994, 997]
+
+
+def test_evaluate():
+    leaves = {'a': from_ids([1, 2, 3]), 'b': from_ids([3, 4])}
+    universe = from_ids(range(1, 6))
+    expression = {'and': ['a', {'not': 'b'}]}
+    assert list(members(evaluate(expression, leaves.get, universe))) == [1, 2]
+    expression = {'or': ['a', 'b']}
+    assert popcount(evaluate(expression, leaves.get, universe)) == 4
+    with pytest.raises(ExpressionException):
+        evaluate({'xor': ['a', 'b']}, leaves.get, universe)
+    with pytest.raises(ExpressionException):
+        evaluate({'and': []}, leaves.get, universe)
+
+
+@pytest.fixture
+def patients(client):
+    problems = load('prob_list.json')['problem_list']
+    for mrn in ('mrn1', 'mrn2', 'mrn3'):
+        parse_problem_list(
+            problems, ClinicalDoc(mrn=mrn, filepath='/tmp/a').save())
+    parse_problem_list(
+        load('one_prob.json'), ClinicalDoc(mrn='mrn4', filepath='/a').save())
+    sdb.session.commit()
+    return client
+
+
+def test_cohort_endpoint(patients):
+    expression = {'or': ['icd10:E78*', 'icd10:D69.2']}
+    resp = patients.post('/cohorts', json={'expression': expression})
+    assert resp.status_code == 200
+    assert resp.json['count'] == 4
+    assert resp.json['patients'] == ['mrn1', 'mrn2', 'mrn3', 'mrn4']
+
+    expression = {'not': 'icd10:D69.2'}
+    resp = patients.post(
+        '/cohorts?limit=2', json={'expression': expression})
+    assert resp.json['count'] == 3
+    assert resp.json['patients'] == ['mrn1', 'mrn2']
+    resp = patients.post('/cohorts?limit=2&after={}'.format(
+        resp.headers['X-Next-Cursor']), json={'expression': expression})
+    assert resp.json['patients'] == ['mrn3']
+    assert 'X-Next-Cursor' not in resp.headers
+
+    resp = patients.post(
+        '/cohorts?count_only=true',
+        json={'expression': {'and': ['icd10:E78*', 'icd9:133.0']}})
+    assert resp.json == {'count': 3}
+
+    resp = patients.post('/cohorts', json={'expression': 'snomed:1'})
+    assert resp.status_code == 400
+
+
+def test_patient_id_gap(patients):
+    # sequences skip ids of rolled back inserts
+    sdb.session.add(PatientIndex(id=6, mrn='mrn6'))
+    sdb.session.commit()
+    resp = patients.post(
+        '/cohorts', json={'expression': {'not': 'icd10:D69.2'}})
+    assert resp.status_code == 200
+    assert resp.json['count'] == 4
+    assert resp.json['patients'] == ['mrn1', 'mrn2', 'mrn3', 'mrn6']
+    assert page(from_ids([1, 5]))[0] == ['mrn1']
+
+
+def test_replace_maintains_cohorts(patients):
+    doc = ClinicalDoc.query.get('mrn1')
+    parse_problem_list(load('one_prob.json'), doc, replace=True)
+    sdb.session.commit()
+
+    resp = patients.post(
+        '/cohorts', json={'expression': {'or': ['icd10:E78*']}})
+    assert resp.json['patients'] == ['mrn2', 'mrn3']
+    resp = patients.post('/cohorts', json={'expression': 'icd10:D69.2'})
+    assert resp.json['patients'] == ['mrn1', 'mrn4']
+
+    # uploads only append deltas, folded into the bitmaps later
+    assert CodeCohort.query.count() == 0
+    pending = CohortDelta.query.count()
+    assert fold_cohorts(batch_size=7) == pending
+    assert CohortDelta.query.count() == 0
+    resp = patients.post('/cohorts', json={'expression': 'icd10:D69.2'})
+    assert resp.json['patients'] == ['mrn1', 'mrn4']
+
+    incremental = {c.code_id: decode(c.bitmap) for c in CodeCohort.query}
+    rebuild_cohorts()
+    rebuilt = {c.code_id: decode(c.bitmap) for c in CodeCohort.query}
+    assert rebuilt == {k: v for k, v in incremental.items() if v}
@@ -0,0 +1,73 @@
+from cdr.api.models import ClinicalDoc
+from cdr.extensions import sdb
+from tests import client
+
+DOCUMENT = b'<ClinicalDocument>' + b'x' * 200000 + b'</ClinicalDocument>'
+
+
+def add_document(client, tmpdir, filepath='abc1.xml'):
+    client.application.config['CCDA_ROOT'] = str(tmpdir)
+    tmpdir.join('abc1.xml').write_binary(DOCUMENT)
+    sdb.session.add(ClinicalDoc(mrn='abc1', filepath=filepath))
+    sdb.session.commit()
+
+
+def test_download(client, tmpdir):
+    add_document(client, tmpdir)
+    response = client.get('/patients/abc1/ccda')
+    assert response.status_code == 200
+    assert response.data == DOCUMENT
+    assert response.mimetype == 'application/xml'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'private' in response.headers['Cache-Control']
+
+    response = client.get(
+        '/patients/abc1/ccda',
+        headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_download_range(client, tmpdir):
+    add_document(client, tmpdir, filepath=str(tmpdir.join('abc1.xml')))
+    for mmap in (False, True):
+        client.application.config['CCDA_MMAP'] = mmap
+        response = client.get(
+            '/patients/abc1/ccda', headers={'Range': 'bytes=1-17'})
+        assert response.status_code == 206
+        assert response.data == DOCUMENT[1:18]
+        assert response.headers['Content-Range'] == 'bytes 1-17/{}'.format(
+            len(DOCUMENT))
+
+        response = client.get('/patients/abc1/ccda')
+        assert response.data == DOCUMENT
+
+
+def test_download_offload(client, tmpdir):
+    add_document(client, tmpdir)
+    client.application.config['CCDA_ACCEL_REDIRECT'] = '/ccda-files/'
+    response = client.get(
+        '/patients/abc1/ccda', headers={'Range': 'bytes=1-17'})
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == '/ccda-files/abc1.xml'
+    assert 'private' in response.headers['Cache-Control']
+    assert response.data == b''
+
+    client.application.config['CCDA_ACCEL_REDIRECT'] = None
+    client.application.use_x_sendfile = True
+    response = client.get(
+        '/patients/abc1/ccda', headers={'Range': 'bytes=1-17'})
+    # ranges are left to the front end, along with the body
+    assert response.status_code == 200
+    assert 'Content-Range' not in response.headers
+    assert response.headers['Content-Length'] == str(len(DOCUMENT))
+    assert response.headers['X-Sendfile'] == str(tmpdir.join('abc1.xml'))
+    assert 'private' in response.headers['Cache-Control']
+
+
+def test_download_outside_root(client, tmpdir):
+    add_document(client, tmpdir.mkdir('root'), filepath='../abc1.xml')
+    tmpdir.join('abc1.xml').write_binary(DOCUMENT)
+    assert client.get('/patients/abc1/ccda').status_code == 404
+
+    client.application.config['CCDA_ROOT'] = None
+    assert client.get('/patients/abc1/ccda').status_code == 404
@@ -0,0 +1,84 @@
+import json
+import os
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from cdr.api.filters import compile_filter, filter_clause, filter_func
+from cdr.api.filters import prefix_clause
+from cdr.api.models import ClinicalDoc, Code, Observation
+from cdr.api.models import parse_problem_list
+from cdr.extensions import sdb
+from tests import client
+
+FILTERS = (
+    {'filter': {
+        'icd9': {'code': ['133.0', '296.2*', '296.3*', '300.4', '311.*']},
+        'icd10': {'code': ['E78.*', 'H21.239']}},
+     'status': {'value': {
+         'code': '55561003', 'code_system': '2.16.840.1.113883.6.96'}}},
+    {'filter': {'icd10': {'code': ['E78.*', 'H21.239']}}},
+    {'filter': {'icd10': {'code': ['e78.*']}}},
+    {'filter': {'icd9': {'code': ['*']}}},
+    {'filter': {'icd10': {'code_system_name': ['ICD-10*']}}},
+    {'filter': {'code': {'code_system_name': ['SNOMED CT']}}},
+    {'filter': {'icd9': {'display': ['Urinary frequency']}}},
+    {'filter': {'icd10': {'code': ['R35.0']}},
+     'status': {'value': {'display': 'Inactive'}}},
+    {'filter': {'status': {'status_code': ['complete*']}}},
+    {'filter': {'icd10': {'code': ['Z99.99']}}},
+    {'filter': {}},
+)
+
+
+@pytest.fixture
+def observations(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    doc = ClinicalDoc(mrn='abc123', filepath='/var/foo').save()
+    parse_problem_list(data['problem_list'], doc)
+    return Observation.eager_query().filter_by(doc_id=doc.mrn)
+
+
+@pytest.mark.parametrize('spec', FILTERS)
+def test_sql_matches_reference(observations, spec):
+    """SQL compiled filter selects the same as the python reference"""
+    filter_parameters = json.dumps(spec)
+    pass_filter = filter_func(filter_parameters)
+    expected = {obs.id for obs in observations if pass_filter(obs.to_json())}
+
+    clause = filter_clause(filter_parameters)
+    found = {obs.id for obs in observations.filter(clause)}
+    assert found == expected
+
+
+def test_no_filter(observations):
+    assert filter_clause(None) is None
+    assert filter_clause('') is None
+
+
+@pytest.mark.parametrize('spec', FILTERS)
+def test_compiled_matches_reference(observations, spec):
+    """Compiled filter evaluates as the python reference"""
+    filter_parameters = json.dumps(spec)
+    pass_filter = filter_func(filter_parameters)
+    compiled = compile_filter(filter_parameters)
+    for obs in observations:
+        problem = obs.to_json()
+        assert compiled.matches(problem) == pass_filter(problem)
+
+
+def test_compiled_filters_memoized():
+    filter_parameters = json.dumps(FILTERS[0])
+    compiled = compile_filter(filter_parameters)
+    assert compile_filter(filter_parameters) is compiled
+    assert compiled.clause() is compile_filter(filter_parameters).clause()
+    assert compile_filter(None) is None
+
+
+def test_prefix_clause_postgresql(client, monkeypatch):
+    # LIKE, so the varchar_pattern_ops index applies
+    monkeypatch.setattr(sdb.engine.dialect, 'name', 'postgresql')
+    clause = prefix_clause(Code.code, 'E78._%').compile(
+        dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+    assert str(clause) == "code.code LIKE 'E78./_/%%%%' ESCAPE '/'"
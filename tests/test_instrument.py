@@ -0,0 +1,127 @@
+import json
+import os
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from cdr import create_app, instrument, metrics
+from cdr.config import TestConfig, TESTDB_PATH
+from cdr.extensions import sdb as _sdb
+from tests import client
+
+
+class InstrumentedConfig(TestConfig):
+    INSTRUMENTATION = True
+
+
+@pytest.fixture
+def instrumented_client(request):
+    app = create_app(InstrumentedConfig)
+    if os.path.exists(TESTDB_PATH):
+        os.unlink(TESTDB_PATH)
+
+    with app.app_context():
+        _sdb.app = app
+        _sdb.create_all()
+        yield app.test_client()
+        _sdb.session.remove()
+        _sdb.drop_all()
+    os.unlink(TESTDB_PATH)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Metrics registered by the test are discarded after it"""
+    for name in ('_descriptions', '_counters', '_histograms'):
+        monkeypatch.setattr(metrics, name, dict(getattr(metrics, name)))
+
+
+def server_timing(response):
+    """Returns dict of Server-Timing entries: name -> (dur, desc)"""
+    timings = {}
+    for entry in response.headers['Server-Timing'].split(', '):
+        name, _, params = entry.partition(';')
+        params = dict(p.split('=', 1) for p in params.split(';'))
+        timings[name] = float(params['dur']), params.get('desc')
+    return timings
+
+
+def test_server_timing(instrumented_client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+
+    resp = instrumented_client.put('/patients/abc123/ccda', json=data)
+    timings = server_timing(resp)
+    assert {'db', 'parse', 'total'} <= set(timings)
+    assert timings['db'][1] != '"0 statements"'
+    assert timings['parse'][0] <= timings['total'][0]
+
+    resp = instrumented_client.get('/patients/abc123/problem_list')
+    timings = server_timing(resp)
+    assert timings['db'][1] == '"1 statements"'
+    assert 'serialize' in timings
+
+    rendered = instrumented_client.get('/metrics').data.decode('utf-8')
+    assert '# TYPE cdr_request_duration_seconds histogram' in rendered
+    assert ('cdr_request_statements_count{endpoint="api.get_problem_list"}'
+            in rendered)
+    assert ('cdr_request_phase_seconds_count{endpoint="api.upload_ccda",'
+            'phase="parse"}' in rendered)
+
+
+def test_uninstrumented(client):
+    resp = client.get('/test')
+    assert 'Server-Timing' not in resp.headers
+
+
+def test_histogram_render(client, registry):
+    metrics.describe('test_latency_seconds', 'histogram', 'Test latency')
+    for value in (0.2, 0.3, 3, 100):
+        metrics.observe(
+            'test_latency_seconds', value, buckets=(0.25, 1, 5),
+            endpoint='x')
+    lines = [l for l in metrics.render().splitlines()
+             if l.startswith('test_latency_seconds')]
+    assert lines == [
+        'test_latency_seconds_bucket{endpoint="x",le="0.25"} 1',
+        'test_latency_seconds_bucket{endpoint="x",le="1"} 2',
+        'test_latency_seconds_bucket{endpoint="x",le="5"} 3',
+        'test_latency_seconds_bucket{endpoint="x",le="+Inf"} 4',
+        'test_latency_seconds_count{endpoint="x"} 4',
+        'test_latency_seconds_sum{endpoint="x"} 103.5',
+    ]
+
+
+def test_registry_reset(client):
+    assert 'test_latency_seconds' not in metrics.render()
+
+
+def test_failed_statement_timing(instrumented_client):
+    with instrumented_client.application.test_request_context():
+        instrument.start()
+        connection = _sdb.session.connection()
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM missing')
+        assert not connection.info.get('cdr_query_start')
+        connection.execute('SELECT 1')
+        assert instrument.current().statements == 1
+        _sdb.session.remove()
+
+
+def test_metrics_across_processes(client, registry, tmpdir):
+    metrics.configure(str(tmpdir))
+    try:
+        metrics.describe('test_uploads_total', 'counter', 'Test uploads')
+        metrics.inc('test_uploads_total', result='ok')
+        metrics.observe('test_latency_seconds', 0.2, buckets=(1,))
+        # as written by another worker
+        tmpdir.join('metrics.1.json').write(json.dumps({
+            'counters': [['test_uploads_total', [['result', 'ok']], 2]],
+            'histograms': [
+                ['test_latency_seconds', [], [1], [0], 3, 1]]}))
+        rendered = metrics.render()
+    finally:
+        metrics.configure(None)
+    assert 'test_uploads_total{result="ok"} 3' in rendered
+    assert 'test_latency_seconds_bucket{le="1"} 1' in rendered
+    assert 'test_latency_seconds_count 2' in rendered
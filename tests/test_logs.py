@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import smtplib
+import threading
+
+from cdr.logs import CoalescingSMTPHandler, JSONFormatter, LogPipeline
+from cdr.logs import ProcessFileHandler
+
+
+class FakeSMTP(object):
+    sent = []
+
+    def __init__(self, host, port, timeout=None):
+        pass
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def quit(self):
+        pass
+
+
+class Collector(logging.Handler):
+    def __init__(self):
+        super(Collector, self).__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread().name)
+
+
+def record(msg, level=logging.ERROR):
+    return logging.LogRecord('cdr', level, __file__, 1, msg, None, None)
+
+
+def test_coalesced_mail(monkeypatch):
+    FakeSMTP.sent = []
+    monkeypatch.setattr(smtplib, 'SMTP', FakeSMTP)
+    handler = CoalescingSMTPHandler(
+        'localhost', 'cdr@example.com', ['admin@example.com'], 'failed',
+        interval=60)
+
+    for i in range(3):
+        handler.handle(record('error {}'.format(i)))
+    # first mail goes out, the rest held for the interval
+    assert len(FakeSMTP.sent) == 1
+    assert FakeSMTP.sent[0]['Subject'] == 'failed'
+
+    handler.close()
+    assert len(FakeSMTP.sent) == 2
+    assert FakeSMTP.sent[1]['Subject'] == 'failed (2 errors)'
+    body = FakeSMTP.sent[1].get_content()
+    assert 'error 1' in body and 'error 2' in body
+
+
+def test_json_formatter():
+    entry = json.loads(JSONFormatter().format(record('hi %s', logging.INFO)))
+    assert entry['level'] == 'INFO'
+    assert entry['message'] == 'hi %s'
+    assert entry['time'].endswith('Z')
+
+
+def test_pipeline():
+    collector = Collector()
+    pipeline = LogPipeline([collector])
+    logger = logging.getLogger('cdr.test_pipeline')
+    logger.addHandler(pipeline.handler)
+    pipeline.start()
+    try:
+        logger.warning("lazy %s", 'formatting')
+    finally:
+        pipeline.stop()
+        logger.removeHandler(pipeline.handler)
+
+    assert [r.getMessage() for r in collector.records] == [
+        'lazy formatting']
+    assert threading.current_thread().name not in collector.threads
+
+
+def test_per_process_files_after_fork(tmpdir, monkeypatch):
+    handler = ProcessFileHandler(str(tmpdir.join('info.{pid}.log')))
+    pipeline = LogPipeline([handler])
+    logger = logging.getLogger('cdr.test_fork')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(pipeline.handler)
+    # pipelines are restarted by the one module level fork hook
+    registered = []
+    monkeypatch.setattr(os, 'register_at_fork', registered.append)
+    pipeline.start()
+    assert registered == []
+    try:
+        logger.info("parent")
+        pid = os.fork()
+        if pid == 0:
+            logger.info("child")
+            pipeline.stop()
+            os._exit(0)
+        os.waitpid(pid, 0)
+    finally:
+        pipeline.stop()
+        logger.removeHandler(pipeline.handler)
+
+    parent = tmpdir.join('info.{}.log'.format(os.getpid())).read()
+    child = tmpdir.join('info.{}.log'.format(pid)).read()
+    assert 'parent' in parent and 'child' not in parent
+    assert 'child' in child and 'parent' not in child
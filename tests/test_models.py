@@ -5,12 +5,13 @@ import os
 import pytz
 from tzlocal import get_localzone
 
+from cdr.api.ingest import collect_problems
 from cdr.api.models import ClinicalDoc, Code, Observation, Status
 from cdr.api.models import parse_icds, parse_effective_time, parse_observation
 from cdr.api.models import parse_problem_list
 from cdr.extensions import sdb
 from cdr.time_util import utc_now
-from tests import client
+from tests import client, StatementCounter
 
 
 def test_code_parse(client):
@@ -313,3 +314,81 @@ def test_duplicate_clinical(client):
     # Resave older, confirm we keep the newer gen time
     doc = doc.save()
     assert doc == found
+
+
+def test_ingest_statement_count(client):
+    """Bulk ingest issues a constant number of statements"""
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    doc = ClinicalDoc(mrn='abc123', filepath='/var/foo').save()
+    with StatementCounter() as first:
+        parse_problem_list(data['problem_list'], doc)
+    assert first.count < 20
+
+    # Second pass finds all codes and statuses, and inserts none
+    doc2 = ClinicalDoc(mrn='def456', filepath='/var/foo').save()
+    with StatementCounter() as second:
+        parse_problem_list(data['problem_list'], doc2)
+    assert second.count < first.count
+    assert Observation.query.filter_by(doc_id=doc2.mrn).count() == 51
+    assert Code.query.filter_by(code_system_name='ICD-9-CM').count() == 33
+
+
+def test_collect_problems():
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'one_prob.json'), 'r') as json_file:
+        data = json.load(json_file)
+    codes, problems = collect_problems(data)
+    assert len(problems) == 1
+    assert codes[problems[0].icd10]['code'] == 'D69.2'
+    assert problems[0].status[0] == 'completed'
+
+
+def test_ingest_reuses_saved_codes(client):
+    """Codes saved through the ORM are found by the bulk resolver"""
+    as_json = {
+        "_code": "D69.2",
+        "_codeSystem": "2.16.840.1.113883.6.90",
+        "_codeSystemName": "ICD-10-CM",
+        "_displayName": "Other nonthrombocytopenic purpura"}
+    existing = Code.from_json(as_json).save()
+    sdb.session.flush()
+
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'one_prob.json'), 'r') as json_file:
+        data = json.load(json_file)
+    doc = ClinicalDoc(mrn='abc927', filepath='/var/food').save()
+    parse_problem_list(data, doc)
+    observation = Observation.query.filter_by(doc_id=doc.mrn).one()
+    assert observation.icd10_id == existing.id
+
+
+def test_replace_only_changes(client):
+    """Replacing with a near identical problem list touches only the diff"""
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    doc = ClinicalDoc(mrn='abc123', filepath='/var/foo').save()
+    parse_problem_list(data['problem_list'], doc)
+    original = {o.id for o in Observation.query.filter_by(doc_id=doc.mrn)}
+
+    with StatementCounter() as counter:
+        parse_problem_list(data['problem_list'], doc, replace=True)
+    assert not [s for s in counter.statements if s.startswith(
+        ('INSERT INTO observation', 'DELETE FROM observation'))]
+    assert original == {
+        o.id for o in Observation.query.filter_by(doc_id=doc.mrn)}
+
+    # change the onset of the first entry
+    entry = data['problem_list']['section']['entry'][0]
+    observation = entry['act']['_']['entryRelationship']['_'][
+        'observation']['_']
+    observation['effectiveTime']['low']['_value'] = '20160101000000-0400'
+    parse_problem_list(data['problem_list'], doc, replace=True)
+    current = {o.id for o in Observation.query.filter_by(doc_id=doc.mrn)}
+    assert len(current) == 51
+    assert len(original - current) == 1
+    assert len(current - original) == 1
+    changed = Observation.query.get((current - original).pop())
+    assert changed.onset_date == dateutilparse('20160101000000-0400')
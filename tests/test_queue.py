@@ -0,0 +1,102 @@
+import json
+import os
+
+from cdr.api.models import ClinicalDoc, IngestJob
+from cdr.api.queue import claim, requeue_stale, run, work
+from cdr.extensions import sdb
+from cdr.time_util import datetime_w_tz, utc_now
+from tests import client
+
+
+def test_async_upload(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    resp = client.put('/patients/abc123/ccda?async=true', json=data)
+    assert resp.status_code == 202
+    job_id = resp.json['job_id']
+    assert resp.headers['Location'].endswith('/jobs/{}'.format(job_id))
+    assert ClinicalDoc.query.get('abc123') is None
+
+    resp = client.get('/jobs/{}'.format(job_id))
+    assert resp.json['state'] == 'queued'
+    metrics = client.get('/metrics').data.decode('utf-8')
+    assert 'cdr_ingest_queue_depth 1' in metrics
+
+    assert work(burst=True) == 1
+    resp = client.get('/jobs/{}'.format(job_id))
+    assert resp.json['state'] == 'done'
+    assert resp.json['result'] == 'upload ok'
+    assert resp.json['attempts'] == 1
+    resp = client.get('/patients/abc123/problem_list')
+    assert 51 == len(resp.json['problem_list'])
+    metrics = client.get('/metrics').data.decode('utf-8')
+    assert 'cdr_ingest_queue_depth 0' in metrics
+    assert 'cdr_ingest_jobs{state="done"} 1' in metrics
+
+
+def test_async_validation(client):
+    resp = client.put(
+        '/patients/abc123/ccda?async=true', json={'filepath': '/tmp/a'})
+    assert resp.status_code == 400
+    assert IngestJob.query.count() == 0
+
+
+def test_failing_job_retried(client):
+    client.application.config['INGEST_MAX_ATTEMPTS'] = 2
+    client.application.config['INGEST_RETRY_BACKOFF'] = 0
+    data = {'filepath': '/tmp/a', 'effectiveTime': '20151023101908-0400',
+            'problem_list': {'section': {'code': {'_displayName': 'Other'}}}}
+    resp = client.put('/patients/abc123/ccda?async=true', json=data)
+    job_id = resp.json['job_id']
+
+    assert work(burst=True) == 2
+    job = IngestJob.query.get(job_id)
+    assert job.state == 'failed'
+    assert job.attempts == 2
+    assert 'ParseException' in job.result
+    assert ClinicalDoc.query.get('abc123') is None
+
+
+def test_failing_job_backs_off(client):
+    data = {'filepath': '/tmp/a', 'effectiveTime': '20151023101908-0400',
+            'problem_list': {'section': {'code': {'_displayName': 'Other'}}}}
+    resp = client.put('/patients/abc123/ccda?async=true', json=data)
+    job_id = resp.json['job_id']
+
+    # not retried until the backoff passes
+    assert work(burst=True) == 1
+    job = IngestJob.query.get(job_id)
+    assert job.state == 'queued'
+    assert datetime_w_tz(job.not_before) > utc_now()
+    assert claim() is None
+
+    job.not_before = utc_now()
+    sdb.session.commit()
+    assert claim().id == job_id
+
+
+def test_one_job_per_mrn(client):
+    jobs = [IngestJob(mrn=mrn, payload='{}') for mrn in (
+        'abc123', 'abc123', 'def456')]
+    sdb.session.add_all(jobs)
+    sdb.session.commit()
+    first, second, other = (job.id for job in jobs)
+
+    # the second job for abc123 waits on the first
+    assert claim().id == first
+    assert claim().id == other
+    assert claim() is None
+
+    client.application.config['INGEST_MAX_ATTEMPTS'] = 1
+    run(IngestJob.query.get(first))
+    assert claim().id == second
+
+
+def test_requeue_stale(client):
+    job = IngestJob(
+        mrn='abc123', payload='{}', state='running', started_at=utc_now())
+    sdb.session.add(job)
+    sdb.session.commit()
+    assert requeue_stale(timeout=-1) == 1
+    assert IngestJob.query.get(job.id).state == 'queued'
@@ -0,0 +1,107 @@
+import json
+import os
+
+from cdr.api.models import ChangeLog, ClinicalDoc, Observation
+from cdr.api.reparse import Checkpoint, describe_problem, reparse
+from cdr.extensions import sdb
+from tests import client
+
+# sources saved alongside, rather than archived
+SOURCE = '{filepath}'
+
+
+def load_upload():
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        return json.load(json_file)
+
+
+def save_sources(client, tmpdir, mrns):
+    """Upload and save the source of each patient, as `<mrn>.json`"""
+    data = load_upload()
+    for mrn in mrns:
+        data['filepath'] = str(tmpdir.join(mrn + '.json'))
+        with open(data['filepath'], 'w') as source:
+            json.dump(data, source)
+        client.put('/patients/{}/ccda'.format(mrn), json=data)
+
+
+def damage(mrn):
+    """Drop a couple of the patient's observations, as a parser bug would"""
+    ids = [id for id, in sdb.session.query(Observation.id).filter_by(
+        doc_id=mrn).order_by(Observation.id).limit(2)]
+    Observation.query.filter(Observation.id.in_(ids)).delete(
+        synchronize_session=False)
+    doc = ClinicalDoc.query.get(mrn)
+    doc.problem_list_snapshot = doc.problem_list()
+    sdb.session.commit()
+
+
+def test_reparse(client, tmpdir):
+    mrns = ['abc1', 'abc2', 'abc3']
+    save_sources(client, tmpdir, mrns)
+    damage('abc2')
+    assert Observation.query.filter_by(doc_id='abc2').count() == 49
+
+    # dry run reports, without writing
+    results = [r for batch in reparse(
+        client.application, mrns, source=SOURCE, batch_size=2,
+        dry_run=True)
+        for r in batch]
+    assert [(r['mrn'], len(r['added']), len(r['removed']))
+            for r in results] == [('abc1', 0, 0), ('abc2', 2, 0),
+                                  ('abc3', 0, 0)]
+    assert describe_problem(results[1]['added'][0])
+    assert Observation.query.filter_by(doc_id='abc2').count() == 49
+
+    results = [r for batch in reparse(
+        client.application, mrns, source=SOURCE)
+        for r in batch]
+    assert len(results[1]['added']) == 2
+    assert Observation.query.filter_by(doc_id='abc2').count() == 51
+    doc = ClinicalDoc.query.get('abc2')
+    assert len(doc.problem_list_snapshot) == 51
+
+    # only the changed patient is announced on the change feed
+    assert [(c.mrn, c.action) for c in ChangeLog.query.filter_by(
+        action='reparsed')] == [('abc2', 'reparsed')]
+
+
+def test_reparse_errors(client, tmpdir):
+    save_sources(client, tmpdir, ['abc1', 'abc2'])
+    damage('abc1')
+    os.unlink(str(tmpdir.join('abc2.json')))
+
+    results = [r for batch in reparse(
+        client.application, ['abc1', 'abc2', 'missing'], source=SOURCE)
+        for r in batch]
+    assert [r['mrn'] for r in results] == ['abc1', 'abc2', 'missing']
+    assert len(results[0]['added']) == 2
+    assert 'FileNotFoundError' in results[1]['error']
+    assert 'no clinical doc' in results[2]['error']
+    assert Observation.query.filter_by(doc_id='abc1').count() == 51
+
+
+def test_checkpoint(tmpdir):
+    checkpoint = Checkpoint(str(tmpdir.join('checkpoint')))
+    assert checkpoint.completed() == set()
+    checkpoint.record(['abc1', 'abc2'])
+    checkpoint.record(['abc3'])
+    assert checkpoint.completed() == {'abc1', 'abc2', 'abc3'}
+
+
+def test_reparse_pool(client, tmpdir):
+    mrns = ['abc{}'.format(i) for i in range(4)]
+    save_sources(client, tmpdir, mrns)
+    for mrn in mrns:
+        damage(mrn)
+
+    results = [r for batch in reparse(
+        client.application, mrns, source=SOURCE, processes=2,
+        batch_size=1)
+        for r in batch]
+    assert sorted(r['mrn'] for r in results) == mrns
+    assert all(len(r['added']) == 2 for r in results)
+    sdb.session.remove()
+    for mrn in mrns:
+        assert Observation.query.filter_by(doc_id=mrn).count() == 51
@@ -0,0 +1,89 @@
+import json
+import os
+import pytest
+import shutil
+
+from cdr import create_app
+from cdr.config import TestConfig, TESTDB_PATH
+from cdr.extensions import REPLICA_BIND, sdb as _sdb
+
+REPLICA_PATH = '/tmp/cdr_test_replica.db'
+
+
+class ReplicaConfig(TestConfig):
+    SQLALCHEMY_BINDS = {REPLICA_BIND: 'sqlite:///' + REPLICA_PATH}
+
+
+@pytest.fixture
+def replica_client(request):
+    app = create_app(ReplicaConfig)
+    for path in (TESTDB_PATH, REPLICA_PATH):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    with app.app_context():
+        _sdb.app = app
+        _sdb.create_all()
+        _sdb.Model.metadata.create_all(
+            bind=_sdb.get_engine(app, bind=REPLICA_BIND))
+        yield app.test_client()
+        _sdb.session.remove()
+        _sdb.drop_all()
+    for path in (TESTDB_PATH, REPLICA_PATH):
+        os.unlink(path)
+
+
+def replicate():
+    """Bring the replica up to date with the primary"""
+    _sdb.session.remove()
+    _sdb.get_engine(bind=REPLICA_BIND).dispose()
+    shutil.copyfile(TESTDB_PATH, REPLICA_PATH)
+
+
+def upload(client, filepath, effective_time, problems='one_prob.json'):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, problems), 'r') as json_file:
+        problem_list = json.load(json_file)
+    # prob_list.json holds an upload, the others just the problem list
+    problem_list = problem_list.get('problem_list', problem_list)
+    resp = client.put('/patients/abc123/ccda', json={
+        'filepath': filepath, 'effectiveTime': effective_time,
+        'problem_list': problem_list})
+    assert resp.json['message'] == 'upload ok'
+    _sdb.session.remove()
+
+
+def problem_list(client, consistent=False):
+    headers = {'X-Read-Your-Writes': 'true'} if consistent else {}
+    resp = client.get('/patients/abc123/problem_list', headers=headers)
+    # as at the end of a request, objects read from one database mustn't
+    # linger in the identity map for the next
+    _sdb.session.remove()
+    return resp
+
+
+def test_reads_from_replica(replica_client):
+    upload(replica_client, '/tmp/first', '20151023101908-0400')
+
+    # not yet replicated
+    assert problem_list(replica_client).status_code == 404
+    assert problem_list(replica_client, consistent=True).status_code == 200
+
+    replicate()
+    upload(
+        replica_client, '/tmp/second', '20161023101908-0400',
+        problems='prob_list.json')
+    assert len(problem_list(replica_client).json['problem_list']) == 1
+    assert len(problem_list(
+        replica_client, consistent=True).json['problem_list']) == 51
+
+    replicate()
+    assert len(problem_list(replica_client).json['problem_list']) == 51
+
+
+def test_writes_to_primary(replica_client):
+    upload(replica_client, '/tmp/first', '20151023101908-0400')
+    replica = _sdb.get_engine(bind=REPLICA_BIND)
+    assert replica.execute('SELECT count(*) FROM clinical_doc').scalar() == 0
+    assert _sdb.engine.execute(
+        'SELECT count(*) FROM clinical_doc').scalar() == 1
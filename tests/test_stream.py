@@ -0,0 +1,85 @@
+from io import BytesIO
+import json
+import os
+import pytest
+
+from cdr.api.ingest import collect_problems, content_hash
+from cdr.api.stream import read_upload
+from tests import client
+
+
+def load(filename):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, filename), 'r') as json_file:
+        return json.load(json_file)
+
+
+def assert_equivalent(data, chunk_size):
+    streamed = read_upload(
+        BytesIO(json.dumps(data, ensure_ascii=False).encode('utf-8')),
+        chunk_size=chunk_size)
+    problem_list = streamed.pop('problem_list')
+    expected = dict(data)
+    assert streamed == {
+        k: v for k, v in expected.items() if k != 'problem_list'}
+    assert collect_problems(problem_list) == collect_problems(
+        data['problem_list'])
+    assert content_hash(problem_list) == content_hash(data['problem_list'])
+    return problem_list
+
+
+@pytest.mark.parametrize('chunk_size', (1, 7, 4096))
+def test_stream_equivalence(chunk_size):
+    problem_list = assert_equivalent(load('prob_list.json'), chunk_size)
+    assert len(problem_list.problems) == 51
+    assert problem_list['section']['code']['_displayName'] == 'Problem List'
+    assert 'entry' not in problem_list['section']
+
+
+def test_single_entry():
+    data = {
+        'filepath': '/tmp/one', 'effectiveTime': '20151023101908-0400',
+        'problem_list': load('one_prob.json')}
+    problem_list = assert_equivalent(data, chunk_size=5)
+    assert len(problem_list.problems) == 1
+
+
+def test_multibyte_split():
+    data = load('prob_list.json')
+    entry = data['problem_list']['section']['entry'][0]
+    observation = entry['act']['_']['entryRelationship']['_']['observation']
+    translation = observation['_']['value']['_']['translation'][0]
+    translation['_displayName'] = 'Purpura é–\U0001f600'
+    problem_list = assert_equivalent(data, chunk_size=1)
+    assert 'Purpura é–\U0001f600' in [
+        c['display'] for c in problem_list.codes.values()]
+
+
+@pytest.mark.parametrize('body', (
+    b'',
+    b'[]',
+    b'{"filepath": "/tmp/x",',
+    b'{"problem_list": {"section": {"entry": [{"act": ',
+    b'{"filepath": "/tmp/x"} trailing',
+    b'{"problem_list": {"section": {"code": {"_displayName": "Allergies"}, '
+    b'"entry": []}}}',
+))
+def test_malformed(body):
+    with pytest.raises(ValueError):
+        read_upload(BytesIO(body), chunk_size=4)
+
+
+def test_empty_problem_list(client):
+    problem_list = read_upload(
+        BytesIO(b'{"problem_list": {}}'), chunk_size=3)['problem_list']
+    assert not problem_list
+    assert content_hash(problem_list) == content_hash({})
+
+    resp = client.put('/patients/abc1/ccda', json={
+        'filepath': '/tmp/x', 'effectiveTime': '20151023101908-0400',
+        'problem_list': {}})
+    assert resp.json['message'] == 'upload ok'
+    resp = client.put('/patients/abc2/ccda', json={
+        'filepath': '/tmp/x', 'effectiveTime': '20151023101908-0400',
+        'problem_list': {'section': {'code': {'_displayName': 'Allergies'}}}})
+    assert resp.status_code == 400
@@ -0,0 +1,42 @@
+from dateutil.parser import parse as dateutilparse
+import pytest
+import pytz
+
+from cdr.time_util import local_zone, parse_datetime, parse_hl7_ts
+
+
+@pytest.mark.parametrize('value', (
+    '20151023',
+    '201510231019',
+    '20151023101908',
+    '20151023101908-0400',
+    '20151106101736+0530',
+    '201510231019-0400',
+))
+def test_hl7_matches_dateutil(value):
+    expected = dateutilparse(value)
+    if not expected.tzinfo:
+        expected = local_zone().localize(expected, is_dst=None)
+    assert parse_datetime(value) == expected.astimezone(pytz.UTC)
+
+
+def test_hl7_fraction():
+    # beyond dateutil, which fails on HL7 fractional seconds
+    dt = parse_datetime('20151023101908.25-0400')
+    assert dt == parse_datetime('20151023141908+0000').replace(
+        microsecond=250000)
+
+
+@pytest.mark.parametrize('value', (
+    '2015-10-23T10:19:08-04:00',
+    '20151323',
+    '2015102310',
+    'Oct 23 2015',
+))
+def test_hl7_fallback(value):
+    assert parse_hl7_ts(value) is None
+
+
+def test_fallback_parses():
+    assert parse_datetime('2015-10-23T10:19:08-04:00') == parse_datetime(
+        '20151023101908-0400')
@@ -7,10 +7,12 @@ import pytz
 import time
 import urllib.parse
 
+from cdr import metrics
 from cdr.api.models import ClinicalDoc
 from cdr.api.models import parse_problem_list
+from cdr.extensions import sdb
 from cdr.time_util import utc_now
-from tests import client
+from tests import client, StatementCounter
 
 
 def test_upload(client):
@@ -162,3 +164,378 @@ def test_dx_views(client):
     data = resp.json
     assert len(data['patients']) == 2
     assert set(data['patients'].keys()) == set(['abc123', 'diagnosis'])
+
+
+def test_problem_list_statement_count(client):
+    """Statement count independent of the problem list length"""
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'one_prob.json'), 'r') as json_file:
+        one = json.load(json_file)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        many = json.load(json_file)
+    parse_problem_list(one, ClinicalDoc(mrn='one', filepath='/a').save())
+    parse_problem_list(
+        many['problem_list'], ClinicalDoc(mrn='many', filepath='/b').save())
+    # bypass the snapshots, exercising the query
+    ClinicalDoc.query.update({'problem_list_snapshot': None})
+    sdb.session.commit()
+    sdb.session.expunge_all()
+
+    with StatementCounter() as short:
+        resp = client.get('/patients/one/problem_list')
+    assert len(resp.json['problem_list']) == 1
+
+    sdb.session.expunge_all()
+    with StatementCounter() as long:
+        resp = client.get('/patients/many/problem_list')
+    assert len(resp.json['problem_list']) == 51
+    assert 'value' in resp.json['problem_list'][0]['status']
+    assert short.count == long.count <= 2
+
+
+def test_codes_pagination(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    parse_problem_list(
+        data['problem_list'], ClinicalDoc(mrn='abc123', filepath='/a').save())
+
+    everything = client.get('/codes/icd9').json['codes']
+    paged = []
+    url = '/codes/icd9?limit=10'
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert len(resp.json['codes']) <= 10
+        paged.extend(resp.json['codes'])
+        url = resp.headers.get('Link', '').split(';')[0].strip('<>')
+        if url:
+            assert resp.headers['X-Next-Cursor'] == paged[-1]['code']
+    assert 33 == len(paged)
+    assert sorted(c['code'] for c in everything) == [
+        c['code'] for c in paged]
+
+    resp = client.get('/codes/icd9?limit=0')
+    assert resp.status_code == 400
+
+
+def test_codes_streamed(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    parse_problem_list(
+        data['problem_list'], ClinicalDoc(mrn='abc123', filepath='/a').save())
+
+    resp = client.get('/codes/icd10?stream=true')
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert 32 == len(json.loads(resp.data)['codes'])
+
+    resp = client.get('/codes/icd10?stream=true&limit=30')
+    assert 30 == len(json.loads(resp.data)['codes'])
+    assert 'stream=true' in resp.headers['Link']
+    cursor = resp.headers['X-Next-Cursor']
+    resp = client.get('/codes/icd10?stream=true&limit=30&after=' + cursor)
+    assert 2 == len(json.loads(resp.data)['codes'])
+    assert 'X-Next-Cursor' not in resp.headers
+
+
+def test_dx_cohort(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    for mrn in ('mrn3', 'mrn1', 'mrn2'):
+        parse_problem_list(
+            data['problem_list'],
+            ClinicalDoc(mrn=mrn, filepath='/tmp/whatever').save())
+
+    resp = client.get('/diagnosis/icd10/E78*/patients')
+    assert resp.status_code == 200
+    assert set(resp.json['patients']) == {'mrn1', 'mrn2', 'mrn3'}
+    assert all(
+        d['code'].startswith('E78') for d in resp.json['diagnoses'])
+
+    resp = client.get('/diagnosis/icd10/E78*/patients?count_only=true')
+    assert resp.json['count'] == 3
+
+    resp = client.get('/diagnosis/icd9/133.0/patients?limit=2')
+    assert set(resp.json['patients']) == {'mrn1', 'mrn2', 'diagnosis'}
+    assert resp.headers['X-Next-Cursor'] == 'mrn2'
+    resp = client.get(resp.headers['Link'].split(';')[0].strip('<>'))
+    assert set(resp.json['patients']) == {'mrn3', 'diagnosis'}
+    assert 'Link' not in resp.headers
+
+    # prefixes match exactly, as would str.startswith
+    assert client.get('/diagnosis/icd10/e78*/patients').status_code == 404
+    resp = client.get('/diagnosis/icd10/E78.*/patients')
+    assert resp.json['diagnoses']
+    assert all(
+        d['code'].startswith('E78.') for d in resp.json['diagnoses'])
+
+    # codes are restricted to the requested system
+    assert client.get('/diagnosis/icd9/E78*/patients').status_code == 404
+    assert client.get('/diagnosis/snomed/1/patients').status_code == 400
+
+
+def uploads_counted(result):
+    return metrics._counters.get(
+        ('cdr_uploads_total', (('result', result),)), 0)
+
+
+def test_batch_upload(client):
+    client.application.config['BULK_COMMIT_SIZE'] = 2
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    with open(os.path.join(here, 'one_prob.json'), 'r') as json_file:
+        one = json.load(json_file)
+    records = [
+        dict(data, mrn='mrn1'),
+        dict(filepath='/tmp/a', effectiveTime='20151023101908-0400',
+             mrn='mrn2', problem_list={'section': {'code': {
+                 '_displayName': 'Not a problem list'}}}),
+        dict(data, mrn='mrn3'),
+        dict(data, mrn='mrn1', effectiveTime='20101023101908-0400',
+             problem_list=one),
+    ]
+    body = '\n'.join(json.dumps(r) for r in records)
+    body += '\n{not json\n'
+    counted = uploads_counted('upload ok')
+    resp = client.post(
+        '/ccda/batch', data=body, content_type='application/x-ndjson')
+    assert resp.status_code == 200
+    results = [json.loads(line) for line in resp.data.splitlines()]
+    assert [r['line'] for r in results] == [1, 2, 3, 4, 5]
+    assert results[0]['message'] == 'upload ok'
+    assert 'ParseException' in results[1]['error']
+    assert results[2]['message'] == 'upload ok'
+    assert results[3]['message'] == 'obsolete'
+    assert 'error' in results[4]
+    # mrn1 is replayed after mrn2 fails, but counted once
+    assert uploads_counted('upload ok') == counted + 2
+
+    # mrn1 committed despite the failure of mrn2 in the same group
+    assert ClinicalDoc.query.get('mrn1')
+    assert ClinicalDoc.query.get('mrn2') is None
+    resp = client.get('/patients/mrn3/problem_list')
+    assert 51 == len(resp.json['problem_list'])
+
+
+def test_unchanged_upload(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    resp = client.put('/patients/abc123/ccda', json=data)
+    assert resp.json['message'] == 'upload ok'
+
+    # same content, even w/o an effectiveTime, short circuits
+    del data['effectiveTime']
+    with StatementCounter() as counter:
+        resp = client.put('/patients/abc123/ccda', json=data)
+    assert resp.json['message'] == 'unchanged'
+    assert not [s for s in counter.statements if 'observation' in s]
+    metrics = client.get('/metrics').data.decode('utf-8')
+    assert 'cdr_uploads_total{result="unchanged"}' in metrics
+
+    # key order and whitespace don't matter
+    reordered = json.loads(json.dumps(data, sort_keys=True, indent=3))
+    resp = client.put('/patients/abc123/ccda', json=reordered)
+    assert resp.json['message'] == 'unchanged'
+
+
+def test_newer_identical_upload(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    resp = client.put('/patients/abc123/ccda', json=data)
+    assert resp.json['message'] == 'upload ok'
+
+    # a newer document with the same problem list updates the doc only
+    newer = dict(
+        data, effectiveTime='20300101000000-0800', filepath='/tmp/newer')
+    resp = client.put('/patients/abc123/ccda', json=newer)
+    assert resp.json['message'] == 'unchanged'
+    sdb.session.remove()
+    doc = ClinicalDoc.query.get('abc123')
+    assert doc.generation_time.year == 2030
+    assert doc.filepath == '/tmp/newer'
+
+    # so an older document with a different problem list stays obsolete
+    data['problem_list']['section']['entry'].pop()
+    older = dict(data, effectiveTime='20200101000000-0800')
+    resp = client.put('/patients/abc123/ccda', json=older)
+    assert resp.json['message'] == 'obsolete'
+    sdb.session.remove()
+    doc = ClinicalDoc.query.get('abc123')
+    assert doc.filepath == '/tmp/newer'
+    resp = client.get('/patients/abc123/problem_list')
+    assert len(resp.json['problem_list']) == 51
+
+
+def test_problem_list_snapshot(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    client.put('/patients/abc123/ccda', json=data)
+    doc = ClinicalDoc.query.get('abc123')
+    assert 51 == len(doc.problem_list_snapshot)
+    assert doc.problem_list_snapshot == doc.problem_list()
+
+    sdb.session.expunge_all()
+    with StatementCounter() as counter:
+        resp = client.get('/patients/abc123/problem_list')
+    assert counter.count == 1
+    assert resp.json['problem_list'] == doc.problem_list()
+
+    # served from the query in the absence of a snapshot
+    ClinicalDoc.query.update({'problem_list_snapshot': None})
+    sdb.session.commit()
+    resp = client.get('/patients/abc123/problem_list')
+    assert resp.json['problem_list'] == doc.problem_list()
+
+
+def test_conditional_problem_list(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    client.put('/patients/abc123/ccda', json=data)
+
+    resp = client.get('/patients/abc123/problem_list')
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+
+    sdb.session.expunge_all()
+    with StatementCounter() as counter:
+        resp = client.get(
+            '/patients/abc123/problem_list',
+            headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert counter.count == 1
+    assert not resp.data
+
+    resp = client.get(
+        '/patients/abc123/problem_list',
+        headers={'If-Modified-Since': last_modified})
+    assert resp.status_code == 304
+
+    # filtered views carry their own validator
+    filter_by = {'filter': {'icd10': {'code': ['E78.*']}}}
+    resp = client.get(
+        '/patients/abc123/problem_list?filter={}'.format(
+            urllib.parse.quote(json.dumps(filter_by))),
+        headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+    # a newer upload invalidates
+    data['effectiveTime'] = '20351023101908-0400'
+    data['problem_list']['section']['entry'].pop()
+    assert client.put(
+        '/patients/abc123/ccda', json=data).json['message'] == 'upload ok'
+    resp = client.get(
+        '/patients/abc123/problem_list', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_conditional_file_info(client):
+    ClinicalDoc(mrn='abc123', filepath='/tmp/abc123').save()
+    resp = client.get('/patients/abc123/ccda/file_info')
+    etag = resp.headers['ETag']
+
+    resp = client.get(
+        '/patients/abc123/ccda/file_info', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    doc = ClinicalDoc.query.get('abc123')
+    doc.filepath = '/tmp/moved'
+    sdb.session.commit()
+    resp = client.get(
+        '/patients/abc123/ccda/file_info', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json['filepath'] == '/tmp/moved'
+
+
+def test_batch_problem_lists(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    mrns = ['abc{}'.format(i) for i in range(5)]
+    for mrn in mrns:
+        client.put('/patients/{}/ccda'.format(mrn), json=data)
+    expected = client.get('/patients/abc0/problem_list').json['problem_list']
+
+    sdb.session.expunge_all()
+    with StatementCounter() as counter:
+        resp = client.post(
+            '/problem_lists', json={'mrns': mrns + ['missing']})
+    assert resp.status_code == 200
+    assert counter.count == 1
+    assert resp.json['not_found'] == ['missing']
+    assert sorted(resp.json['problem_lists']) == mrns
+    for mrn in mrns:
+        assert resp.json['problem_lists'][mrn]['problem_list'] == expected
+
+    # filtered lists match the single patient endpoint, in one more query
+    filter_by = {'filter': {'icd10': {'code': ['E78.*', 'H21.239']}}}
+    single = client.get('/patients/abc0/problem_list?filter={}'.format(
+        urllib.parse.quote(json.dumps(filter_by)))).json['problem_list']
+    assert single
+    sdb.session.expunge_all()
+    with StatementCounter() as counter:
+        resp = client.post(
+            '/problem_lists', json={'mrns': mrns, 'filter': filter_by})
+    assert counter.count == 2
+    for mrn in mrns:
+        assert resp.json['problem_lists'][mrn]['problem_list'] == single
+
+    assert client.post('/problem_lists', json={}).status_code == 400
+
+
+def test_change_feed(client):
+    here = os.path.dirname(__file__)
+    with open(os.path.join(here, 'prob_list.json'), 'r') as json_file:
+        data = json.load(json_file)
+    entries = data['problem_list']['section']['entry']
+    client.put('/patients/abc1/ccda', json=data)
+    client.put('/patients/abc1/ccda', json=data)
+    entries.pop()
+    older = dict(data, effectiveTime='20100101000000-0800')
+    client.put('/patients/abc1/ccda', json=older)
+    newer = dict(data, effectiveTime='20300101000000-0800')
+    client.put('/patients/abc1/ccda', json=newer)
+    client.put('/patients/abc2/ccda', json=data)
+
+    resp = client.get('/changes')
+    assert [(c['mrn'], c['action']) for c in resp.json['changes']] == [
+        ('abc1', 'inserted'), ('abc1', 'unchanged'), ('abc1', 'obsolete'),
+        ('abc1', 'replaced'), ('abc2', 'inserted')]
+    assert resp.json['changes'][3]['generation_time'].startswith('2030')
+    assert 'Link' not in resp.headers
+    last = resp.json['cursor']
+
+    # keyset pages, following the advertised cursor
+    resp = client.get('/changes?limit=2')
+    assert len(resp.json['changes']) == 2
+    cursor = resp.headers['X-Next-Cursor']
+    assert cursor == resp.json['cursor']
+    resp = client.get('/changes?since={}&limit=2'.format(cursor))
+    assert resp.json['changes'][0]['action'] == 'obsolete'
+
+    # long polling is disabled by default
+    start = time.time()
+    resp = client.get('/changes?since={}&wait=5'.format(last))
+    assert time.time() - start < 1
+    assert resp.json == {'changes': [], 'cursor': last}
+
+    # nothing new, long poll times out with the same cursor
+    client.application.config['CHANGE_FEED_MAX_WAIT'] = 1
+    start = time.time()
+    resp = client.get('/changes?since={}&wait=0.2'.format(last))
+    assert time.time() - start >= 0.2
+    assert resp.json == {'changes': [], 'cursor': last}
+
+    # recent changes are held back until settled
+    client.application.config['CHANGE_FEED_SETTLE'] = 60
+    assert client.get('/changes').json['changes'] == []
+    assert client.get('/changes?limit=0').status_code == 400